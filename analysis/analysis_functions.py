@@ -33,7 +33,10 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import os
+import os, csv, math
+import multiprocessing
+import numpy
+from scipy import special, stats
 
 ##################### HELPER FUNCTIONS #########################
 
@@ -77,3 +80,315 @@ def readMethods(filepath):
                 line = line.rstrip().split()
                 methods.append(line[0])
         return methods
+
+##################### WRITING OUT #########################
+
+# buffer size of the output files
+buffer_size = 1 << 20
+
+def openOutput(filepath):
+    '''Opens a buffered output file'''
+    return open(filepath, 'w', buffer_size)
+
+def writeTable(outfile, labels, aves, stds, sep=" ", decimals=3):
+    '''Writes a table with one line per label and the pairs
+    average std for each column of the arrays (label x column)'''
+    fmt = "%%.%if %%.%if " % (decimals, decimals)
+    row_fmt = "%s" + sep + fmt*aves.shape[1] + "\r\n" # for Windows
+    data = numpy.empty((aves.shape[0], 2*aves.shape[1]))
+    data[:,0::2] = aves
+    data[:,1::2] = stds
+    outfile.write("".join([row_fmt % ((l,)+tuple(r)) for l,r in zip(labels, data.tolist())]))
+
+def writeRankingCSV(outfile, fps, targets, ranks):
+    '''Writes the ranks (fp x target x repeat) as csv lines
+    "fp","target","rank","repeat" ordered by target, fp and repeat'''
+    outfile.write("\"fp\",\"target\",\"rank\",\"repeat\"\n")
+    ranks = numpy.swapaxes(ranks, 0, 1)
+    t, f, q = numpy.nonzero(~numpy.isnan(ranks))
+    if len(t) == 0: return
+    r = ranks[t,f,q].astype(numpy.int64)
+    # the lines are put together from a prefix per (target, fp)
+    # and a suffix per (rank, repeat), both formatted only once
+    prefix = numpy.array([["\"%s\",\"%s\",\"" % (k, target) for k in fps] for target in targets], dtype=object)
+    suffix = numpy.array([["%i\",\"%i\"\n" % (i, j+1) for j in range(ranks.shape[2])] for i in range(r.max()+1)], dtype=object)
+    outfile.write("".join((prefix[t,f] + suffix[r,q]).tolist()))
+
+##################### RESULTS STORE #########################
+# all validation results of a run in two arrays (values and ranks)
+# with the dimensions method x fp x target x repeat; each target
+# is labelled with its data set, missing repeats are NaN;
+# the averages per (method, fp, target) are cached in the store
+# as they do not change when fingerprints are added
+
+class ResultsStore:
+    '''Consolidated validation results of a run'''
+    def __init__(self, methods, fps, datasets, targets, values, ranks, aves=None, stds=None):
+        self.methods = list(methods)
+        self.fps = list(fps)
+        self.datasets = list(datasets) # data set of each target
+        self.targets = list(targets)
+        self.values = values
+        self.ranks = ranks
+        self.aves = aves
+        self.stds = stds
+    def method(self, m):
+        '''Returns the index of a method'''
+        if m not in self.methods:
+            raise KeyError('method not in results store:', m)
+        return self.methods.index(m)
+    def targetIndices(self, dataset):
+        '''Returns the indices of the targets of a data set'''
+        return [i for i,d in enumerate(self.datasets) if d == dataset]
+    def averages(self):
+        '''Returns the average and standard deviation of the values
+        over the repeats (method x fp x target)'''
+        if self.aves is None:
+            self.aves = numpy.nanmean(self.values, axis=-1)
+            self.stds = numpy.nanstd(self.values, axis=-1)
+        return self.aves, self.stds
+    def addFingerprints(self, other):
+        '''Adds the fingerprints of another results store with the
+        same methods and targets; the cached averages are kept and
+        the ranks are recalculated for the new set of fingerprints'''
+        for k in other.fps:
+            if k in self.fps:
+                raise ValueError('fingerprint already in results store:', k)
+        keys = zip(self.datasets, self.targets)
+        other_keys = dict((k,i) for i,k in enumerate(zip(other.datasets, other.targets)))
+        if set(keys) != set(other_keys) or set(self.methods) != set(other.methods):
+            raise ValueError('results stores have different methods or targets')
+        m_idx = [other.methods.index(m) for m in self.methods]
+        t_idx = [other_keys[k] for k in keys]
+        other_aves, other_stds = other.averages()
+        aves, stds = self.averages()
+        # pad the repeats to the same number
+        num_rep = max(self.values.shape[-1], other.values.shape[-1])
+        values = [numpy.full(v.shape[:-1] + (num_rep,), numpy.nan) for v in [self.values, other.values]]
+        values[0][...,:self.values.shape[-1]] = self.values
+        values[1][...,:other.values.shape[-1]] = other.values[m_idx][:,:,t_idx]
+        self.values = numpy.concatenate(values, axis=1)
+        self.aves = numpy.concatenate([aves, other_aves[m_idx][:,:,t_idx]], axis=1)
+        self.stds = numpy.concatenate([stds, other_stds[m_idx][:,:,t_idx]], axis=1)
+        self.fps += other.fps
+        self.ranks = rankValues(self.values, self.fps)
+    def averageRanks(self):
+        '''Returns the average and standard deviation of the ranks
+        over all targets and repeats (method x fp)'''
+        ranks = self.ranks.reshape(self.ranks.shape[:2] + (-1,))
+        return numpy.nanmean(ranks, axis=-1), numpy.nanstd(ranks, axis=-1)
+    def write(self, filepath):
+        '''Writes the results store to a npz file'''
+        aves, stds = self.averages()
+        tmpfile = filepath+'.tmp.npz'
+        numpy.savez_compressed(tmpfile, methods=numpy.array(self.methods), fps=numpy.array(self.fps),
+                               datasets=numpy.array(self.datasets), targets=numpy.array(self.targets),
+                               values=self.values, ranks=self.ranks, aves=aves, stds=stds)
+        os.rename(tmpfile, filepath)
+
+def rankValues(values, fps):
+    '''Ranks the fingerprints (second axis) by descending value
+    (method x fp x target x repeat), ties are ranked by descending
+    fp name as in the validation step; missing values are NaN'''
+    # sort key of the names: position in the sorted list of names
+    names = numpy.argsort(numpy.argsort(fps)).reshape((1, -1) + (1,)*(values.ndim-2))
+    names = numpy.broadcast_to(names, values.shape)
+    order = numpy.lexsort((-names, -values), axis=1)
+    # the rank of a fingerprint is its position in the order
+    ranks = numpy.argsort(order, axis=1) + 1.0
+    ranks[numpy.isnan(values)] = numpy.nan
+    return ranks
+
+def makeResultsStore(entries):
+    '''Builds a results store from a list of (data set, target,
+    validation results); the validation results have the format
+    {method: {fp: [[value, rank], ...]}}'''
+    if not entries:
+        raise ValueError('no validation results given')
+    methods = entries[0][2].keys()
+    fps = entries[0][2][methods[0]].keys()
+    num_rep = max([len(v[methods[0]][fps[0]]) for d,t,v in entries])
+    data = numpy.empty((2, len(methods), len(fps), len(entries), num_rep))
+    data.fill(numpy.nan)
+    for n,(dataset, target, validation) in enumerate(entries):
+        for i,m in enumerate(methods):
+            for j,k in enumerate(fps):
+                v = numpy.array(validation[m][k], dtype=float).reshape(-1, 2)
+                data[:,i,j,n,:len(v)] = v.T
+    datasets = [str(d) for d,t,v in entries]
+    targets = [str(t) for d,t,v in entries]
+    return ResultsStore(methods, fps, datasets, targets, data[0], data[1])
+
+def updateResultsStore(store, entries):
+    '''Adds the fingerprints of the validation results which are
+    not yet in the results store; returns the new fingerprints'''
+    new_entries = []
+    for dataset, target, validation in entries:
+        new = dict((m, dict((k,v) for k,v in validation[m].iteritems() if k not in store.fps)) for m in validation)
+        new_entries.append((dataset, target, new))
+    new_fps = new_entries[0][2].values()[0].keys()
+    if new_fps:
+        store.addFingerprints(makeResultsStore(new_entries))
+    return new_fps
+
+def readResultsStore(filepath):
+    '''Reads a results store from a npz file'''
+    checkPath(filepath)
+    data = numpy.load(filepath)
+    aves, stds = None, None
+    if 'aves' in data.files:
+        aves, stds = data['aves'], data['stds']
+    return ResultsStore(data['methods'].tolist(), data['fps'].tolist(), data['datasets'].tolist(),
+                        data['targets'].tolist(), data['values'], data['ranks'], aves, stds)
+
+##################### STATISTICAL ANALYSIS #########################
+# Friedman test with the fingerprints as groups and the targets as
+# blocks, followed by all pairwise comparisons of the fingerprints
+# (max-T test on the rank sums with single-step adjusted p-values,
+# the asymptotic form of the test in the R package coin)
+
+def rankBlocks(data):
+    '''Ranks the fingerprints (second-last axis) within each
+    target (last axis), ties get the average rank'''
+    x = numpy.swapaxes(data, -1, -2)[...,None]
+    y = numpy.swapaxes(x, -1, -2)
+    less = (y < x).sum(axis=-1)
+    equal = (y == x).sum(axis=-1)
+    return numpy.swapaxes(less + 0.5*(equal+1), -1, -2)
+
+def friedmanTest(data):
+    '''Friedman test for an array (fp x target) of mean ranks;
+    returns the test statistic and the p-value'''
+    num_fp, num_target = data.shape
+    r = rankBlocks(data)
+    # tie-corrected statistic
+    centered = r - 0.5*(num_fp+1)
+    ssb = (centered.sum(axis=1)**2).sum()
+    sst = (centered**2).sum() / (num_fp-1)
+    statistic = ssb / sst
+    return statistic, stats.chi2.sf(statistic, num_fp-1)
+
+def _studentizedRangeSF(q, k, num_z=2001):
+    '''Survival function of the studentized range distribution
+    for k groups and infinite degrees of freedom:
+    P(Q > q) = k * int phi(z) (Phi(z)^(k-1) - (Phi(z)-Phi(z-q))^(k-1)) dz'''
+    z = numpy.linspace(-9.0, 9.0, num_z)
+    q = numpy.asarray(q, dtype=float)[...,None]
+    log_a = special.log_ndtr(z)
+    # ratio Phi(z-q)/Phi(z), computed in log space for large q
+    ratio = numpy.exp(special.log_ndtr(z - q) - log_a)
+    # a^(k-1) - (a-b)^(k-1) = a^(k-1) * (1 - (1-b/a)^(k-1))
+    with numpy.errstate(divide='ignore'):
+        diff = numpy.exp((k-1)*log_a) * -numpy.expm1((k-1)*numpy.log1p(-numpy.minimum(ratio, 1.0)))
+    integrand = k * stats.norm.pdf(z) * diff
+    return numpy.trapz(integrand, z, axis=-1)
+
+# p-values below this value are set to it
+min_p_value = 1.0E-16
+
+class StudentizedRange:
+    '''Tabulated survival function of the studentized range
+    distribution for k groups (interpolated in log space)'''
+    def __init__(self, k, q_max=20.0, num_q=4001):
+        self.q = numpy.linspace(0.0, q_max, num_q)
+        sf = numpy.zeros(num_q)
+        # in slices to limit the memory of the integration
+        for i in range(0, num_q, 500):
+            sf[i:i+500] = _studentizedRangeSF(self.q[i:i+500], k)
+        self.log_sf = numpy.log(numpy.clip(sf, min_p_value, 1.0))
+    def sf(self, q):
+        return numpy.exp(numpy.interp(q, self.q, self.log_sf))
+
+def pairwisePValues(data, srange):
+    '''Single-step adjusted p-values of all pairwise comparisons
+    of the fingerprints for arrays (... x fp x target) of mean
+    ranks; returns an array (... x pair), the pairs are ordered
+    as numpy.triu_indices(num_fp, 1)'''
+    num_fp = data.shape[-2]
+    r = rankBlocks(data)
+    sums = r.sum(axis=-1)
+    # permutation variance of a difference of rank sums
+    var = 2.0 * ((r - r.mean(axis=-2)[...,None,:])**2).sum(axis=-2) / (num_fp-1)
+    var = var.sum(axis=-1)
+    i, j = numpy.triu_indices(num_fp, 1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        z = numpy.abs(sums[...,i] - sums[...,j]) / numpy.sqrt(var)[...,None]
+    z[~numpy.isfinite(z)] = 0.0
+    return numpy.maximum(srange.sf(math.sqrt(2)*z), min_p_value)
+
+def resampleMeans(ranks, num_res, random_state):
+    '''Resamples the repeats of each (fp, target) cell with
+    replacement and returns the resampled mean ranks
+    (resample x fp x target)'''
+    num_fp, num_target, max_rep = ranks.shape
+    # number of repeats per target (missing repeats are NaN)
+    num_rep = (~numpy.isnan(ranks[0])).sum(axis=1)
+    idx = (random_state.random_sample((num_res, num_fp, num_target, max_rep)) * num_rep[:,None]).astype(numpy.int32)
+    f = numpy.arange(num_fp)[:,None,None]
+    t = numpy.arange(num_target)[None,:,None]
+    values = ranks[f, t, idx]
+    values[:,:,numpy.arange(max_rep)[None,:] >= num_rep[:,None]] = 0.0
+    return values.sum(axis=-1) / num_rep
+
+# number of resamples drawn and tested together
+res_chunk = 10
+
+def _resampleChunk(args):
+    '''Resampled p-values of one chunk of resamples'''
+    ranks, num_res, seed, srange = args
+    return pairwisePValues(resampleMeans(ranks, num_res, numpy.random.RandomState(seed)), srange)
+
+def resamplePValues(ranks, num_res, seed, srange, num_jobs=1):
+    '''Adjusted p-values of the fingerprint pairs for num_res
+    resampled sets of repeats (resample x pair); the resamples
+    are drawn in chunks with their own seed, so the result does
+    not depend on the number of jobs'''
+    tasks = []
+    for i in range(0, num_res, res_chunk):
+        tasks.append((ranks, min(res_chunk, num_res-i), [seed, i], srange))
+    if num_jobs > 1:
+        pool = multiprocessing.Pool(num_jobs)
+        try:
+            p_values = pool.map(_resampleChunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        p_values = map(_resampleChunk, tasks)
+    return numpy.concatenate(p_values)
+
+def compareFingerprints(fps, ranks, num_res, seed=None, num_jobs=1):
+    '''Pairwise comparisons of the fingerprints (max-T test) for an
+    array (fp x target x repeat) of ranks; returns the global p-value
+    of the max-T test (smallest adjusted p-value), the adjusted
+    p-values of the pairs and the list [mean rank 1, mean rank 2,
+    fp1, fp2, [resampled p-values]]; the Friedman test itself is
+    friedmanTest'''
+    if seed is None: seed = numpy.random.randint(2**31-1)
+    means = numpy.nanmean(ranks, axis=-1)
+    srange = StudentizedRange(len(fps))
+    p_values = pairwisePValues(means, srange)
+    p_resampled = resamplePValues(ranks, num_res, seed, srange, num_jobs)
+    # mean rank of each fingerprint over all targets and repeats
+    mean_ranks = numpy.nanmean(ranks.reshape(len(fps), -1), axis=1)
+    friedman = []
+    for n,(i,j) in enumerate(zip(*numpy.triu_indices(len(fps), 1))):
+        # mean rank 1 < mean rank 2
+        if mean_ranks[i] > mean_ranks[j]: i,j = j,i
+        friedman.append([mean_ranks[i], mean_ranks[j], fps[i], fps[j], p_resampled[:,n].tolist()])
+    return p_values.min(), p_values, friedman
+
+def writePValues(filepath1, filepath2, friedman, p_values):
+    '''Writes the adjusted p-values of the fingerprint pairs
+    and the resampled p-values to csv files'''
+    outfile = open(filepath1, 'w')
+    outfile.write("\"fp.1\",\"fp.2\",\"mean.rank.1\",\"mean.rank.2\",\"adjusted.p-value\"\n")
+    for f,p in zip(friedman, p_values):
+        outfile.write("\"%s\",\"%s\",%.6f,%.6f,%.6g\n" % (f[2], f[3], f[0], f[1], p))
+    outfile.close()
+    outfile = open(filepath2, 'w')
+    for f in friedman:
+        outfile.write("\"%s\",\"%s\",%.6f,%.6f," % (f[2], f[3], f[0], f[1]))
+        outfile.write(",".join("%.6g" % p for p in f[4]))
+        outfile.write("\n")
+    outfile.close()
@@ -1,8 +1,8 @@
 #
 # $Id$
 #
-# loads average performance per target
-# and summarizes them in a single file
+# loads the results store with the performance
+# per target and summarizes them in a single file
 # for each fingerprint
 #
 # INPUT
@@ -77,47 +77,19 @@ if __name__=='__main__':
         ana_func.checkPath(inpath)
     outpath = inpath
 
-    summary = {}
-
-    # loop over dataset sources
-    for dataset in conf.set_data.keys():
-        print dataset
-        # input path
-        inpath = outpath+'/'+dataset
-
-        # loop over targets
-        for target in conf.set_data[dataset]['ids']:
-            print target
-
-            # load results
-            results, fpkeys = ana_func.readFile(open(inpath+'/target_'+str(target)+'.txt', 'r'))
-            methodkeys = results.keys()
-
-            # if summary is not yet set: prepare it
-            if len(summary) == 0:
-                for m in methodkeys:
-                    summary[m] = defaultdict(list)
-
-            # fill results into summary dictionary
-            for m in methodkeys:
-                for i,k in enumerate(fpkeys):
-                    j = i*2
-                    summary[m][k].append([target, results[m][j], results[m][j+1]])
+    # load results store
+    store = ana_func.readResultsStore(outpath+'/results.npz')
+    methodkeys = store.methods
+    fpkeys = store.fps
+    aves, stds = store.averages()
 
     # write out
     outdir = outpath+'/fp_summary/'
     if not os.path.exists(outdir): os.makedirs(outdir)
     # loop over fingerprints
-    for k in fpkeys:
-        outfile = open(outdir+'summary_'+k+'.txt', 'w')
+    for j,k in enumerate(fpkeys):
+        outfile = ana_func.openOutput(outdir+'summary_'+k+'.txt')
         ana_func.writeHeader(outfile, methodkeys)
-        # loop over targets
-        for t in range(len(summary[methodkeys[0]][k])):
-            curr_id = summary[methodkeys[0]][k][t][0]
-            outfile.write("%s " % curr_id)
-            # loop over methods
-            for m in methodkeys:
-                element = summary[m][k][t]
-                outfile.write("%.3f %.3f " % (element[1], element[2]))
-            outfile.write("\r\n") # for Windows
+        # one line per target
+        ana_func.writeTable(outfile, store.targets, aves[:,j].T, stds[:,j].T)
         outfile.close()
@@ -1,19 +1,29 @@
 # 
 # $Id$
 #
-# executes an R script for each method;
-# reads the generated csv files with 
-# fp pairs, mean rank, and 100 resampled p-values
+# performs a Friedman test for each method
+# on the ranks in the results store
+# (fingerprints as groups, targets as blocks)
+# followed by all pairwise comparisons of the fps;
+# the p-values of the pairs are calculated for
+# resampled sets of the repetitions
 #
 # INPUT
 # required:
 # -m [] : file containing the evaluation method names
 #         for which to perform the statistical analysis
 # optional:
-# -i [] : absolute input path (default: pwd/../validation/[data set name])
+# -i [] : relative input path (default: pwd)
+# -n [] : number of resamples (default: 100)
+# -s [] : seed of the random number generator (default: random)
+# -j [] : number of processes for the resampling (default: 1)
 # --help : prints usage
 #
-# OUTPUT: correlation tables for each method
+# OUTPUT: Friedman test statistic and p-value for each
+#         method (friedman_test.dat); correlation tables
+#         for each method;
+#         csv files with the fp pairs, mean ranks
+#         and (resampled) p-values
 #
 #  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
 #  All rights reserved.
@@ -45,8 +55,9 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import csv, os, os.path, sys
-import operator, subprocess
+import os, os.path, sys
+import operator
+import numpy
 from optparse import OptionParser
 
 # import configuration file with global variables
@@ -60,13 +71,15 @@ import analysis_functions as ana_func
 # paths
 cwd = os.getcwd()
 path = cwd + '/'
-Rpath = '/usr/prog/R/2.15.2_gcc/bin/Rscript'
 
 # prepare command-line option parser
 usage = "usage: %prog [options] arg"
 parser = OptionParser(usage)
 parser.add_option("-m", "--methods", dest="filename", metavar="FILE", help="FILE containing the evaluation method names")
 parser.add_option("-i", "--inpath", dest="inpath", metavar="PATH", help="relative input PATH (default: pwd)")
+parser.add_option("-n", "--num_res", dest="num_res", type="int", metavar="INT", help="number of resamples (default: 100)")
+parser.add_option("-s", "--seed", dest="seed", type="int", metavar="INT", help="seed of the random number generator (default: random)")
+parser.add_option("-j", "--jobs", dest="num_jobs", type="int", metavar="INT", help="number of processes for the resampling (default: 1)")
 
 ######################## MAIN PART ###########################
 if __name__=='__main__':
@@ -87,53 +100,48 @@ if __name__=='__main__':
         inpath = path+options.inpath+'/stat_analysis/'
         ana_func.checkPath(inpath)
     outpath = inpath
+    num_res = 100
+    if options.num_res: num_res = options.num_res
+    seed = options.seed
+    if seed is None: seed = numpy.random.randint(2**31-1)
+    num_jobs = 1
+    if options.num_jobs: num_jobs = options.num_jobs
+    print "seed:", seed
+
+    # load results store
+    store = ana_func.readResultsStore(inpath+'../results.npz')
 
     # output file(s)
     outfile = open(outpath+'correlation_tables.dat', 'w')
     texfile = open(outpath+'correlation_tables_latex.dat', 'w') # as latex tabulars
+    testfile = open(outpath+'friedman_test.dat', 'w')
+    testfile.write("# method\tstatistic\tp-value\n")
 
     # loop over methods
     for m in methods:
         print m
 
-        # run R script
-        R_input = inpath+'fp_ranking_'+m+'.csv'
-        ana_func.checkPath(R_input)
-        R_output1 = outpath+'friedman_fp_ranking_'+m+'.csv'
-        R_output2 = outpath+'friedman_resampled_p_values_'+m+'.csv'
-        proc = subprocess.call([Rpath, path+'Friedman_Test.Target_x_FP_Data.R', R_input, R_output1, R_output2])
+        # ranks of the fingerprints (fp x target x repeat)
+        fps = store.fps
+        ranks = store.ranks[store.method(m)]
+
+        # Friedman test on the mean ranks over the repeats (fp x target)
+        statistic, p_friedman = ana_func.friedmanTest(numpy.nanmean(ranks, axis=-1))
+        print "Friedman test: chi-squared =", statistic, "p-value =", p_friedman
+        testfile.write("%s\t%s\t%s\n" % (m, statistic, p_friedman))
 
-        if not proc: # 0 if successfull
+        # global test and pairwise comparisons
+        # friedman has the format:
+        # [mean rank 1, mean rank 2, fp1, fp2, [p-values 1..num_res]]
+        p_global, p_values, friedman = ana_func.compareFingerprints(fps, ranks, num_res, seed, num_jobs)
+        print "global p-value:", p_global
+        ana_func.writePValues(outpath+'friedman_fp_ranking_'+m+'.csv', outpath+'friedman_resampled_p_values_'+m+'.csv', friedman, p_values)
+
+        if p_global < conf.p_value: # no post hoc test otherwise
 
             outfile.write("%s\n" % m)
             texfile.write("%s\n" % m)
 
-            # read in csv file
-            friedman = []
-            with open(R_output2, 'r') as csvfile:
-                myreader = csv.reader(csvfile, delimiter=',')
-                for row in myreader: 
-                    if row[0] != "": # header leave out
-                        # row has the format:
-                        # [index, fp1, fp2, mean rank 1, mean rank 2, p-value1, ..., p-value100]
-
-                        # check if mean rank 1 < mean rank 2, else exchange
-                        if float(row[3]) > float(row[4]):
-                            # exchange fingerprint names
-                            tmp = row[1]
-                            row[1] = row[2]
-                            row[2] = tmp
-                            # exchange mean ranks
-                            tmp = row[3]
-                            row[3] = row[4]
-                            row[4] = tmp
-
-                        # change format of the row to:
-                        # [mean rank 1, mean rank 2, fp1, fp2, [p-values 1..100]]
-                        tmp = [float(row[3]), float(row[4]), row[1], row[2]]
-                        tmp.append([float(x) for x in row[5:]])
-                        friedman.append(tmp)
-
             # sort the table (first column, than second column)
             friedman = sorted(friedman)
             # order list of fps with respect to mean rank
@@ -187,6 +195,9 @@ if __name__=='__main__':
             texfile.write("& 13 \\\\ \n")
             outfile.write("%s\n\n" % fps[-1])
             texfile.write("    \\textbf{%s} & & & & & & & & & & & & & & & 13 \\\\ \\hline \n\n" % fps[-1].upper())
+        else:
+            print "no significant difference between the fingerprints, no post hoc test"
 
     outfile.close()
     texfile.close()
+    testfile.close()
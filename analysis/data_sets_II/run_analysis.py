@@ -8,9 +8,14 @@
 # optional:
 # -i [] : absolute input path (default: pwd/../validation)
 # -o [] : absolute output path (default: pwd)
+# -u : update mode, only the fingerprints not yet in the
+#      results store of the output path are added, the
+#      averages of the other fingerprints are kept
 # --help : prints usage
 #
-# OUTPUT: for each target in each dataset
+# OUTPUT: a results store (results.npz) with the values
+#         and ranks of all methods, fps, targets and
+#         repetitions; for each target in each dataset
 #         a summary for each fp and method;
 #         for each method a list with ranks
 #         for each fingerprint and repetition
@@ -69,6 +74,7 @@ usage = "usage: %prog [options] arg"
 parser = OptionParser(usage)
 parser.add_option("-i", "--inpath", dest="inpath", metavar="PATH", help="relative input PATH (default: pwd/../validation)")
 parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relative output PATH (default: pwd)")
+parser.add_option("-u", "--update", action="store_true", dest="update", help="add new fingerprints to an existing results store")
 
 ######################## MAIN PART ###########################
 if __name__=='__main__':
@@ -87,78 +93,46 @@ if __name__=='__main__':
         ana_func.checkPath(outpath)
     tmppath = inpath
 
-    ranks = {}
-    header = False # header written to csv file
-
-    # output directories and input directory
-    outdir = outpath+'/ChEMBL'
-    if not os.path.exists(outdir): os.makedirs(outdir)
-    outdir_csv = outpath+'/stat_analysis'
-    if not os.path.exists(outdir_csv): os.makedirs(outdir_csv)
-    inpath = tmppath+'/ChEMBL'
-
+    # load the validation results of all targets
+    entries = []
     # loop over targets
     for target in conf.set_data:
         print target
-
-        # load results
-        validation = cPickle.load(gzip.open(inpath+'/validation_'+str(target)+'.pkl.gz', 'r'))
-        methodkeys = validation.keys()
-        fpkeys = validation[methodkeys[0]].keys()
-
-        # if ranks is not yet set: prepare it
-        if len(ranks) == 0:
-            for m in methodkeys:
-                ranks[m] = defaultdict(list)
-
-        # prepare writing out
-        # if header is not yet written to csv file
-        if not header:
-            for m in methodkeys:
-                outfile_csv = open(outdir_csv+'/fp_ranking_'+m+'.csv', 'w')
-                outfile_csv.write("\"fp\",\"target\",\"rank\",\"repeat\"\n")
-                outfile_csv.close()
-            header = True
-
-        # header of average score per target
-        outfile = open(outdir+'/target_'+str(target)+'.txt', 'w')
+        validation = cPickle.load(gzip.open(tmppath+'/ChEMBL/validation_'+str(target)+'.pkl.gz', 'r'))
+        entries.append(('ChEMBL', target, validation))
+
+    # consolidated results store
+    if options.update:
+        store = ana_func.readResultsStore(outpath+'/results.npz')
+        new_fps = ana_func.updateResultsStore(store, entries)
+        print "new fingerprints:", " ".join(new_fps)
+    else:
+        store = ana_func.makeResultsStore(entries)
+    store.write(outpath+'/results.npz')
+    methodkeys = store.methods
+    fpkeys = store.fps
+    aves, stds = store.averages()
+
+    # average score per target
+    outdir = outpath+'/ChEMBL'
+    if not os.path.exists(outdir): os.makedirs(outdir)
+    for t,target in enumerate(store.targets):
+        outfile = ana_func.openOutput(outpath+'/'+store.datasets[t]+'/target_'+target+'.txt')
         ana_func.writeHeader(outfile, fpkeys)
-
-        # calculate average score
-        # loop over methods
-        for m in methodkeys:
-            outfile.write("%s\t" % m) # average score file
-            outfile_csv = open(outdir_csv+'/fp_ranking_'+m+'.csv', 'a') # csv file: append!
-            # loop over fingerprints
-            for k in fpkeys:
-                # csv rank file
-                for i,v in enumerate(validation[m][k]):
-                    outfile_csv.write("\"%s\",\"%s\",\"%i\",\"%i\"\n" % (k, str(target), v[1], i+1))
-                # average score file
-                tmp = []
-                for i in validation[m][k]:
-                    ranks[m][k].append(i[1]) # store ranks
-                    tmp.append(i[0])
-                tmp = np.array(tmp)
-                ave = np.average(tmp)
-                std = np.std(tmp)
-                outfile.write("%.3f %.3f " % (ave, std))
-            outfile.write("\r\n") # for Windows
-
-            outfile_csv.close()
+        ana_func.writeTable(outfile, methodkeys, aves[:,:,t], stds[:,:,t], sep="\t")
         outfile.close()
 
+    # csv files with the ranks for the statistical analysis
+    outdir_csv = outpath+'/stat_analysis'
+    if not os.path.exists(outdir_csv): os.makedirs(outdir_csv)
+    for i,m in enumerate(methodkeys):
+        outfile_csv = ana_func.openOutput(outdir_csv+'/fp_ranking_'+m+'.csv')
+        ana_func.writeRankingCSV(outfile_csv, fpkeys, store.targets, store.ranks[i])
+        outfile_csv.close()
+
     # calculate average ranks and write out
-    outfile = open(outpath+'/average_rank_fps.txt', 'w')
+    ave_ranks, std_ranks = store.averageRanks()
+    outfile = ana_func.openOutput(outpath+'/average_rank_fps.txt')
     ana_func.writeHeader(outfile, fpkeys)
-    averages = defaultdict(list)
-    for m in methodkeys:
-        outfile.write("%s " % m)
-        for k in fpkeys:
-            tmp = np.array(ranks[m][k])
-            ave = np.average(tmp)
-            std = np.std(tmp)
-            outfile.write("%.2f %.2f " % (ave, std))
-            averages[m].append([ave, k])
-        outfile.write("\r\n") # for Windows
+    ana_func.writeTable(outfile, methodkeys, ave_ranks, std_ranks, decimals=2)
     outfile.close()
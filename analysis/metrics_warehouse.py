@@ -0,0 +1,204 @@
+#
+# $Id$
+#
+# collects the validation results of different runs
+# in a SQLite database and queries aggregates
+# across runs
+#
+# INPUT
+# required:
+# command : import or query
+# optional:
+# -d [] : relative path of the database (default: pwd/metrics.db)
+# import:
+# -i [] : relative path of the analysis output of a run, i.e.
+#         the directory with results.npz (more than one possible)
+# -r [] : name of the run (one per input path, default: input path)
+# query:
+# -m [] : evaluation method (required)
+# -g [] : comma-separated columns to group by: run, dataset,
+#         target, fp (default: fp)
+# -s [] : only runs with this name (more than one possible)
+# -f [] : only this fingerprint (more than one possible)
+# -t [] : only this data set (more than one possible)
+# --help : prints usage
+#
+# OUTPUT: import: new runs added to the database,
+#         runs already in the database are skipped
+#         query: for each group the number of repetitions,
+#         the average and std of the value and the average rank
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, os.path, math, time
+import sqlite3
+import numpy
+from optparse import OptionParser
+
+# import analysis functions
+import analysis_functions as ana_func
+
+# paths
+cwd = os.getcwd()
+path = cwd+'/'
+
+# prepare command-line option parser
+usage = "usage: %prog [options] import|query"
+parser = OptionParser(usage)
+parser.add_option("-d", "--database", dest="database", metavar="FILE", help="relative path of the database (default: pwd/metrics.db)")
+parser.add_option("-i", "--inpath", action="append", dest="inpath", metavar="PATH", help="relative PATH of the analysis output of a run")
+parser.add_option("-r", "--run", action="append", dest="runs", metavar="NAME", help="NAME of the run (default: input path)")
+parser.add_option("-m", "--method", dest="method", metavar="NAME", help="evaluation method to query")
+parser.add_option("-g", "--groupby", dest="groupby", metavar="LIST", help="comma-separated columns to group by (default: fp)")
+parser.add_option("-s", "--select", action="append", dest="select_runs", metavar="NAME", help="only runs with this NAME")
+parser.add_option("-f", "--fp", action="append", dest="fps", metavar="NAME", help="only this fingerprint")
+parser.add_option("-t", "--dataset", action="append", dest="datasets", metavar="NAME", help="only this data set")
+
+# columns which can be used for grouping
+group_columns = ['run', 'dataset', 'target', 'fp']
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    path TEXT,
+    imported TEXT
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    dataset TEXT NOT NULL,
+    target TEXT NOT NULL,
+    fp TEXT NOT NULL,
+    method TEXT NOT NULL,
+    rep INTEGER NOT NULL,
+    value REAL,
+    rank INTEGER
+);
+CREATE INDEX IF NOT EXISTS metrics_key ON metrics (run_id, dataset, target, fp, method, rep);
+CREATE INDEX IF NOT EXISTS metrics_method ON metrics (method, fp);
+'''
+
+def connect(filepath):
+    '''Opens the database and creates the tables if needed'''
+    conn = sqlite3.connect(filepath)
+    conn.executescript(schema)
+    return conn
+
+def getRuns(conn):
+    '''Returns the names of the runs in the database'''
+    return [r[0] for r in conn.execute("SELECT name FROM runs ORDER BY run_id")]
+
+def _metricRows(run_id, store):
+    '''Generator of the rows of the metrics table of a results store'''
+    idx = numpy.argwhere(~numpy.isnan(store.values))
+    for i,j,t,q in idx:
+        yield (run_id, store.datasets[t], store.targets[t], store.fps[j], store.methods[i], int(q)+1,
+               float(store.values[i,j,t,q]), int(store.ranks[i,j,t,q]))
+
+def importRun(conn, name, store, runpath=''):
+    '''Adds the results store of a run to the database;
+    returns False if the run is already in the database'''
+    if conn.execute("SELECT 1 FROM runs WHERE name = ?", (name,)).fetchone():
+        return False
+    with conn: # single transaction
+        cur = conn.execute("INSERT INTO runs (name, path, imported) VALUES (?, ?, ?)",
+                           (name, runpath, time.strftime('%Y-%m-%d %H:%M:%S')))
+        conn.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)", _metricRows(cur.lastrowid, store))
+    return True
+
+def queryAggregates(conn, method, groupby=['fp'], runs=None, fps=None, datasets=None):
+    '''Returns for each group [group values..., number of repetitions,
+    average value, std of the value, average rank], ordered by
+    the average value'''
+    for g in groupby:
+        if g not in group_columns:
+            raise ValueError('cannot group by', g)
+    columns = ', '.join(['runs.name' if g == 'run' else 'metrics.'+g for g in groupby])
+    where = ["metrics.method = ?"]
+    params = [method]
+    for column, names in [('runs.name', runs), ('metrics.fp', fps), ('metrics.dataset', datasets)]:
+        if names:
+            where.append(column+" IN ("+", ".join("?"*len(names))+")")
+            params += names
+    sql = "SELECT "+columns+", COUNT(*), AVG(value), AVG(value*value), AVG(rank) " + \
+          "FROM metrics JOIN runs ON metrics.run_id = runs.run_id " + \
+          "WHERE "+" AND ".join(where)+" GROUP BY "+columns+" ORDER BY AVG(value) DESC"
+    rows = []
+    for r in conn.execute(sql, params):
+        n = len(groupby)
+        ave = r[n+1]
+        std = math.sqrt(max(r[n+2] - ave*ave, 0.0))
+        rows.append(list(r[:n]) + [r[n], ave, std, r[n+3]])
+    return rows
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in ['import', 'query']:
+        raise RuntimeError('command import or query required!')
+    command = args[0]
+
+    # optional arguments
+    dbfile = path+'metrics.db'
+    if options.database: dbfile = path+options.database
+    conn = connect(dbfile)
+
+    if command == 'import':
+        if not options.inpath:
+            raise RuntimeError('one or more of the required options was not given!')
+        names = options.inpath
+        if options.runs:
+            if len(options.runs) != len(options.inpath):
+                raise ValueError('number of run names differs from the number of input paths')
+            names = options.runs
+        known = set(getRuns(conn))
+        for name, inp in zip(names, options.inpath):
+            if name in known:
+                print name, "already in the database, skipped"
+                continue
+            store = ana_func.readResultsStore(path+inp+'/results.npz')
+            importRun(conn, name, store, inp)
+            print name, "imported"
+
+    else:
+        if not options.method:
+            raise RuntimeError('one or more of the required options was not given!')
+        groupby = ['fp']
+        if options.groupby: groupby = options.groupby.split(',')
+        rows = queryAggregates(conn, options.method, groupby, options.select_runs, options.fps, options.datasets)
+        print "# "+" ".join(groupby)+" num_reps ave std ave_rank"
+        for r in rows:
+            print " ".join([str(x) for x in r[:len(groupby)]]), "%i %.3f %.3f %.2f" % tuple(r[len(groupby):])
+
+    conn.close()
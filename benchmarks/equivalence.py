@@ -0,0 +1,321 @@
+#
+# $Id$
+#
+# golden-output equivalence harness: compares the output of a
+# legacy and an optimized code path record by record, i.e. the
+# scored lists (scores within a tolerance, tie order, internal
+# IDs and active/inactive labels) and the validation results
+# (values within a tolerance and ranks of the fingerprints)
+#
+# INPUT
+# required:
+# command : run or compare
+#           run: runs the legacy and the optimized commands
+#           and compares their output
+#           compare: compares two existing output paths
+# run:
+# -l [] : legacy command: script (relative to the root directory)
+#         and its arguments, {out} is replaced by the output path;
+#         can be given multiple times (run in order)
+# -f [] : optimized command, as -l
+# -o [] : relative path where the outputs are written
+#         (default: pwd/equivalence)
+# compare:
+# -a [] : relative path of the legacy output
+# -b [] : relative path of the optimized output
+# optional:
+# -s [] : absolute tolerance of the scores (default: 1e-9)
+# -v [] : absolute tolerance of the validation values
+#         (default: 1e-9)
+# -p [] : tie-order policy: strict (the order of the records
+#         must be the same) or ties (records with equal scores
+#         may be in any order) (default: strict)
+# -e : the shorter scored list may be the top of the longer one
+#      (early-recognition mode), a kept sample may contain fewer
+#      repetitions than the full lists (streaming mode)
+# -m [] : maximal number of divergences printed per file
+#         (default: 10)
+# --help : prints usage
+#
+# the scored lists list_[name].pkl.gz of the two outputs are
+# compared, a sample_list_[name].pkl.gz takes the place of a
+# missing list file; validation_[target].pkl.gz files are
+# compared in all subdirectories
+#
+# OUTPUT: the divergences per file and a summary; the exit code
+#         is 1 if the outputs diverge
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, os.path, sys, gzip, cPickle, shlex, subprocess
+from optparse import OptionParser
+
+# paths
+cwd = os.getcwd()
+path = cwd+'/'
+rootpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+
+# tie-order policies
+tie_policies = ['strict', 'ties']
+
+# prepare command-line option parser
+usage = "usage: %prog [options] run|compare"
+parser = OptionParser(usage)
+parser.add_option("-l", "--legacy", action="append", dest="legacy", metavar="COMMAND", help="legacy command (script and arguments, {out} is replaced by the output path), can be given multiple times")
+parser.add_option("-f", "--fast", action="append", dest="fast", metavar="COMMAND", help="optimized command, as --legacy")
+parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relative PATH where the outputs are written (default: pwd/equivalence)")
+parser.add_option("-a", "--path-a", dest="path_a", metavar="PATH", help="relative PATH of the legacy output")
+parser.add_option("-b", "--path-b", dest="path_b", metavar="PATH", help="relative PATH of the optimized output")
+parser.add_option("-s", "--score-tol", dest="score_tol", type="float", metavar="FLOAT", help="absolute tolerance of the scores (default: 1e-9)")
+parser.add_option("-v", "--value-tol", dest="value_tol", type="float", metavar="FLOAT", help="absolute tolerance of the validation values (default: 1e-9)")
+parser.add_option("-p", "--policy", dest="policy", metavar="NAME", help="tie-order policy: strict or ties (default: strict)")
+parser.add_option("-e", "--prefix", dest="prefix", action="store_true", help="the shorter scored list may be the top of the longer one")
+parser.add_option("-m", "--max", dest="max_print", type="int", metavar="INT", help="maximal number of divergences printed per file (default: 10)")
+
+##################### COMPARISON #########################
+
+def readLists(filepath):
+    '''Reads a file of scored lists: {fp: list of scored lists}'''
+    lists = {}
+    infile = gzip.open(filepath, 'r')
+    while 1:
+        try:
+            tmp = cPickle.load(infile)
+        except EOFError:
+            break
+        lists[tmp[0]] = tmp[1]
+    infile.close()
+    return lists
+
+def _tieGroups(scored_list, score_tol):
+    '''Returns the boundaries [start, end) of the groups of records
+    with equal scores (within the tolerance)'''
+    groups = []
+    start = 0
+    for i in range(1, len(scored_list)+1):
+        if i == len(scored_list) or abs(scored_list[i][0]-scored_list[start][0]) > score_tol:
+            groups.append((start, i))
+            start = i
+    return groups
+
+def compareScoredList(a, b, score_tol, policy, prefix):
+    '''Compares two scored lists [scores..., internal ID,
+    active/inactive]; returns the list of divergences as
+    (position, description)'''
+    diffs = []
+    num = len(a)
+    if len(a) != len(b):
+        if not prefix:
+            return [(min(len(a), len(b)), 'different lengths: %i != %i' % (len(a), len(b)))]
+        num = min(len(a), len(b))
+    for i in range(num):
+        ra, rb = a[i], b[i]
+        for j in range(len(ra)-2):
+            if abs(ra[j]-rb[j]) > score_tol:
+                diffs.append((i, 'score %i: %r != %r' % (j, ra[j], rb[j])))
+                break
+    if policy == 'strict':
+        for i in range(num):
+            if a[i][-2] != b[i][-2]:
+                diffs.append((i, 'ID: %s != %s' % (a[i][-2], b[i][-2])))
+            elif a[i][-1] != b[i][-1]:
+                diffs.append((i, 'label of %s: %s != %s' % (a[i][-2], a[i][-1], b[i][-1])))
+    else:
+        # the records of a tie group may be in any order, a group cut
+        # at the end of a prefix is compared as a subset
+        longer = a
+        if len(b) > len(a): longer = b
+        for start, end in _tieGroups(a[:num], score_tol):
+            ga = set([(r[-2], r[-1]) for r in a[start:end]])
+            gb = set([(r[-2], r[-1]) for r in b[start:end]])
+            if end == num and num < len(longer):
+                full = end
+                while full < len(longer) and abs(longer[full][0]-longer[start][0]) <= score_tol:
+                    full += 1
+                gl = set([(r[-2], r[-1]) for r in longer[start:full]])
+                if ga <= gl and gb <= gl: continue
+                missing = sorted((ga | gb) - gl)[:3]
+                diffs.append((start, 'tie group [%i, %i): records not in the longer list, e.g. %s' % (start, end, missing)))
+            elif ga != gb:
+                missing = sorted(ga - gb)[:3]
+                diffs.append((start, 'tie group [%i, %i): records differ, e.g. %s' % (start, end, missing)))
+    diffs.sort()
+    return diffs
+
+def compareListFiles(file_a, file_b, score_tol, policy, prefix):
+    '''Compares the scored lists of two files; returns the number
+    of compared lists and the divergences as (fp, repetition,
+    position, description)'''
+    lists_a = readLists(file_a)
+    lists_b = readLists(file_b)
+    diffs = []
+    num = 0
+    for fp in sorted(set(lists_a.keys()) | set(lists_b.keys())):
+        if fp not in lists_a or fp not in lists_b:
+            diffs.append((fp, None, None, 'missing in '+('legacy' if fp not in lists_a else 'optimized')+' output'))
+            continue
+        la, lb = lists_a[fp], lists_b[fp]
+        if len(la) != len(lb) and not prefix:
+            diffs.append((fp, None, None, 'different numbers of repetitions: %i != %i' % (len(la), len(lb))))
+        for q in range(min(len(la), len(lb))):
+            num += 1
+            for pos, d in compareScoredList(la[q], lb[q], score_tol, policy, prefix):
+                diffs.append((fp, q, pos, d))
+    return num, diffs
+
+def compareValidationFiles(file_a, file_b, value_tol):
+    '''Compares two validation results {method: {fp: [[value, rank],
+    ...]}}; returns the number of compared values and the
+    divergences as (method, fp, repetition, description)'''
+    res_a = cPickle.load(gzip.open(file_a, 'r'))
+    res_b = cPickle.load(gzip.open(file_b, 'r'))
+    diffs = []
+    num = 0
+    for m in sorted(set(res_a.keys()) | set(res_b.keys())):
+        if m not in res_a or m not in res_b:
+            diffs.append((m, None, None, 'method missing'))
+            continue
+        for fp in sorted(set(res_a[m].keys()) | set(res_b[m].keys())):
+            va, vb = res_a[m].get(fp), res_b[m].get(fp)
+            if va is None or vb is None:
+                diffs.append((m, fp, None, 'fingerprint missing'))
+                continue
+            if len(va) != len(vb):
+                diffs.append((m, fp, None, 'different numbers of repetitions: %i != %i' % (len(va), len(vb))))
+            for q in range(min(len(va), len(vb))):
+                num += 1
+                if abs(va[q][0]-vb[q][0]) > value_tol:
+                    diffs.append((m, fp, q, 'value: %r != %r' % (va[q][0], vb[q][0])))
+                elif va[q][1] != vb[q][1]:
+                    diffs.append((m, fp, q, 'rank: %r != %r' % (va[q][1], vb[q][1])))
+    return num, diffs
+
+def findOutputs(outpath):
+    '''Returns the scored-list files {name: file} (a kept sample
+    only if there is no full list) and the validation files
+    {relative path: file} of an output path'''
+    lists = {}
+    validation = {}
+    for dirpath, dirnames, filenames in os.walk(outpath):
+        for f in filenames:
+            filepath = os.path.join(dirpath, f)
+            if f.startswith('validation_') and f.endswith('.pkl.gz'):
+                validation[os.path.relpath(filepath, outpath)] = filepath
+            elif f.startswith('list_') and f.endswith('.pkl.gz'):
+                lists[os.path.relpath(filepath, outpath)] = filepath
+    for dirpath, dirnames, filenames in os.walk(outpath):
+        for f in filenames:
+            if f.startswith('sample_list_') and f.endswith('.pkl.gz'):
+                name = os.path.relpath(os.path.join(dirpath, f[len('sample_'):]), outpath)
+                if name not in lists: lists[name] = os.path.join(dirpath, f)
+    return lists, validation
+
+def compareOutputs(path_a, path_b, score_tol, value_tol, policy, prefix, max_print):
+    '''Compares all outputs of two paths and prints the divergences;
+    returns the number of divergences'''
+    lists_a, val_a = findOutputs(path_a)
+    lists_b, val_b = findOutputs(path_b)
+    num_diffs = 0
+    for kind, files_a, files_b in [('scored lists', lists_a, lists_b), ('validation', val_a, val_b)]:
+        for name in sorted(set(files_a.keys()) | set(files_b.keys())):
+            if name not in files_a or name not in files_b:
+                print "%s %s: missing in the %s output" % (kind, name, 'legacy' if name not in files_a else 'optimized')
+                num_diffs += 1
+                continue
+            if kind == 'scored lists':
+                num, diffs = compareListFiles(files_a[name], files_b[name], score_tol, policy, prefix)
+            else:
+                num, diffs = compareValidationFiles(files_a[name], files_b[name], value_tol)
+            status = 'equivalent'
+            if diffs: status = '%i divergences' % len(diffs)
+            print "%s %s: %i compared, %s" % (kind, name, num, status)
+            for d in diffs[:max_print]:
+                print "   ", " ".join(['-' if x is None else str(x) for x in d[:-1]])+":", d[-1]
+            num_diffs += len(diffs)
+    return num_diffs
+
+def runCommands(commands, outdir):
+    '''Runs the commands (script relative to the root directory and
+    arguments) in the directory of the script; {out} is replaced
+    by the output path relative to that directory'''
+    if not os.path.exists(outdir): os.makedirs(outdir)
+    for command in commands:
+        args = shlex.split(command)
+        scriptdir = os.path.dirname(os.path.abspath(rootpath+args[0]))
+        out = os.path.relpath(outdir, scriptdir)
+        args = [os.path.basename(args[0])] + [a.replace('{out}', out) for a in args[1:]]
+        print "running:", command
+        returncode = subprocess.call([sys.executable]+args, cwd=scriptdir)
+        if returncode != 0:
+            raise RuntimeError('command failed:', command)
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in ['run', 'compare']:
+        raise RuntimeError('command run or compare required!')
+    command = args[0]
+
+    # optional arguments
+    score_tol = 1e-9
+    if options.score_tol is not None: score_tol = options.score_tol
+    value_tol = 1e-9
+    if options.value_tol is not None: value_tol = options.value_tol
+    policy = 'strict'
+    if options.policy: policy = options.policy
+    if policy not in tie_policies:
+        raise ValueError('tie-order policy not supported:', policy)
+    max_print = 10
+    if options.max_print is not None: max_print = options.max_print
+
+    if command == 'run':
+        if not options.legacy or not options.fast:
+            raise RuntimeError('one or more of the required options was not given!')
+        outpath = path+'equivalence/'
+        if options.outpath: outpath = path+options.outpath+'/'
+        path_a = outpath+'legacy'
+        path_b = outpath+'optimized'
+        runCommands(options.legacy, path_a)
+        runCommands(options.fast, path_b)
+    else:
+        if not options.path_a or not options.path_b:
+            raise RuntimeError('one or more of the required options was not given!')
+        path_a = path+options.path_a
+        path_b = path+options.path_b
+
+    num_diffs = compareOutputs(path_a, path_b, score_tol, value_tol, policy, options.prefix, max_print)
+    if num_diffs:
+        print num_diffs, "divergences between the legacy and the optimized output"
+        sys.exit(1)
+    print "outputs are equivalent"
@@ -0,0 +1,217 @@
+#
+# $Id$
+#
+# generates a synthetic data set for scaling studies: the
+# compound lists of the targets are sampled from the SMILES
+# of the shipped compound lists and the training lists are
+# drawn as for subset I; the output is a directory tree with
+# the layout of the benchmarking platform (compounds,
+# query_lists, configuration_file_I.py and a copy of the
+# scripts), so that the scripts can be run on it unchanged
+#
+# INPUT
+# optional:
+# -s [] : number of decoys per target: 10k, 100k, 1M or an
+#         integer (default: 10k)
+# -a [] : number of actives per target (default: 100)
+# -n [] : number of targets (default: 1)
+# -r [] : number of repetitions of the training lists
+#         (default: num_reps of the configuration file)
+# -e [] : seed of the random number generator (default: 42)
+# -o [] : relative output path (default: pwd/synthetic_[size])
+# -x : do not copy the scripts into the output path
+# --help : prints usage
+#
+# OUTPUT: in the output path the data set SYN with the targets
+#         1 to n: compounds/SYN/cmp_list_SYN_[target]_actives.dat.gz,
+#         compounds/SYN/cmp_list_SYN_[target]_decoys.dat.gz and
+#         query_lists/data_sets_I/SYN/training_SYN_[target]_[num].pkl
+#         for each number of query mols
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, os.path, sys, glob, gzip, cPickle, shutil
+import numpy
+from optparse import OptionParser
+
+# paths
+cwd = os.getcwd()
+path = cwd+'/'
+rootpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+
+# import configuration file with global variables
+sys.path.insert(0, rootpath)
+import configuration_file_I as conf
+
+# name of the synthetic data set
+dataset = 'SYN'
+
+# predefined sizes (number of decoys per target)
+sizes = {'10k':10000, '100k':100000, '1M':1000000}
+
+# directories with scripts copied into the output path
+script_dirs = ['scoring', 'scoring/data_sets_I', 'validation', 'validation/data_sets_I',
+               'analysis', 'analysis/data_sets_I']
+
+# prepare command-line option parser
+usage = "usage: %prog [options]"
+parser = OptionParser(usage)
+parser.add_option("-s", "--size", dest="size", metavar="SIZE", help="number of decoys per target: 10k, 100k, 1M or an integer (default: 10k)")
+parser.add_option("-a", "--actives", dest="num_act", type="int", metavar="INT", help="number of actives per target (default: 100)")
+parser.add_option("-n", "--targets", dest="num_targets", type="int", metavar="INT", help="number of targets (default: 1)")
+parser.add_option("-r", "--reps", dest="num_reps", type="int", metavar="INT", help="number of repetitions of the training lists (default: num_reps of the configuration file)")
+parser.add_option("-e", "--seed", dest="seed", type="int", metavar="INT", help="seed of the random number generator (default: 42)")
+parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relative output PATH (default: pwd/synthetic_[size])")
+parser.add_option("-x", "--no-scripts", dest="no_scripts", action="store_true", help="do not copy the scripts into the output path")
+
+def readSmiles(inpath):
+    '''Reads the SMILES of all shipped compound lists (without
+    duplicates, in a fixed order)'''
+    smiles = set()
+    for f in sorted(glob.glob(inpath+'*/cmp_list_*.dat.gz')):
+        for line in gzip.open(f, 'r'):
+            if line[0] != '#':
+                smiles.add(line.rstrip().split()[2])
+    return sorted(smiles)
+
+def sampleIndices(num, pool_size, random_state):
+    '''Draws num indices from the pool, without replacement as
+    long as the pool is large enough'''
+    if num <= pool_size:
+        return random_state.permutation(pool_size)[:num]
+    return random_state.randint(0, pool_size, num)
+
+def writeCompounds(filepath, smiles, prefix):
+    '''Writes a compound list [external ID, internal ID, SMILES]'''
+    outfile = gzip.open(filepath, 'wb')
+    outfile.write("# EXT_ID\tID\tSMILES\n")
+    for i,s in enumerate(smiles):
+        outfile.write("%i\t%s_%i\t%s\n" % (i+1, prefix, i+1, s))
+    outfile.close()
+
+def writeTrainingLists(filepath, num_act, num_dcy, num_query, num_reps, random_state):
+    '''Writes the training lists of a target: per repetition the
+    indices of the query actives followed by the training decoys'''
+    num_train_dcy = int(conf.percent_dcy*num_dcy)
+    outfile = open(filepath, 'wb')
+    for q in range(num_reps):
+        training = random_state.permutation(num_act)[:num_query].tolist()
+        training += random_state.permutation(num_dcy)[:num_train_dcy].tolist()
+        cPickle.dump(training, outfile, 2)
+    outfile.close()
+
+def writeConfiguration(filepath, targets, num_reps):
+    '''Writes the configuration file of the synthetic data set,
+    with the license header and the global variables of the
+    configuration file of subset I'''
+    lines = open(rootpath+'configuration_file_I.py', 'r').readlines()
+    header = []
+    for line in lines:
+        if not line.startswith('#') and line.strip(): break
+        header.append(line)
+    outfile = open(filepath, 'w')
+    outfile.writelines(header)
+    outfile.write("# synthetic data set written by benchmarks/generate_data.py\n\n")
+    outfile.write("list_num_query_mols = %s\n" % conf.list_num_query_mols)
+    outfile.write("num_reps = %i # number of repetitions\n" % num_reps)
+    outfile.write("percent_dcy = %s # percentage of decoys used for training\n" % conf.percent_dcy)
+    outfile.write("p_value = %s # confidence level for statistical analysis\n\n" % conf.p_value)
+    outfile.write("set_data = {}\n")
+    outfile.write("set_data['%s'] = dict(fullname='synthetic', ids=%s)\n" % (dataset, targets))
+    outfile.close()
+
+def copyScripts(outpath):
+    '''Copies the scripts and function libraries'''
+    for d in script_dirs:
+        if not os.path.exists(outpath+d): os.makedirs(outpath+d)
+        for f in glob.glob(rootpath+d+'/*.py'):
+            shutil.copy(f, outpath+d)
+    shutil.copy(rootpath+'tracing.py', outpath)
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+
+    # optional arguments
+    size = '10k'
+    if options.size: size = options.size
+    if size in sizes:
+        num_dcy = sizes[size]
+    else:
+        try:
+            num_dcy = int(size)
+        except ValueError:
+            raise ValueError('size not supported:', size)
+    num_act = 100
+    if options.num_act: num_act = options.num_act
+    if num_act <= max(conf.list_num_query_mols):
+        raise ValueError('number of actives must be larger than', max(conf.list_num_query_mols))
+    num_targets = 1
+    if options.num_targets: num_targets = options.num_targets
+    num_reps = conf.num_reps
+    if options.num_reps: num_reps = options.num_reps
+    seed = 42
+    if options.seed is not None: seed = options.seed
+    outpath = path+'synthetic_'+size+'/'
+    if options.outpath: outpath = path+options.outpath+'/'
+
+    smiles = readSmiles(rootpath+'compounds/')
+    print len(smiles), "SMILES read in"
+
+    cmppath = outpath+'compounds/'+dataset+'/'
+    listpath = outpath+'query_lists/data_sets_I/'+dataset+'/'
+    for p in [cmppath, listpath]:
+        if not os.path.exists(p): os.makedirs(p)
+
+    random_state = numpy.random.RandomState(seed)
+    targets = range(1, num_targets+1)
+    for target in targets:
+        name = dataset+'_'+str(target)
+        # actives and decoys are drawn from disjoint parts of the pool
+        order = random_state.permutation(len(smiles))
+        act_pool = order[:len(smiles)/10]
+        dcy_pool = order[len(smiles)/10:]
+        actives = [smiles[act_pool[i]] for i in sampleIndices(num_act, len(act_pool), random_state)]
+        decoys = [smiles[dcy_pool[i]] for i in sampleIndices(num_dcy, len(dcy_pool), random_state)]
+        writeCompounds(cmppath+'cmp_list_'+name+'_actives.dat.gz', actives, name+'_A')
+        writeCompounds(cmppath+'cmp_list_'+name+'_decoys.dat.gz', decoys, name+'_D')
+        for num_query in conf.list_num_query_mols:
+            writeTrainingLists(listpath+'training_'+name+'_'+str(num_query)+'.pkl', num_act, num_dcy,
+                               num_query, num_reps, random_state)
+        print "target", target, "written:", num_act, "actives,", num_dcy, "decoys"
+
+    writeConfiguration(outpath+'configuration_file_I.py', targets, num_reps)
+    if not options.no_scripts:
+        copyScripts(outpath)
+    print "synthetic data set written to", outpath
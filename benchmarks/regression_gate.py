@@ -0,0 +1,275 @@
+#
+# $Id$
+#
+# performance regression gate: runs a benchmark profile (the
+# pipeline for a few targets, a panel of fingerprints and all
+# models, traced with tracing.py), stores the wall time, CPU
+# time and peak RSS per (script, stage) and compares them with
+# a saved baseline; the exit code is 1 if a stage regresses
+# beyond the tolerance
+#
+# INPUT
+# required:
+# command : run, compare or check
+#           run: runs the profile and writes the report
+#           compare: compares a report with the baseline
+#           check: runs the profile and compares it with the
+#           baseline (the report is saved as baseline if there
+#           is none yet)
+# run and check:
+# -t [] : target ([data set]:[target]), can be given multiple
+#         times (default: MUV:466, DUD:ace, ChEMBL:11359)
+# -f [] : fingerprint, can be given multiple times
+#         (default: ecfp4, maccs, rdk5)
+# -c [] : scoring model: sim, LR, NB or RF, can be given
+#         multiple times (default: all models)
+# -n [] : number of query mols (default: 10)
+# -r [] : number of runs, the minimum per stage is kept
+#         (default: 1)
+# -o [] : relative path of the report file (run: required)
+# compare and check:
+# -b [] : relative path of the baseline report (required)
+# -x [] : tolerance of the times, relative (default: 0.1)
+# -y [] : tolerance of the peak RSS, relative (default: 0.2)
+# -z [] : stages below this wall time (in seconds) in the
+#         baseline are not compared (default: 0.5)
+# compare: [] : report file to compare with the baseline
+# --help : prints usage
+#
+# reports of benchmarks/run_benchmarks.py can be compared as
+# well, the stages are then the benchmarks
+#
+# OUTPUT: the report with the timings and memory per stage,
+#         for compare and check the comparison per stage;
+#         exit code 1 if a stage is slower or larger than the
+#         baseline beyond the tolerance or missing
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, os.path, sys, json, time, socket, platform, shutil, subprocess, tempfile
+from optparse import OptionParser
+
+# paths
+cwd = os.getcwd()
+path = cwd+'/'
+rootpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+
+# import the summary of the traces
+sys.path.insert(0, rootpath)
+import tracing
+
+# default profile
+default_targets = ['MUV:466', 'DUD:ace', 'ChEMBL:11359']
+default_fps = ['ecfp4', 'maccs', 'rdk5']
+default_models = ['sim', 'LR', 'NB', 'RF']
+default_methods = ['AUC', 'EF 0.01 0.05', 'BEDROC 20']
+
+# prepare command-line option parser
+usage = "usage: %prog [options] run|compare|check [report]"
+parser = OptionParser(usage)
+parser.add_option("-t", "--target", action="append", dest="targets", metavar="NAME", help="target ([data set]:[target]), can be given multiple times")
+parser.add_option("-f", "--fp", action="append", dest="fps", metavar="NAME", help="fingerprint, can be given multiple times")
+parser.add_option("-c", "--model", action="append", dest="models", metavar="NAME", help="scoring model: sim, LR, NB or RF, can be given multiple times (default: all)")
+parser.add_option("-n", "--num", dest="num", type="int", metavar="INT", help="number of query mols (default: 10)")
+parser.add_option("-r", "--runs", dest="num_runs", type="int", metavar="INT", help="number of runs, the minimum per stage is kept (default: 1)")
+parser.add_option("-o", "--output", dest="output", metavar="FILE", help="relative path of the report file")
+parser.add_option("-b", "--baseline", dest="baseline", metavar="FILE", help="relative path of the baseline report")
+parser.add_option("-x", "--time-tol", dest="time_tol", type="float", metavar="FLOAT", help="relative tolerance of the times (default: 0.1)")
+parser.add_option("-y", "--memory-tol", dest="memory_tol", type="float", metavar="FLOAT", help="relative tolerance of the peak RSS (default: 0.2)")
+parser.add_option("-z", "--min-time", dest="min_time", type="float", metavar="FLOAT", help="stages below this wall time in the baseline are not compared (default: 0.5)")
+
+def runProfile(targets, fps, models, num, workdir):
+    '''Runs the pipeline for the profile in a working directory;
+    returns the stages {script:stage: [wall, cpu, peak RSS]}'''
+    fp_file = workdir+'/fps.txt'
+    methods_file = workdir+'/methods.txt'
+    trace_file = workdir+'/trace.jsonl'
+    open(fp_file, 'w').write("\n".join(fps)+"\n")
+    open(methods_file, 'w').write("\n".join(default_methods)+"\n")
+    args = [sys.executable, rootpath+'pipeline.py', '-f', fp_file, '-m', methods_file, '-n', str(num),
+            '-o', workdir+'/pipeline']
+    for m in models: args += ['-c', m]
+    for t in targets: args += ['-t', t]
+    env = dict(os.environ)
+    env[tracing.trace_env] = trace_file
+    # the fingerprints are calculated, not read from the fingerprint
+    # stores (fingerprint_lib.no_fp_store_env)
+    env['BENCHMARK_NO_FP_STORE'] = '1'
+    start = time.time()
+    log = open(workdir+'/pipeline.log', 'w')
+    returncode = subprocess.call([os.path.relpath(a, workdir) if a.startswith(workdir) else a for a in args],
+                                 cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    wall = time.time() - start
+    if returncode != 0:
+        raise RuntimeError('pipeline failed, see the log:', open(workdir+'/pipeline.log', 'r').read()[-2000:])
+    stages = {'pipeline:total': [wall, None, None]}
+    for r in tracing.summarizeTrace(tracing.readTrace([trace_file]), ['script', 'stage']):
+        stages[os.path.splitext(r[0])[0]+':'+r[1]] = [r[4], r[5], r[6]]
+    return stages
+
+def _min(a, b):
+    '''Minimum of two values which can be None'''
+    if a is None: return b
+    if b is None: return a
+    return min(a, b)
+
+def mergeRuns(runs):
+    '''Keeps the minimum of each value per stage over the runs'''
+    stages = {}
+    for run in runs:
+        for k,v in run.items():
+            if k not in stages:
+                stages[k] = list(v)
+            else:
+                stages[k] = [_min(a, b) for a,b in zip(stages[k], v)]
+    return stages
+
+def writeReport(filepath, info, stages):
+    '''Writes the report of a run (JSON)'''
+    report = dict(info=info, stages=dict([(k, dict(wall=v[0], cpu=v[1], peak_rss_kb=v[2])) for k,v in stages.items()]))
+    outfile = open(filepath+'.tmp', 'w')
+    json.dump(report, outfile, indent=1, sort_keys=True)
+    outfile.close()
+    os.rename(filepath+'.tmp', filepath)
+
+def readStages(filepath):
+    '''Reads the stages of a report; for the reports of
+    run_benchmarks.py the benchmarks are the stages'''
+    report = json.load(open(filepath, 'r'))
+    if 'stages' in report:
+        return report['stages']
+    stages = {}
+    for r in report['results']:
+        stages[r['group']+':'+r['name']] = dict(wall=r['min'], cpu=None, peak_rss_kb=r['peak_rss_kb'])
+    return stages
+
+def compareStages(baseline, stages, time_tol, memory_tol, min_time):
+    '''Compares the stages with the baseline; returns the list
+    [stage, baseline wall, wall, ratio, baseline RSS, RSS, status]
+    and the number of regressions'''
+    rows = []
+    num_regressions = 0
+    for k in sorted(baseline.keys()):
+        b = baseline[k]
+        if k not in stages:
+            rows.append([k, b['wall'], None, None, b['peak_rss_kb'], None, 'MISSING'])
+            num_regressions += 1
+            continue
+        s = stages[k]
+        ratio = None
+        if b['wall'] > 0: ratio = s['wall']/b['wall']
+        status = 'ok'
+        if b['wall'] < min_time:
+            status = 'skipped'
+        elif s['wall'] > b['wall']*(1.0+time_tol):
+            status = 'SLOWER'
+        if b['peak_rss_kb'] and s['peak_rss_kb'] and s['peak_rss_kb'] > b['peak_rss_kb']*(1.0+memory_tol):
+            status = 'LARGER' if status != 'SLOWER' else 'SLOWER,LARGER'
+        if status not in ['ok', 'skipped']: num_regressions += 1
+        rows.append([k, b['wall'], s['wall'], ratio, b['peak_rss_kb'], s['peak_rss_kb'], status])
+    for k in sorted(set(stages.keys()) - set(baseline.keys())):
+        s = stages[k]
+        rows.append([k, None, s['wall'], None, None, s['peak_rss_kb'], 'new'])
+    return rows, num_regressions
+
+def printComparison(rows):
+    '''Prints the comparison with the baseline'''
+    fmt = lambda v, f: '-' if v is None else f % v
+    print "# %-38s %10s %10s %7s %10s %10s %s" % ('stage', 'base[s]', 'new[s]', 'ratio', 'base[MB]', 'new[MB]', 'status')
+    for k, bw, w, ratio, brss, rss, status in rows:
+        print "%-40s %10s %10s %7s %10s %10s %s" % (k, fmt(bw, '%.3f'), fmt(w, '%.3f'), fmt(ratio, '%.2f'),
+              fmt(brss and brss/1024.0, '%.1f'), fmt(rss and rss/1024.0, '%.1f'), status)
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+    if not args or args[0] not in ['run', 'compare', 'check']:
+        raise RuntimeError('command run, compare or check required!')
+    command = args[0]
+    if command == 'run' and not options.output:
+        raise RuntimeError('one or more of the required options was not given!')
+    if command in ['compare', 'check'] and not options.baseline:
+        raise RuntimeError('one or more of the required options was not given!')
+    if command == 'compare' and len(args) != 2:
+        raise RuntimeError('report file to compare required!')
+    if command == 'check' and options.output and os.path.abspath(path+options.output) == os.path.abspath(path+options.baseline):
+        raise ValueError('report file (-o) and baseline (-b) must differ!')
+    # without baseline, the report of check is saved as baseline
+    new_baseline = command == 'check' and not os.path.exists(path+options.baseline)
+
+    # optional arguments
+    time_tol = 0.1
+    if options.time_tol is not None: time_tol = options.time_tol
+    memory_tol = 0.2
+    if options.memory_tol is not None: memory_tol = options.memory_tol
+    min_time = 0.5
+    if options.min_time is not None: min_time = options.min_time
+
+    if command in ['run', 'check']:
+        targets = options.targets or default_targets
+        fps = options.fps or default_fps
+        models = options.models or default_models
+        num = 10
+        if options.num: num = options.num
+        num_runs = 1
+        if options.num_runs: num_runs = options.num_runs
+        runs = []
+        for r in range(num_runs):
+            workdir = tempfile.mkdtemp(prefix='regression_gate_')
+            try:
+                runs.append(runProfile(targets, fps, models, num, workdir))
+            finally:
+                shutil.rmtree(workdir)
+            print "run", r+1, "of", num_runs, "done"
+        stages = mergeRuns(runs)
+        info = dict(host=socket.gethostname(), python=platform.python_version(), date=time.strftime('%Y-%m-%d %H:%M:%S'),
+                    targets=targets, fps=fps, models=models, num=num, num_runs=num_runs)
+        if options.output:
+            writeReport(path+options.output, info, stages)
+        if new_baseline:
+            writeReport(path+options.baseline, info, stages)
+            print "no baseline yet, report saved as baseline:", options.baseline
+            sys.exit(0)
+        report = dict([(k, dict(wall=v[0], cpu=v[1], peak_rss_kb=v[2])) for k,v in stages.items()])
+    elif command == 'compare':
+        report = readStages(path+args[1])
+
+    if command in ['compare', 'check']:
+        rows, num_regressions = compareStages(readStages(path+options.baseline), report, time_tol, memory_tol, min_time)
+        printComparison(rows)
+        if num_regressions:
+            print num_regressions, "stage(s) regressed beyond the tolerance"
+            sys.exit(1)
+        print "no regression"
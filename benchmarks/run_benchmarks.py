@@ -0,0 +1,287 @@
+#
+# $Id$
+#
+# benchmarks of the building blocks of the platform: fingerprint
+# generation for each entry of the fingerprint library, the
+# similarity metrics, the construction of the test lists, fit
+# and prediction of the ML models, fusion, validation methods
+# and analysis; each benchmark is run several times and the
+# minimum and median time are reported
+#
+# INPUT
+# optional:
+# -g [] : group of benchmarks: fingerprints, similarity, splits,
+#         models, fusion, validation, analysis, can be given
+#         multiple times (default: all groups)
+# -n [] : number of molecules (default: 2000)
+# -i [] : relative path of a compound list (cmp_list_[...].dat.gz)
+#         from which the molecules are read (default: the decoys
+#         of MUV 466)
+# -r [] : number of runs of each benchmark (default: 3)
+# -k [] : only benchmarks whose name contains this string
+# -e [] : seed of the random number generator (default: 42)
+# -o [] : relative path of the report file (JSON)
+# --help : prints usage
+#
+# OUTPUT: for each benchmark the number of items, the minimum and
+#         median time and the throughput (items per second);
+#         groups whose libraries (RDKit, scikit-learn) are not
+#         installed are skipped; the report file contains the
+#         parameters of the run, the timings and the skipped
+#         groups, so that runs can be compared
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, os.path, sys, gzip, json, time, socket, platform, timeit
+import resource
+import numpy
+from optparse import OptionParser
+
+# paths
+cwd = os.getcwd()
+path = cwd+'/'
+rootpath = os.path.dirname(os.path.abspath(__file__))+'/../'
+
+# import configuration file and function libraries
+for p in ['', 'scoring', 'validation', 'analysis']:
+    sys.path.insert(0, rootpath+p)
+import configuration_file_I as conf
+
+# default compound list
+default_input = 'compounds/MUV/cmp_list_MUV_466_decoys.dat.gz'
+
+# prepare command-line option parser
+usage = "usage: %prog [options]"
+parser = OptionParser(usage)
+parser.add_option("-g", "--group", action="append", dest="groups", metavar="NAME", help="group of benchmarks, can be given multiple times (default: all groups)")
+parser.add_option("-n", "--num", dest="num_mol", type="int", metavar="INT", help="number of molecules (default: 2000)")
+parser.add_option("-i", "--input", dest="input", metavar="FILE", help="relative path of a compound list from which the molecules are read (default: decoys of MUV 466)")
+parser.add_option("-r", "--runs", dest="num_runs", type="int", metavar="INT", help="number of runs of each benchmark (default: 3)")
+parser.add_option("-k", "--keyword", dest="keyword", metavar="NAME", help="only benchmarks whose name contains this string")
+parser.add_option("-e", "--seed", dest="seed", type="int", metavar="INT", help="seed of the random number generator (default: 42)")
+parser.add_option("-o", "--output", dest="output", metavar="FILE", help="relative path of the report file (JSON)")
+
+class Benchmarks:
+    '''Runs the benchmarks and collects the timings'''
+    def __init__(self, num_runs, keyword=None):
+        self.num_runs = num_runs
+        self.keyword = keyword
+        self.results = []
+        self.skipped = {}
+    def run(self, group, name, function, items):
+        '''Runs a function num_runs times; items is the number
+        of items processed in one run'''
+        if self.keyword and self.keyword not in name: return
+        times = []
+        for r in range(self.num_runs):
+            start = timeit.default_timer()
+            function()
+            times.append(timeit.default_timer() - start)
+        times.sort()
+        median = times[len(times)/2]
+        rate = 0.0
+        if times[0] > 0: rate = items/times[0]
+        self.results.append(dict(group=group, name=name, items=items, times=times, min=times[0], median=median,
+                                 rate=rate, peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        print "%-12s %-28s %9i %10.4f %10.4f %12.1f" % (group, name, items, times[0], median, rate)
+    def skip(self, group, reason):
+        self.skipped[group] = reason
+        print "%-12s skipped: %s" % (group, reason)
+
+def readSmiles(filepath, num_mol):
+    '''Reads the first num_mol SMILES of a compound list'''
+    smiles = []
+    for line in gzip.open(filepath, 'r'):
+        if line[0] != '#':
+            smiles.append(line.rstrip().split()[2])
+            if len(smiles) == num_mol: break
+    return smiles
+
+def makeScoredLists(num_lists, num_mol, num_act, random_state):
+    '''Returns random scored lists [score, internal ID, active/inactive]
+    of the same molecules, sorted by descending score'''
+    lists = []
+    for j in range(num_lists):
+        scores = random_state.rand(num_mol)
+        sl = [[scores[i], 'M_'+str(i), int(i < num_act)] for i in range(num_mol)]
+        sl.sort(reverse=True)
+        lists.append(sl)
+    return lists
+
+##################### BENCHMARKS #########################
+
+def benchFingerprints(bench, smiles, random_state):
+    '''SMILES parsing and each entry of the fingerprint library'''
+    from rdkit import Chem
+    import fingerprint_lib
+    bench.run('fingerprints', 'parse', lambda: [Chem.MolFromSmiles(s) for s in smiles], len(smiles))
+    mols = [Chem.MolFromSmiles(s) for s in smiles]
+    for fp in sorted(fingerprint_lib.fpdict.keys()):
+        calc = fingerprint_lib.fpdict[fp]
+        bench.run('fingerprints', fp, lambda: [calc(m) for m in mols], len(mols))
+    # all Morgan fingerprints derived from one calculation per invariant type
+    names = sorted(fingerprint_lib.morgan_params.keys())
+    bench.run('fingerprints', 'morgan_family', lambda: [fingerprint_lib.GetMorganFamily(m, names) for m in mols], len(mols))
+
+def benchSimilarity(bench, smiles, random_state):
+    '''Each similarity metric: the test molecules against 10 query
+    molecules as in the scoring scripts'''
+    import scoring_functions as scor
+    fps = [scor.getFP('ecfp4', s) for s in smiles]
+    query = fps[:10]
+    for simil in sorted(scor.simil_dict.keys()):
+        bench.run('similarity', simil, lambda: [scor.getBulkSimilarity(fp, query, simil) for fp in fps], len(fps))
+
+def benchSplits(bench, smiles, random_state):
+    '''Construction of the test lists from a training list
+    as in the scoring scripts of subset I'''
+    num_actives = 100
+    num_decoys = len(smiles)
+    for num_query_mols in conf.list_num_query_mols:
+        training_list = random_state.permutation(num_actives)[:num_query_mols].tolist()
+        training_list += random_state.permutation(num_decoys)[:int(conf.percent_dcy*num_decoys)].tolist()
+        def split():
+            test_list = [i for i in range(num_actives) if i not in training_list[:num_query_mols]]
+            test_list += [i for i in range(num_decoys) if i not in training_list[num_query_mols:]]
+            return test_list
+        bench.run('splits', 'test_list_'+str(num_query_mols), split, num_actives+num_decoys)
+
+def benchModels(bench, smiles, random_state):
+    '''Fit and prediction of the ML models with the default parameters
+    of the scoring scripts on random bit vectors (1024 bits)'''
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.naive_bayes import BernoulliNB
+    from sklearn.ensemble import RandomForestClassifier
+    num_mol = len(smiles)
+    num_train = 10 + int(conf.percent_dcy*num_mol)
+    data = (random_state.rand(num_mol, 1024) < 0.05).astype(numpy.float64)
+    ys_fit = numpy.array([1]*10 + [0]*(num_train-10))
+    models = {}
+    models['LR'] = lambda: LogisticRegression(penalty='l2', dual=False, C=1.0, fit_intercept=True, intercept_scaling=1.0, class_weight=None, tol=0.0001)
+    models['NB'] = lambda: BernoulliNB(alpha=1.0, binarize=None, fit_prior=True)
+    models['RF'] = lambda: RandomForestClassifier(criterion='gini', min_samples_split=2, max_depth=10, min_samples_leaf=1, n_estimators=100, n_jobs=1)
+    for name in sorted(models.keys()):
+        ml = models[name]()
+        bench.run('models', name+'_fit', lambda: ml.fit(data[:num_train], ys_fit), num_train)
+        bench.run('models', name+'_predict', lambda: ml.predict_proba(data), num_mol)
+
+def benchFusion(bench, smiles, random_state):
+    '''Alignment of the ranked lists and each fusion rule'''
+    import scoring_functions as scor
+    lists = makeScoredLists(4, len(smiles), len(smiles)/100, random_state)
+    bench.run('fusion', 'rank_matrix', lambda: scor.getRankMatrix(lists), len(lists)*len(smiles))
+    ids, labels, ranks, scores = scor.getRankMatrix(lists)
+    weights = [1.0]*len(lists)
+    for method in sorted(scor.fusion_dict.keys()):
+        bench.run('fusion', method, lambda: scor.fuseRanks(ids, labels, ranks, scores, method, weights), len(ids))
+
+def benchValidation(bench, smiles, random_state):
+    '''Each validation method on the ranked lists of 10 fingerprints'''
+    import validation_functions as vfunc
+    lines = {'AUC':['AUC'], 'EF':['EF', '0.01', '0.05'], 'BEDROC':['BEDROC', '20'], 'RIE':['RIE', '20']}
+    scores = dict([('fp'+str(j), [sl]) for j,sl in enumerate(makeScoredLists(10, len(smiles), len(smiles)/100, random_state))])
+    for name in sorted(lines.keys()) + ['all']:
+        if name == 'all':
+            method_dict = dict([(m, vfunc.read_dict[m](lines[m])) for m in lines])
+        else:
+            method_dict = {name:vfunc.read_dict[name](lines[name])}
+        def validate():
+            results = {}
+            for m in method_dict: method_dict[m].addNames(results)
+            vfunc.runMethods(method_dict, results, scores, 0, -1)
+        bench.run('validation', name, validate, len(scores))
+
+def benchAnalysis(bench, smiles, random_state):
+    '''Ranking of the fingerprints, Friedman test and pairwise
+    comparisons for 20 fingerprints and the targets of subset I'''
+    import analysis_functions as ana_func
+    num_targets = sum([len(conf.set_data[d]['ids']) for d in conf.set_data])
+    fps = ['fp'+str(j) for j in range(20)]
+    values = random_state.rand(2, len(fps), num_targets, conf.num_reps)
+    bench.run('analysis', 'rank_values', lambda: ana_func.rankValues(values, fps), values.size)
+    ranks = ana_func.rankValues(values, fps)[0]
+    means = ranks.mean(axis=-1)
+    bench.run('analysis', 'friedman', lambda: ana_func.friedmanTest(means), means.size)
+    bench.run('analysis', 'compare_fps', lambda: ana_func.compareFingerprints(fps, ranks, 100, 42), 100)
+
+# groups of benchmarks
+groups = [('fingerprints', benchFingerprints), ('similarity', benchSimilarity), ('splits', benchSplits),
+          ('models', benchModels), ('fusion', benchFusion), ('validation', benchValidation),
+          ('analysis', benchAnalysis)]
+
+def writeReport(filepath, info, bench):
+    '''Writes the report of a run (JSON)'''
+    report = dict(info=info, results=bench.results, skipped=bench.skipped)
+    outfile = open(filepath+'.tmp', 'w')
+    json.dump(report, outfile, indent=1, sort_keys=True)
+    outfile.close()
+    os.rename(filepath+'.tmp', filepath)
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+
+    # optional arguments
+    selected = [g for g,f in groups]
+    if options.groups:
+        for g in options.groups:
+            if g not in selected:
+                raise ValueError('group of benchmarks not supported:', g)
+        selected = options.groups
+    num_mol = 2000
+    if options.num_mol: num_mol = options.num_mol
+    inputfile = rootpath+default_input
+    if options.input: inputfile = path+options.input
+    num_runs = 3
+    if options.num_runs: num_runs = options.num_runs
+    seed = 42
+    if options.seed is not None: seed = options.seed
+
+    smiles = readSmiles(inputfile, num_mol)
+    info = dict(host=socket.gethostname(), python=platform.python_version(), numpy=numpy.__version__,
+                date=time.strftime('%Y-%m-%d %H:%M:%S'), input=os.path.relpath(inputfile, rootpath),
+                num_mol=len(smiles), num_runs=num_runs, seed=seed)
+    print "# %i molecules from %s, %i runs" % (len(smiles), info['input'], num_runs)
+    print "# %-10s %-28s %9s %10s %10s %12s" % ('group', 'benchmark', 'items', 'min[s]', 'median[s]', 'items/s')
+
+    bench = Benchmarks(num_runs, options.keyword)
+    for g,function in groups:
+        if g not in selected: continue
+        try:
+            function(bench, smiles, numpy.random.RandomState(seed))
+        except ImportError, e:
+            bench.skip(g, str(e))
+
+    if options.output:
+        writeReport(path+options.output, info, bench)
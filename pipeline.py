@@ -0,0 +1,415 @@
+#
+# $Id$
+#
+# runs the scoring, fusion, validation and analysis steps
+# as one pipeline; each step for each target (and fingerprint)
+# is a node of a dependency graph and is run with the script
+# of the step; a node is only run again if one of its inputs
+# (scripts, imported modules, configuration file, compound
+# and query lists, compound registry, fingerprint definitions,
+# parameters or upstream nodes) has changed
+#
+# INPUT
+# required:
+# -f [] : file containing the fingerprint names
+# -m [] : file containing the validation methods
+# -n [] : number of query mols (subset I only)
+# optional:
+# -d [] : subset of data sets: I or II (default: I)
+# -c [] : scoring model: sim, LR, NB or RF, can be given
+#         multiple times (default: sim)
+# -s [] : similarity metric (default: Dice)
+# -l [] : file containing the parameters of the ML models
+#         (default: default parameters of the scripts)
+# -u [] : fusion rule, can be given multiple times
+#         (default: no fusion)
+# -o [] : relative output path (default: pwd/pipeline)
+# -t [] : only this target ([data set]:[target] for subset I),
+#         can be given multiple times (default: all targets,
+#         the analysis steps are only run for all targets)
+# -j [] : number of nodes run in parallel (default: 1)
+# -x : dry run, only prints the nodes which would be run
+# --help : prints usage
+#
+# OUTPUT: in the output path the directories scoring/[model]_[fp],
+#         fusion, validation and analysis (with the statistical
+#         analysis and the summaries per fp and per method) with
+#         the output of the steps, stamps with the input hash of
+#         each finished node and logs with the output of each node
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, os.path, sys, time, json, hashlib, subprocess
+from optparse import OptionParser
+
+# paths
+cwd = os.getcwd()
+path = cwd+'/'
+rootpath = os.path.dirname(os.path.abspath(__file__))+'/'
+
+# scripts of the scoring models
+model_scripts = {'sim':'calculate_scored_lists.py', 'LR':'calculate_scored_lists_LR.py',
+                 'NB':'calculate_scored_lists_NB.py', 'RF':'calculate_scored_lists_RF.py'}
+
+# prepare command-line option parser
+usage = "usage: %prog [options] arg"
+parser = OptionParser(usage)
+parser.add_option("-f", "--fingerprints", dest="fp_file", metavar="FILE", help="FILE containing the fingerprint names")
+parser.add_option("-m", "--methods", dest="methods_file", metavar="FILE", help="FILE containing the validation methods")
+parser.add_option("-n", "--num", dest="num", type="int", metavar="INT", help="number of query mols (subset I only)")
+parser.add_option("-d", "--subset", dest="subset", metavar="NAME", help="subset of data sets: I or II (default: I)")
+parser.add_option("-c", "--model", action="append", dest="models", metavar="NAME", help="scoring model: sim, LR, NB or RF, can be given multiple times (default: sim)")
+parser.add_option("-s", "--similarity", dest="simil", metavar="NAME", help="NAME of similarity metric to use (default: Dice)")
+parser.add_option("-l", "--ml", dest="ml_file", metavar="FILE", help="FILE containing the parameters of the ML models")
+parser.add_option("-u", "--fusion", action="append", dest="fusion", metavar="NAME", help="fusion rule, can be given multiple times (default: no fusion)")
+parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relative output PATH (default: pwd/pipeline)")
+parser.add_option("-t", "--target", action="append", dest="targets", metavar="NAME", help="only this target ([data set]:[target] for subset I), can be given multiple times (default: all targets)")
+parser.add_option("-j", "--jobs", dest="num_jobs", type="int", metavar="INT", help="number of nodes run in parallel (default: 1)")
+parser.add_option("-x", "--dry_run", dest="dry_run", action="store_true", help="only print the nodes which would be run (default: False)")
+
+##################### DEPENDENCY GRAPH #########################
+
+class Node:
+    '''A step of the pipeline: a script run with a set of arguments,
+    its output files, input files, further input values (e.g. the
+    signature of a fingerprint definition) and upstream nodes'''
+    def __init__(self, name, script, args, outputs, files, deps=[], values=[]):
+        self.name = name
+        self.script = script
+        self.args = [str(a) for a in args]
+        self.outputs = outputs
+        self.files = files
+        self.deps = deps
+        self.values = values
+        self.key = None
+    def command(self):
+        '''Returns the command line, the script is run in its directory
+        and all paths in args are relative to this directory'''
+        return [sys.executable, os.path.basename(self.script)] + self.args
+
+class FileHashes:
+    '''Content hashes of files, cached on size and modification time'''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.cache = {}
+        if os.path.exists(filepath):
+            self.cache = json.load(open(filepath, 'r'))
+    def get(self, filepath):
+        if not os.path.exists(filepath): return 'missing'
+        st = os.stat(filepath)
+        entry = self.cache.get(filepath)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+        h = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                h.update(block)
+        self.cache[filepath] = [st.st_size, st.st_mtime, h.hexdigest()]
+        return h.hexdigest()
+    def write(self):
+        json.dump(self.cache, open(self.filepath, 'w'))
+
+def setKeys(nodes, hashes):
+    '''Calculates the key of each node (in topological order) from
+    the hashes of its script and input files, its arguments, its
+    input values and the keys of its upstream nodes'''
+    for n in nodes:
+        h = hashlib.sha1()
+        h.update(hashes.get(n.script))
+        for f in sorted(n.files):
+            h.update(os.path.relpath(f, rootpath)+'\0'+hashes.get(f))
+        h.update('\0'.join(n.args))
+        h.update(repr(n.values))
+        for d in n.deps:
+            h.update(d.key)
+        n.key = h.hexdigest()
+
+def readStamp(stampdir, node):
+    stampfile = stampdir+node.name+'.stamp'
+    if not os.path.exists(stampfile): return None
+    return open(stampfile, 'r').read().strip()
+
+def writeStamp(stampdir, node):
+    stampfile = stampdir+node.name+'.stamp'
+    outfile = open(stampfile+'.tmp', 'w')
+    outfile.write(node.key+'\n')
+    outfile.close()
+    os.rename(stampfile+'.tmp', stampfile)
+
+def isStale(stampdir, node):
+    '''A node is stale if its key differs from the stamp of its
+    last successful run or if one of its outputs is missing'''
+    if readStamp(stampdir, node) != node.key: return True
+    return not all([os.path.exists(f) for f in node.outputs])
+
+def runNodes(nodes, stale, num_jobs, stampdir, logdir):
+    '''Runs the stale nodes, up to num_jobs at the same time; a node
+    is started when all its upstream nodes are finished; returns
+    the names of the failed nodes'''
+    done = set([n.name for n in nodes if n not in stale])
+    failed = set()
+    pending = list(stale)
+    running = {}
+    while pending or running:
+        # start ready nodes
+        for n in list(pending):
+            if any([d.name in failed for d in n.deps]):
+                print "skipped (upstream node failed):", n.name
+                failed.add(n.name)
+                pending.remove(n)
+            elif len(running) < num_jobs and all([d.name in done for d in n.deps]):
+                stampfile = stampdir+n.name+'.stamp'
+                if os.path.exists(stampfile): os.remove(stampfile)
+                log = open(logdir+n.name+'.log', 'w')
+                running[n] = (subprocess.Popen(n.command(), cwd=os.path.dirname(n.script), stdout=log, stderr=subprocess.STDOUT), log)
+                pending.remove(n)
+                print "started:", n.name
+        # check running nodes
+        time.sleep(0.2)
+        for n in running.keys():
+            proc, log = running[n]
+            if proc.poll() is None: continue
+            log.close()
+            del running[n]
+            if proc.returncode == 0 and all([os.path.exists(f) for f in n.outputs]):
+                writeStamp(stampdir, n)
+                done.add(n.name)
+                print "finished:", n.name
+            else:
+                failed.add(n.name)
+                print "failed:", n.name, "(see "+logdir+n.name+".log)"
+    return failed
+
+def writeParamFile(filepath, lines):
+    '''Writes a parameter file, unchanged files are not touched'''
+    content = "".join([l+"\n" for l in lines])
+    if os.path.exists(filepath) and open(filepath, 'r').read() == content: return
+    outfile = open(filepath, 'w')
+    outfile.write(content)
+    outfile.close()
+
+def getFPSignatures(fp_names):
+    '''Returns the signatures of the fingerprint definitions, a scoring
+    node only depends on the definition of its fingerprint and not
+    on the whole fingerprint library (imported here as it needs RDKit)'''
+    sys.path.insert(0, rootpath+'scoring')
+    import fingerprint_lib
+    return dict([(fp, fingerprint_lib.GetFPSignature(fp)) for fp in fp_names])
+
+def readMethodNames(filepath):
+    '''Reads the names of the validation methods (first column)'''
+    methods = []
+    for line in open(filepath, 'r'):
+        line = line.rstrip().split()
+        if line and line[0][0] != '#': methods.append(line[0])
+    return methods
+
+def buildGraph(subset, conf, fp_names, fp_signatures, models, options, outpath):
+    '''Builds the nodes of the pipeline in topological order'''
+    rel = os.path.relpath
+    scoringdir = rootpath+'scoring/data_sets_'+subset+'/'
+    validationdir = rootpath+'validation/data_sets_'+subset+'/'
+    analysisdir = rootpath+'analysis/data_sets_'+subset+'/'
+    conf_file = rootpath+'configuration_file_'+subset+'.py'
+    methods_file = path+options.methods_file
+    simil = options.simil or 'Dice'
+    # modules imported by the scripts of the steps
+    tracing_file = rootpath+'tracing.py'
+    scoring_file = rootpath+'scoring/scoring_functions.py'
+    validation_file = rootpath+'validation/validation_functions.py'
+    # compound registry and molecule store (build_mol_store.py)
+    registry_files = [rootpath+'compounds/registry.pkl.gz', rootpath+'compounds/mol_store.bin']
+
+    # targets: [data set, target, selection name, name of the list file]
+    targets = []
+    if subset == 'I':
+        for dataset in conf.set_data.keys():
+            for target in conf.set_data[dataset]['ids']:
+                targets.append([dataset, target, dataset+':'+str(target), dataset+'_'+str(target)])
+    else:
+        for target in conf.set_data:
+            targets.append(['ChEMBL', target, str(target), str(target)])
+    if options.targets:
+        targets = [t for t in targets if t[2] in options.targets or str(t[1]) in options.targets]
+
+    nodes = []
+    validate_nodes = []
+    for dataset, target, selection, listname in targets:
+        # input data of the target
+        data_files = [rootpath+'compounds/'+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_actives.dat.gz']
+        if dataset == 'ChEMBL':
+            data_files.append(rootpath+'compounds/ChEMBL/cmp_list_ChEMBL_zinc_decoys.dat.gz')
+        else:
+            data_files.append(rootpath+'compounds/'+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_decoys.dat.gz')
+        if subset == 'I':
+            data_files.append(rootpath+'query_lists/data_sets_I/'+dataset+'/training_'+dataset+'_'+str(target)+'_'+str(options.num)+'.pkl')
+        else:
+            data_files.append(rootpath+'query_lists/data_sets_II/ChEMBL/training_'+str(target)+'.pkl')
+            data_files.append(rootpath+'query_lists/data_sets_II/ChEMBL/test_'+str(target)+'.pkl')
+            # training actives per paper
+            data_files.append(rootpath+'compounds/ChEMBL_II/Target_no_'+str(target)+'.pkl')
+
+        # scoring: one node per model and fingerprint
+        score_nodes = []
+        score_dirs = []
+        for model in models:
+            for fp in fp_names:
+                outdir = outpath+'scoring/'+model+'_'+fp
+                files = data_files + registry_files + [conf_file, tracing_file, scoring_file, validation_file]
+                args = ['-o', rel(outdir, scoringdir), '-s', simil, '-t', selection]
+                if subset == 'I': args += ['-n', options.num]
+                if model == 'sim':
+                    fp_file = outpath+'params/fp_'+fp+'.txt'
+                    args += ['-f', rel(fp_file, scoringdir)]
+                    files.append(fp_file)
+                else:
+                    args += ['-f', fp]
+                    files.append(rootpath+'scoring/ml_functions_13.py')
+                    if options.ml_file:
+                        args += ['-m', rel(path+options.ml_file, scoringdir)]
+                        files.append(path+options.ml_file)
+                score_nodes.append(Node('score_'+model+'_'+fp+'_'+listname, scoringdir+model_scripts[model], args,
+                                        [outdir+'/list_'+listname+'.pkl.gz'], files, values=[fp_signatures[fp]]))
+                score_dirs.append(outdir)
+        nodes += score_nodes
+
+        # fusion of all models and fingerprints
+        fusion_nodes = []
+        if options.fusion:
+            outdir = outpath+'fusion'
+            args = []
+            for d in score_dirs: args += ['-i', rel(d, scoringdir)]
+            for rule in options.fusion: args += ['-m', rule]
+            args += ['-o', rel(outdir, scoringdir), '-t', selection]
+            fusion_nodes.append(Node('fusion_'+listname, scoringdir+'apply_fusion.py', args, [outdir+'/list_'+listname+'.pkl.gz'],
+                                     [conf_file, tracing_file, scoring_file], score_nodes))
+            score_dirs.append(outdir)
+            nodes += fusion_nodes
+
+        # validation of all scored lists of the target
+        outdir = outpath+'validation'
+        args = ['-m', rel(methods_file, validationdir), '-o', rel(outdir, validationdir), '-t', selection]
+        for d in score_dirs: args += ['-i', rel(d, validationdir)]
+        node = Node('validate_'+listname, validationdir+'calculate_validation_methods.py', args,
+                    [outdir+'/'+dataset+'/validation_'+str(target)+'.pkl.gz'],
+                    [conf_file, methods_file, tracing_file, validation_file], score_nodes+fusion_nodes)
+        validate_nodes.append(node)
+        nodes.append(node)
+
+    # analysis of all targets
+    if not options.targets:
+        outdir = outpath+'analysis'
+        analysis_files = [conf_file, rootpath+'analysis/analysis_functions.py']
+        args = ['-i', rel(outpath+'validation', analysisdir), '-o', rel(outdir, analysisdir)]
+        analysis_node = Node('analysis', analysisdir+'run_analysis.py', args, [outdir+'/results.npz'],
+                             analysis_files, validate_nodes)
+        nodes.append(analysis_node)
+        # statistical analysis and summaries of the results store
+        args = ['-m', rel(methods_file, analysisdir), '-i', rel(outdir, analysisdir)]
+        outputs = [outdir+'/stat_analysis/'+f for f in ['friedman_test.dat', 'correlation_tables.dat', 'correlation_tables_latex.dat']]
+        outputs += [outdir+'/stat_analysis/friedman_fp_ranking_'+m+'.csv' for m in readMethodNames(methods_file)]
+        nodes.append(Node('stat_analysis', analysisdir+'run_stat_analysis.py', args, outputs,
+                          analysis_files+[methods_file], [analysis_node]))
+        args = ['-i', rel(outdir, analysisdir)]
+        nodes.append(Node('fp_summary', analysisdir+'run_fp_summary.py', args, [outdir+'/fp_summary'],
+                          analysis_files, [analysis_node]))
+        nodes.append(Node('method_summary', analysisdir+'run_method_summary.py', args, [outdir+'/method_summary'],
+                          analysis_files, [analysis_node]))
+    return nodes
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+    # required arguments
+    if not options.fp_file or not options.methods_file:
+        raise RuntimeError('one or more of the required options was not given!')
+    subset = 'I'
+    if options.subset: subset = options.subset
+    if subset not in ['I', 'II']:
+        raise ValueError('subset not supported:', subset)
+    if subset == 'I' and not options.num:
+        raise RuntimeError('number of query mols (-n) required for subset I')
+
+    # optional arguments
+    models = ['sim']
+    if options.models: models = options.models
+    for model in models:
+        if model not in model_scripts:
+            raise ValueError('scoring model not supported:', model)
+    outpath = path+'pipeline/'
+    if options.outpath: outpath = path+options.outpath+'/'
+    num_jobs = 1
+    if options.num_jobs: num_jobs = options.num_jobs
+
+    # configuration file of the subset
+    sys.path.insert(0, rootpath)
+    conf = __import__('configuration_file_'+subset)
+
+    # read fingerprint names
+    fp_names = []
+    for line in open(path+options.fp_file, 'r'):
+        line = line.rstrip().split()
+        if line: fp_names.append(line[0])
+    if not fp_names: raise ValueError('No fingerprints given in', options.fp_file)
+
+    # output directories
+    stampdir = outpath+'stamps/'
+    logdir = outpath+'logs/'
+    for d in [stampdir, logdir, outpath+'params', outpath+'fusion', outpath+'validation', outpath+'analysis/stat_analysis']:
+        if not os.path.exists(d): os.makedirs(d)
+    for model in models:
+        for fp in fp_names:
+            if not os.path.exists(outpath+'scoring/'+model+'_'+fp): os.makedirs(outpath+'scoring/'+model+'_'+fp)
+            if model == 'sim': writeParamFile(outpath+'params/fp_'+fp+'.txt', [fp])
+
+    # dependency graph and stale nodes
+    fp_signatures = getFPSignatures(fp_names)
+    nodes = buildGraph(subset, conf, fp_names, fp_signatures, models, options, outpath)
+    hashes = FileHashes(stampdir+'file_hashes.json')
+    setKeys(nodes, hashes)
+    hashes.write()
+    # nodes downstream of a stale node are stale as well
+    stale = []
+    for n in nodes:
+        if isStale(stampdir, n) or any([d in stale for d in n.deps]): stale.append(n)
+    print len(nodes), "nodes,", len(nodes)-len(stale), "up to date,", len(stale), "to run"
+
+    if options.dry_run:
+        for n in stale:
+            print n.name
+    else:
+        failed = runNodes(nodes, stale, num_jobs, stampdir, logdir)
+        if failed:
+            print len(failed), "nodes failed or skipped"
+            sys.exit(1)
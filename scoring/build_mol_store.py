@@ -0,0 +1,175 @@
+#
+# $Id$
+#
+# builds the compound registry and the binary molecule store:
+# each SMILES of the compound lists of all data sets (and of the
+# training actives of subset II) is parsed and sanitized once, the
+# molecules get a global ID per canonical SMILES, so that a molecule
+# occurring in several lists (e.g. the ZINC decoys or the ChEMBL
+# actives of both subsets) is stored once; the scoring scripts restore
+# the molecules from the store (fingerprint_lib.GetMol) and calculate
+# each fingerprint once per molecule (fingerprint_lib.FPStore)
+#
+# the IDs of a previous registry are kept, so that the fingerprint
+# stores (compounds/fp_store) remain valid; the scoring scripts do not
+# use the fingerprint stores if BENCHMARK_NO_FP_STORE is set
+#
+# INPUT
+# optional:
+# -f : rebuild the registry even if it is up to date
+# --help : prints usage
+#
+# OUTPUT: in compounds/ the registry (registry.pkl.gz) with the
+#         global ID of each SMILES ('ids'), the canonical SMILES of
+#         each ID ('smiles'), the IDs of the rows of each compound
+#         list ('rows') and the position of each molecule in the
+#         molecule store ('offsets'), and the RDKit binaries of the
+#         molecules (mol_store.bin); SMILES which cannot be parsed
+#         are not registered
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from rdkit import Chem
+import os, os.path, sys, glob, gzip, cPickle
+from optparse import OptionParser
+
+# paths
+cwd = os.getcwd()
+path = cwd+'/'
+scoringpath = os.path.dirname(os.path.abspath(__file__))+'/'
+rootpath = scoringpath+'../'
+inpath_cmp = rootpath+'compounds/'
+
+# import the fingerprint library (names of the registry files)
+sys.path.insert(0, rootpath)
+sys.path.insert(0, scoringpath)
+import fingerprint_lib
+
+# prepare command-line option parser
+usage = "usage: %prog [options]"
+parser = OptionParser(usage)
+parser.add_option("-f", "--force", dest="force", action="store_true", help="rebuild the registry even if it is up to date (default: False)")
+
+def getInputFiles(inpath):
+    '''Returns the compound lists of all data sets and the training
+    actives of subset II'''
+    return sorted(glob.glob(inpath+'*/cmp_list_*.dat.gz')), sorted(glob.glob(inpath+'ChEMBL_II/Target_no_*.pkl'))
+
+def isUpToDate(inpath, filepaths):
+    '''Checks if the registry is newer than the input files'''
+    regname = inpath+fingerprint_lib.registry_name
+    if not os.path.exists(regname): return False
+    return os.path.getmtime(regname) >= max([os.path.getmtime(f) for f in filepaths])
+
+def readSmiles(filepath):
+    '''Returns the SMILES of the rows of a compound list or of the
+    training actives of subset II (ordered by paper)'''
+    if filepath.endswith('.pkl'):
+        actives = cPickle.load(open(filepath, 'r'))
+        return [m[1] for k in sorted(actives.keys()) for m in actives[k]]
+    smiles = []
+    for line in gzip.open(filepath, 'r'):
+        if line[0] != '#':
+            # structure of line: [external ID, internal ID, SMILES]
+            smiles.append(line.rstrip().split()[2])
+    return smiles
+
+def readRegistry(inpath):
+    '''Returns the canonical SMILES of the IDs of a previous registry'''
+    regname = inpath+fingerprint_lib.registry_name
+    if not os.path.exists(regname): return []
+    return cPickle.load(gzip.open(regname, 'rb'))['smiles']
+
+def buildRegistry(inpath, filepaths):
+    '''Parses each SMILES once and writes the molecule store and the
+    registry; returns the registry and the number of SMILES which
+    cannot be parsed'''
+    canonical = readRegistry(inpath)
+    canonical_ids = dict([(c,i) for i,c in enumerate(canonical)])
+    ids = {}
+    offsets = [None]*len(canonical)
+    rows = {}
+    failed = set()
+    offset = 0
+    storename = inpath+fingerprint_lib.store_name
+    outfile = open(storename+'.tmp', 'wb')
+    for f in filepaths:
+        row_ids = []
+        for smiles in readSmiles(f):
+            if smiles not in ids and smiles not in failed:
+                m = Chem.MolFromSmiles(smiles)
+                if m is None: # left to the scoring scripts, which report it
+                    failed.add(smiles)
+                else:
+                    c = Chem.MolToSmiles(m, isomericSmiles=True)
+                    molid = canonical_ids.get(c)
+                    if molid is None:
+                        molid = canonical_ids[c] = len(canonical)
+                        canonical.append(c)
+                        offsets.append(None)
+                    ids[smiles] = molid
+                    if offsets[molid] is None:
+                        binary = m.ToBinary()
+                        outfile.write(binary)
+                        offsets[molid] = (offset, len(binary))
+                        offset += len(binary)
+            row_ids.append(ids.get(smiles))
+        rows[os.path.relpath(f, inpath)] = row_ids
+    outfile.close()
+    registry = dict(ids=ids, smiles=canonical, rows=rows, offsets=offsets)
+    regname = inpath+fingerprint_lib.registry_name
+    outfile = gzip.open(regname+'.tmp', 'wb')
+    cPickle.dump(registry, outfile, 2)
+    outfile.close()
+    # the registry is replaced last, the store is only used with it
+    if os.path.exists(regname): os.remove(regname)
+    os.rename(storename+'.tmp', storename)
+    os.rename(regname+'.tmp', regname)
+    return registry, len(failed)
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+
+    cmp_lists, training_lists = getInputFiles(inpath_cmp)
+    filepaths = cmp_lists + training_lists
+    if not filepaths:
+        raise IOError('no compound lists found in', inpath_cmp)
+    if not options.force and isUpToDate(inpath_cmp, filepaths):
+        print "registry is up to date"
+        sys.exit(0)
+    registry, failed = buildRegistry(inpath_cmp, filepaths)
+    num_rows = sum([len(r) for r in registry['rows'].values()])
+    num_mols = len([o for o in registry['offsets'] if o is not None])
+    print num_rows, "rows,", len(registry['ids']), "distinct SMILES,", num_mols, "molecules stored,", failed, "SMILES cannot be parsed"
@@ -16,11 +16,35 @@
 #          default parameters: criterion=gini, max_depth=10,
 #          max_features=auto (=sqrt), num_estimators=100,
 #          min_samples_split=2, min_samples_leaf=1, n_jobs=1
+# -v [] : file containing the validation methods; streaming mode:
+#         the scored lists are validated directly and only the
+#         validation results are written (default: off)
+# -k [] : number of repetitions for which the scored lists are
+#         kept in streaming mode (default: 0)
+# -e : early-recognition mode (requires -v with EF, BEDROC and
+#      RIE only): only the top of the scored lists is ranked
+# -t [] : only this target ([data set]:[target]), can be
+#         given multiple times (default: all targets)
+# --resume : resume an interrupted run, finished targets (with
+#      --checkpoint also repetitions) are skipped (default: off)
+# --checkpoint : record the scored lists of the finished
+#      repetitions, flushed to disk once per repetition, so
+#      that --resume skips them (default: off)
+# -p [] : pipelined mode: comma-separated numbers of load
+#         threads, fingerprint processes and write threads
+#         (e.g. 1,4,1); the stages of consecutive targets run
+#         concurrently, the score stage on one thread; the
+#         fingerprint stage calculates the fingerprints of the
+#         compounds the repetitions use (default: off)
 # --help : prints usage
 #
 # OUTPUT: for each target in each data set
 #         a file with a list (1 element) of RF prediction
 #         per RF prediction: [name, list of 50 scored lists]
+#         in streaming mode: the validation results per target
+#         (as for calculate_validation_methods.py) and the kept
+#         sample of scored lists (sample_list_[...].pkl.gz)
+#         (ranks of the validation results within this run)
 #
 #  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
 #  All rights reserved.
@@ -57,6 +81,7 @@ import cPickle, gzip, sys, os, os.path, numpy
 from collections import defaultdict
 from optparse import OptionParser 
 from sklearn.ensemble import RandomForestClassifier, forest
+from sklearn.base import clone
 from sklearn.tree import tree
 from rdkit.ML.Data import DataUtils
 from multiprocessing import Pool
@@ -65,10 +90,17 @@ from multiprocessing import Pool
 sys.path.insert(0, os.getcwd()+'/../../')
 import configuration_file_I as conf
 
+# instrumentation of the stages
+import tracing
+
 # import functions for scoring step
 sys.path.insert(0, os.getcwd()+'/../')
 import scoring_functions as scor
 
+# import validation functions for the streaming mode
+sys.path.insert(0, os.getcwd()+'/../../validation/')
+import validation_functions as vfunc
+
 # import ML functions
 import ml_functions_13 as ml_func
 
@@ -79,9 +111,6 @@ inpath_cmp = parentpath+'compounds/'
 inpath_list = parentpath+'query_lists/data_sets_I/'
 path = cwd+'/'
 
-# flag to read in ChEMBL decoys only once
-firstchembl = True
-
 # dictionary for readMLFile()
 read_dict = {}
 read_dict['criterion'] = lambda x: x
@@ -103,6 +132,13 @@ parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relat
 parser.add_option("-s", "--similarity", dest="simil", type="string", metavar="NAME", help="NAME of similarity metric to use (default: Dice, other options are: Tanimoto, Cosine, Russel, Kulczynski, McConnaughey, Manhattan, RogotGoldberg")
 parser.add_option("-m", "--ml", dest="ml", metavar="FILE", help="file containing the random forest info (default parameters: criterion=gini, max_depth=10, max_features=auto (=sqrt), num_estimators=100, min_samples_split=2, min_samples_leaf=1, n_jobs=1)")
 parser.add_option("-a", "--append", dest="do_append", action="store_true", help="append to the output file (default: False)")
+parser.add_option("-v", "--validation", dest="val_file", metavar="FILE", help="FILE containing the validation methods, switches on the streaming mode (default: off)")
+parser.add_option("-k", "--keep", dest="num_keep", type="int", metavar="INT", help="number of repetitions for which the scored lists are kept in streaming mode (default: 0)")
+parser.add_option("-e", "--early", dest="early", action="store_true", help="early-recognition mode: only the top of the scored lists is ranked, requires -v with EF, BEDROC and RIE only (default: False)")
+parser.add_option("-t", "--target", action="append", dest="targets", metavar="NAME", help="only this target ([data set]:[target]), can be given multiple times (default: all targets)")
+parser.add_option("--resume", dest="resume", action="store_true", help="resume an interrupted run: finished targets (with --checkpoint also repetitions) are skipped (default: False)")
+parser.add_option("--checkpoint", dest="checkpoint", action="store_true", help="record the scored lists of the finished repetitions, so that --resume skips them (default: False)")
+parser.add_option("-p", "--pipeline", dest="workers", metavar="LIST", help="pipelined mode: comma-separated numbers of load threads, fingerprint processes and write threads, e.g. 1,4,1 (default: off)")
 
 ############# MAIN PART ########################
 if __name__=='__main__':
@@ -131,6 +167,17 @@ if __name__=='__main__':
     if outpath_set: scor.checkPath(outpath, 'output')
     scor.checkSimil(simil_metric)
     scor.checkQueryMols(num_query_mols, conf.list_num_query_mols)
+    num_keep = 0
+    if options.num_keep: num_keep = options.num_keep
+    # streaming mode: validation of the ranked lists of each repetition
+    method_dict = None
+    if options.val_file:
+        method_dict = vfunc.readMethods(path+options.val_file)
+    early = False
+    if options.early:
+        if not method_dict: raise RuntimeError('early-recognition mode requires the streaming mode (-v)')
+        vfunc.checkEarly(method_dict)
+        early = True
 
     # default machine-learning method variables
     ml_dict = dict(criterion='gini', max_features='auto', n_jobs=1, max_depth=10, min_samples_split=2, min_samples_leaf=1, num_estimators=100)
@@ -140,104 +187,166 @@ if __name__=='__main__':
     # initialize machine-learning method
     ml = RandomForestClassifier(criterion=ml_dict['criterion'], max_features=ml_dict['max_features'], min_samples_split=ml_dict['min_samples_split'], max_depth=ml_dict['max_depth'], min_samples_leaf=ml_dict['min_samples_leaf'], n_estimators=ml_dict['num_estimators'], n_jobs=ml_dict['n_jobs'])
 
-    # loop over data-set sources
-    for dataset in conf.set_data.keys():
-        print dataset
-        # loop over targets
-        for target in conf.set_data[dataset]['ids']:
-            print target
-
-            # read in actives and calculate fps
-            actives = []
-            for line in gzip.open(inpath_cmp+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_actives.dat.gz', 'r'):
-                if line[0] != '#': 
-                    # structure of line: [external ID, internal ID, SMILES]]
-                    line = line.rstrip().split()
-                    fp_dict = scor.getFP(fp_build, line[2])
-                    # store: [internal ID, dict with fps]
-                    actives.append([line[1], fp_dict])
-            num_actives = len(actives)
-            num_test_actives = num_actives - num_query_mols
-            # convert fps to numpy arrays
-            np_fps_act = ml_func.getNumpy(actives)
-
-            # read in decoys and calculate fps
-            if dataset == 'ChEMBL':
-                if firstchembl:
-                    decoys = []
-                    for line in gzip.open(inpath_cmp+dataset+'/cmp_list_'+dataset+'_zinc_decoys.dat.gz', 'r'):
-                        if line[0] != '#': 
-                            # structure of line: [external ID, internal ID, SMILES]]
-                            line = line.rstrip().split()
-                            fp_dict = scor.getFP(fp_build, line[2])
-                            # store: [internal ID, dict with fps]
-                            decoys.append([line[1], fp_dict])
-                    # convert fps to numpy arrays
-                    np_fps_dcy = ml_func.getNumpy(decoys)
-                    firstchembl = False
-            else:
-                decoys = []
-                for line in gzip.open(inpath_cmp+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_decoys.dat.gz', 'r'):
-                    if line[0] != '#': 
-                        # structure of line: [external ID, internal ID, SMILES]]
-                        line = line.rstrip().split()
-                        fp_dict = scor.getFP(fp_build, line[2])
-                        # store: [internal ID, dict with fps]
-                        decoys.append([line[1], fp_dict])
-                # convert fps to numpy arrays
-                np_fps_dcy = ml_func.getNumpy(decoys)
-            num_decoys = len(decoys)
-            print "molecules read in and fingerprints calculated"
-
-            # open training lists
-            training_input = open(inpath_list+dataset+'/training_'+dataset+'_'+str(target)+'_'+str(num_query_mols)+'.pkl', 'r')
-            # to store the scored lists
-            scores = defaultdict(list)
-
-            # loop over repetitions
-            for q in range(conf.num_reps):
-                print q
-                training_list = cPickle.load(training_input)
-                test_list = [i for i in range(num_actives) if i not in training_list[:num_query_mols]]
-                test_list += [i for i in range(num_decoys) if i not in training_list[num_query_mols:]]
-
-                # list with active/inactive info
-                ys_fit = [1]*num_query_mols + [0]*(len(training_list)-num_query_mols)
-                # training fps
-                train_fps = [actives[i][1] for i in training_list[:num_query_mols]]
-                np_train_fps = [np_fps_act[i] for i in training_list[:num_query_mols]]
-                np_train_fps += [np_fps_dcy[i] for i in training_list[num_query_mols:]]
-                # fit random forest
-                ml.fit(np_train_fps, ys_fit)
-
-                # test fps and molecule info
-                test_fps = [actives[i][1] for i in test_list[:num_test_actives]]
-                test_fps += [decoys[i][1] for i in test_list[num_test_actives:]]
-                np_test_fps = [np_fps_act[i] for i in test_list[:num_test_actives]]
-                np_test_fps += [np_fps_dcy[i] for i in test_list[num_test_actives:]]
-                test_mols = [[actives[i][0], 1] for i in test_list[:num_test_actives]]
-                test_mols += [[decoys[i][0], 0] for i in test_list[num_test_actives:]]
-
-                # calculate similarity with standard fp
-                std_simil = []
+    # pipelined mode: numbers of workers of the stages and of the
+    # fingerprint processes (started before any other thread)
+    workers = None
+    num_fp_jobs = 1
+    if options.workers: workers, num_fp_jobs = scor.checkWorkers(options.workers)
+    fp_calc = scor.FPCalculator(num_fp_jobs)
+
+    # compound lists of the selected targets, read ahead on background threads
+    targets = [(d, t) for d in conf.set_data.keys() for t in conf.set_data[d]['ids'] if scor.checkTarget(options.targets, d, t)]
+    compounds = scor.CompoundPrefetcher(scor.getCompoundFiles(inpath_cmp, targets))
+
+    def readMols(reader):
+        '''Reads a compound list, the fingerprint of a compound and
+        its numpy array are calculated on the first access'''
+        # store: [internal ID, fp]
+        mols = scor.LazyFPList(scor.readCompounds(reader), fp_build)
+        # numpy arrays of the fps
+        return mols, scor.LazyList(mols, lambda m: ml_func.getNumpy([m])[0])
+
+    def loadTarget(item):
+        '''Checks the journal of a target and opens its compound lists'''
+        dataset, target = item['dataset'], item['target']
+        print dataset, target
+        # checkpoint journal of the target
+        item['checkpoint'] = scor.Checkpoint(outpath, dataset+'_'+str(target), options.resume, [fp_build, num_query_mols, simil_metric, sorted(ml_dict.items()),
+                                                                                                method_dict and sorted(method_dict.items()), num_keep, early], options.checkpoint)
+        if item['checkpoint'].done:
+            print "already done"
+            return None
+        item['actives'] = compounds.open(inpath_cmp+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_actives.dat.gz')
+        if dataset == 'ChEMBL': # the ChEMBL decoys are read only once
+            filepath = inpath_cmp+dataset+'/cmp_list_'+dataset+'_zinc_decoys.dat.gz'
+            item['decoys'] = pipeline.once(filepath, lambda: compounds.open(filepath))
+        else:
+            item['decoys'] = compounds.open(inpath_cmp+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_decoys.dat.gz')
+        return item
+
+    def fingerprintTarget(item):
+        '''Reads the actives and decoys and calculates the fingerprints
+        and their numpy arrays (the repetitions use all actives and
+        decoys for training or testing)'''
+        item['actives'] = readMols(item['actives'])
+        if item['dataset'] == 'ChEMBL':
+            item['decoys'] = pipeline.once('ChEMBL decoys', lambda: readMols(item['decoys']))
+        else:
+            item['decoys'] = readMols(item['decoys'])
+        for mols, np_fps in [item['actives'], item['decoys']]:
+            mols.calculate(range(len(mols)), fp_calc)
+            np_fps.fill(range(len(np_fps)))
+        print item['target'], "fingerprints calculated"
+        return item
+
+    def scoreTarget(item):
+        '''Scores the repetitions of a target'''
+        dataset, target, checkpoint = item['dataset'], item['target'], item['checkpoint']
+        actives, np_fps_act = item.pop('actives')
+        decoys, np_fps_dcy = item.pop('decoys')
+        num_actives = len(actives)
+        num_test_actives = num_actives - num_query_mols
+        num_decoys = len(decoys)
+        # streaming mode: validation of the ranked lists of each repetition
+        stream = None
+        if method_dict: stream = vfunc.StreamValidation(method_dict, num_keep)
+        # machine-learning method of the target (unfitted copy)
+        model = clone(ml)
+
+        # open training lists
+        training_input = open(inpath_list+dataset+'/training_'+dataset+'_'+str(target)+'_'+str(num_query_mols)+'.pkl', 'r')
+        # to store the scored lists
+        scores = defaultdict(list)
+
+        # loop over repetitions
+        for q in range(conf.num_reps):
+            print q
+            training_list = cPickle.load(training_input)
+            test_list = [i for i in range(num_actives) if i not in training_list[:num_query_mols]]
+            test_list += [i for i in range(num_decoys) if i not in training_list[num_query_mols:]]
+            # repetition validated in an interrupted run (streaming mode)
+            if checkpoint.isFinished(q, scor.results_unit):
+                stream.addResults(checkpoint.get(q, scor.results_unit))
+                continue
+            # repetition already finished in an interrupted run
+            if checkpoint.isFinished(q, 'rf_'+fp_build):
+                scores['rf_'+fp_build].append(checkpoint.get(q, 'rf_'+fp_build))
+                if stream: stream.addRepetition(scores, num_mol=len(test_list), num_act=num_test_actives)
+                continue
+
+            # list with active/inactive info
+            ys_fit = [1]*num_query_mols + [0]*(len(training_list)-num_query_mols)
+            # training fps
+            train_fps = [actives[i][1] for i in training_list[:num_query_mols]]
+            np_train_fps = [np_fps_act[i] for i in training_list[:num_query_mols]]
+            np_train_fps += [np_fps_dcy[i] for i in training_list[num_query_mols:]]
+            # fit random forest
+            with tracing.stage('fit', len(ys_fit), fp_build):
+                model.fit(np_train_fps, ys_fit)
+
+            # test fps and molecule info
+            test_fps = [actives[i][1] for i in test_list[:num_test_actives]]
+            test_fps += [decoys[i][1] for i in test_list[num_test_actives:]]
+            np_test_fps = [np_fps_act[i] for i in test_list[:num_test_actives]]
+            np_test_fps += [np_fps_dcy[i] for i in test_list[num_test_actives:]]
+            test_mols = [[actives[i][0], 1] for i in test_list[:num_test_actives]]
+            test_mols += [[decoys[i][0], 0] for i in test_list[num_test_actives:]]
+
+            # calculate similarity with standard fp
+            std_simil = []
+            with tracing.stage('similarity', len(test_fps), fp_build):
                 for fp in test_fps:
                     tmp_simil = scor.getBulkSimilarity(fp, train_fps, simil_metric)
                     tmp_simil.sort(reverse=True)
                     std_simil.append(tmp_simil[0])
 
-                # rank based on probability (and second based on similarity)
-                single_score = ml.predict_proba(np_test_fps)
-                # store: [probability, similarity, internal ID, active/inactive]
-                single_score = [[m[1], s, t[0], t[1]] for m,s,t in zip(single_score,std_simil,test_mols)]
-                single_score.sort(reverse=True)
-                scores['rf_'+fp_build].append(single_score)
-
-            # write scores to file
-            if do_append:
-                outfile = gzip.open(outpath+'/list_'+dataset+'_'+str(target)+'.pkl.gz', 'ab+') # binary format
-            else:
-                outfile = gzip.open(outpath+'/list_'+dataset+'_'+str(target)+'.pkl.gz', 'wb+') # binary format
-            for fp in ['rf_'+fp_build]:
-                cPickle.dump([fp, scores[fp]], outfile, 2)
-            outfile.close()
-            print "scoring done and scored lists written"
+            # rank based on probability (and second based on similarity)
+            with tracing.stage('predict', len(np_test_fps), fp_build):
+                single_score = model.predict_proba(np_test_fps)
+            # store: [probability, similarity, internal ID, active/inactive]
+            single_score = [[m[1], s, t[0], t[1]] for m,s,t in zip(single_score,std_simil,test_mols)]
+            with tracing.stage('rank', len(test_mols), fp_build):
+                if early: # only the top of the ranked list
+                    single_score = scor.getTopRanked(single_score, stream.numRanked(len(test_mols)))
+                else:
+                    single_score.sort(reverse=True)
+            scores['rf_'+fp_build].append(single_score)
+            if not stream or stream.keeps(): # streaming mode: only the kept sample
+                checkpoint.add(q, 'rf_'+fp_build, single_score)
+            if stream:
+                kept = stream.keeps()
+                stream.addRepetition(scores, num_mol=len(test_mols), num_act=num_test_actives)
+                # only the validation results of the repetition are recorded
+                if not kept: checkpoint.add(q, scor.results_unit, stream.lastResults())
+            checkpoint.sync()
+        item['scores'] = scores
+        item['stream'] = stream
+        return item
+
+    def writeTarget(item):
+        '''Writes the scored lists (streaming mode: the validation
+        results and the kept sample) of a target'''
+        dataset, target, scores, stream = item['dataset'], item['target'], item['scores'], item['stream']
+        # write scores to file
+        outname = outpath+'/list_'+dataset+'_'+str(target)+'.pkl.gz'
+        if stream: # validation results and the kept sample of scored lists
+            stream.writeTarget(outpath+'/'+dataset, target)
+            outname = outpath+'/sample_list_'+dataset+'_'+str(target)+'.pkl.gz'
+        if not stream or num_keep > 0:
+            with tracing.stage('write'):
+                if do_append:
+                    outfile = gzip.open(outname, 'ab+') # binary format
+                else:
+                    outfile = gzip.open(outname+'.tmp', 'wb+') # binary format
+                for fp in ['rf_'+fp_build]:
+                    cPickle.dump([fp, scores[fp]], outfile, 2)
+                outfile.close()
+            if not do_append: os.rename(outname+'.tmp', outname)
+        item['checkpoint'].finish()
+        print target, "scoring done and scored lists written"
+
+    # run the stages for each target (pipelined mode: concurrently)
+    pipeline = scor.Pipeline(zip(scor.stage_names, [loadTarget, fingerprintTarget, scoreTarget, writeTarget]), workers,
+                             context=lambda item: dict(dataset=item['dataset'], target=item['target']))
+    pipeline.run([dict(dataset=d, target=t) for d,t in targets])
+    fp_calc.close()
@@ -9,16 +9,23 @@
 # required:
 # -i [] : relative input path(s)
 # optional:
-# -m [] : fusion method (max or ave, default: max)
+# -m [] : fusion rule (default: max, other options: ave, sum,
+#         rrf, zscore, minmax, weighted); can be given multiple
+#         times to produce the fusions for several rules at once
+# -w [] : weight of an input path for the weighted fusion
+#         (one per input path, default: 1.0)
 # -r [] : file containing fingerprints to leave out
 # -o [] : relative output path (default: pwd)
 # -a : append to the output file (default: overwrite)
+# -t [] : only this target, can be given multiple times
+#         (default: all targets)
 # --help : prints usage
 #
 # OUTPUT: for each target in each data set
 #         a file with a list of fusion predictions
 #         per fusion prediction: [name, list of 50 scored lists]
 #         names: fusion_[fp name] (ml model)
+#         (fusion_[rule]_[fp name] if several rules are given)
 #
 #  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
 #  All rights reserved.
@@ -58,6 +65,9 @@ from optparse import OptionParser
 sys.path.insert(0, os.getcwd()+'/../../')
 import configuration_file_II as conf
 
+# instrumentation of the stages
+import tracing
+
 # import functions for scoring step
 sys.path.insert(0, os.getcwd()+'/../')
 import scoring_functions as scor
@@ -71,10 +81,12 @@ path = cwd+'/'
 usage = "usage: %prog [options] arg"
 parser = OptionParser(usage)
 parser.add_option("-i", "--inpath", action="append", dest="inpath", metavar="PATH", help="relative input PATHs")
-parser.add_option("-m", "--method", dest="method", help="method for data fusion (max or ave, default: max)")
+parser.add_option("-m", "--method", action="append", dest="method", help="rule for data fusion (default: max, other options are: ave, sum, rrf, zscore, minmax, weighted), can be given multiple times")
+parser.add_option("-w", "--weight", action="append", dest="weight", type="float", help="weight of the input PATHs for the weighted fusion (default: 1.0 for each)")
 parser.add_option("-r", "--remove", dest="rm_file", metavar="FILE", help="FILE containing the fingerprints to be left out (default: all fingerprints are read)")
 parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relative output PATH (default: pwd)")
 parser.add_option("-a", "--append", dest="do_append", action="store_true", help="append to the output file (default: False)")
+parser.add_option("-t", "--target", action="append", dest="targets", metavar="NAME", help="only this target (target id), can be given multiple times (default: all targets)")
 
 
 ######################## MAIN PART ###########################
@@ -91,12 +103,16 @@ if __name__=='__main__':
         raise RuntimeError('one or more of the required options was not given!')
 
     # optional arguments
-    method = 'max'
+    methods = ['max']
     if options.method:
-        if options.method not in ['max', 'ave']:
-            raise ValueError('method is unkown. supported methods are: max and ave')
-        else:
-            method = options.method
+        for m in options.method:
+            scor.checkFusion(m)
+        methods = options.method
+    weights = [1.0]*len(inpath)
+    if options.weight:
+        if len(options.weight) != len(inpath):
+            raise ValueError('number of weights does not match the number of input paths')
+        weights = options.weight
     remove_fps = []
     if options.rm_file:
         remove_fps = scor.readFPs(path+options.rm_file)
@@ -112,66 +128,63 @@ if __name__=='__main__':
 
     # loop over targets
     for target in conf.set_data:
+        if not scor.checkTarget(options.targets, 'ChEMBL', target): continue
         print target
+        tracing.setContext(dataset='ChEMBL', target=target)
 
         # load scored lists
         scores = {}
-        for inp in inpath: # loop over input paths
-            myfile = gzip.open(inp+'/list_'+str(target)+'.pkl.gz', 'r')
-            while 1:
-                try:
-                    tmp = cPickle.load(myfile)
-                except (EOFError):
-                    break
-                else:
-                    # check that fp is not in remove_fps list
-                    if tmp[0] not in remove_fps:
-                        tmp[0] = scor.getName(tmp[0], scores.keys())
-                        # input line: [fp_name, list of scored lists]
-                        scores[tmp[0]] = tmp[1]
+        fp_weights = {}
+        with tracing.stage('read_lists', len(inpath)):
+            for inp,w in zip(inpath, weights): # loop over input paths
+                myfile = gzip.open(inp+'/list_'+str(target)+'.pkl.gz', 'r')
+                while 1:
+                    try:
+                        tmp = cPickle.load(myfile)
+                    except (EOFError):
+                        break
+                    else:
+                        # check that fp is not in remove_fps list
+                        if tmp[0] not in remove_fps:
+                            tmp[0] = scor.getName(tmp[0], scores.keys())
+                            # input line: [fp_name, list of scored lists]
+                            scores[tmp[0]] = tmp[1]
+                            fp_weights[tmp[0]] = w
         print "scored lists read in"
         if len(scores.keys()) < 2:
             print "number of fingerprints/models < 2, nothing to be done"
             break
+        fpkeys = scores.keys()
         if printfp:
-            # determine the name of the fusion
-            fpname = 'fusion'
-            for k in scores.keys():
-                fpname += '_'+k
-            scor.printFPs(scores.keys(), fpname)
+            # determine the names of the fusions
+            fpname = {}
+            for method in methods:
+                fpname[method] = 'fusion'
+                if len(methods) > 1: fpname[method] += '_'+method
+                for k in fpkeys:
+                    fpname[method] += '_'+k
+                scor.printFPs(fpkeys, fpname[method])
             printfp = False
 
         # FUSION
         # loop over papers
-        new_scores = []
-        for q in range(len(scores[scores.keys()[0]])):
-            # get ranks
-            ranks = []
-            for k in scores.keys():
-                ranks.append(scor.getRanks(scores[k][q]))
-
-            # do fusion
-            new_list = []
-            for i in range(len(ranks[0])):
-                current_ranks = [r[i][0] for r in ranks]
-                current_scores = [r[i][1] for r in ranks]
-                if method == 'max': # MAX fusion
-                    fused_rank = max(current_ranks)
-                    fused_score = max(current_scores)
-                else: # AVE fusion
-                    fused_rank = numpy.average(current_ranks)
-                    fused_score = numpy.average(current_scores)
+        new_scores = defaultdict(list)
+        fused_weights = [fp_weights[k] for k in fpkeys]
+        for q in range(len(scores[fpkeys[0]])):
+            # get ranks and scores aligned on the internal ID
+            ids, labels, rank_matrix, score_matrix = scor.getRankMatrix([scores[k][q] for k in fpkeys])
+            # do fusion for all rules
+            for method in methods:
                 # store: [fused rank, fused score, internal ID, active/inactive]
-                new_list.append([fused_rank, fused_score, ranks[0][i][-2], ranks[0][i][-1]])
-            # sort the new list based on fused ranks
-            new_list.sort(reverse=True)
-            new_scores.append(new_list)
+                new_scores[method].append(scor.fuseRanks(ids, labels, rank_matrix, score_matrix, method, fused_weights))
 
         # write out the new scores
-        if do_append:
-            outfile = gzip.open(outpath+'/list_'+str(target)+'.pkl.gz', 'ab+') # binary format
-        else:
-            outfile = gzip.open(outpath+'/list_'+str(target)+'.pkl.gz', 'wb+') # binary format
-        cPickle.dump([fpname, new_scores], outfile, 2)
-        outfile.close()
+        with tracing.stage('write'):
+            if do_append:
+                outfile = gzip.open(outpath+'/list_'+str(target)+'.pkl.gz', 'ab+') # binary format
+            else:
+                outfile = gzip.open(outpath+'/list_'+str(target)+'.pkl.gz', 'wb+') # binary format
+            for method in methods:
+                cPickle.dump([fpname[method], new_scores[method]], outfile, 2)
+            outfile.close()
     print "fusion ranking done and ranked list written"
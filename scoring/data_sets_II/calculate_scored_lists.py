@@ -11,11 +11,34 @@
 # -s [] : similarity metric (default: Dice, 
 #         other options: Tanimoto, Cosine, Russel, Kulczynski, 
 #         McConnaughey, Manhattan, RogotGoldberg)
+# -v [] : file containing the validation methods; streaming mode:
+#         the scored lists are validated directly and only the
+#         validation results are written (default: off)
+# -k [] : number of repetitions for which the scored lists are
+#         kept in streaming mode (default: 0)
+# -e : early-recognition mode (requires -v with EF, BEDROC and
+#      RIE only): only the top of the scored lists is ranked
+# -t [] : only this target, can be given multiple times
+#         (default: all targets)
+# --resume : resume an interrupted run, finished targets (with
+#      --checkpoint also repetitions) are skipped (default: off)
+# --checkpoint : record the scored lists of the finished
+#      repetitions, flushed to disk once per repetition, so
+#      that --resume skips them (default: off)
+# -p [] : pipelined mode: comma-separated numbers of load
+#         threads, fingerprint processes and write threads
+#         (e.g. 1,4,1); the stages of consecutive targets run
+#         concurrently, the score stage on one thread; the
+#         fingerprint stage calculates the fingerprints of the
+#         compounds the repetitions use (default: off)
 # --help : prints usage
 #
 # OUTPUT: for each target in each data set
 #         a file with a list of fingerprints
 #         per fingerprint: [name, list of 50 scored lists]
+#         in streaming mode: the validation results per target
+#         (as for calculate_validation_methods.py) and the kept
+#         sample of scored lists (sample_list_[...].pkl.gz)
 #
 #  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
 #  All rights reserved.
@@ -56,10 +79,17 @@ from optparse import OptionParser
 sys.path.insert(0, os.getcwd()+'/../../')
 import configuration_file_II as conf
 
+# instrumentation of the stages
+import tracing
+
 # import functions for scoring step
 sys.path.insert(0, os.getcwd()+'/../')
 import scoring_functions as scor
 
+# import validation functions for the streaming mode
+sys.path.insert(0, os.getcwd()+'/../../validation/')
+import validation_functions as vfunc
+
 # paths
 cwd = os.getcwd()
 parentpath = cwd+'/../../'
@@ -67,9 +97,6 @@ inpath_cmp = parentpath+'compounds/'
 inpath_list = parentpath+'query_lists/data_sets_II/ChEMBL/'
 path = cwd+'/'
 
-# flag to read in ChEMBL decoys only once
-firstchembl = True
-
 # prepare command-line option parser
 usage = "usage: %prog [options] arg"
 parser = OptionParser(usage)
@@ -77,6 +104,13 @@ parser.add_option("-f", "--fingerprints", dest="fp_file", metavar="FILE", help="
 parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relative output PATH (default: pwd)")
 parser.add_option("-s", "--similarity", dest="simil", type="string", metavar="NAME", help="NAME of similarity metric to use (default: Dice, other options are: Tanimoto, Cosine, Russel, Kulczynski, McConnaughey, Manhattan, RogotGoldberg")
 parser.add_option("-a", "--append", dest="do_append", action="store_true", help="append to the output file (default: False)")
+parser.add_option("-v", "--validation", dest="val_file", metavar="FILE", help="FILE containing the validation methods, switches on the streaming mode (default: off)")
+parser.add_option("-k", "--keep", dest="num_keep", type="int", metavar="INT", help="number of repetitions for which the scored lists are kept in streaming mode (default: 0)")
+parser.add_option("-e", "--early", dest="early", action="store_true", help="early-recognition mode: only the top of the scored lists is ranked, requires -v with EF, BEDROC and RIE only (default: False)")
+parser.add_option("-t", "--target", action="append", dest="targets", metavar="NAME", help="only this target (target id), can be given multiple times (default: all targets)")
+parser.add_option("--resume", dest="resume", action="store_true", help="resume an interrupted run: finished targets (with --checkpoint also repetitions) are skipped (default: False)")
+parser.add_option("--checkpoint", dest="checkpoint", action="store_true", help="record the scored lists of the finished repetitions, so that --resume skips them (default: False)")
+parser.add_option("-p", "--pipeline", dest="workers", metavar="LIST", help="pipelined mode: comma-separated numbers of load threads, fingerprint processes and write threads, e.g. 1,4,1 (default: off)")
 
 ############# MAIN PART ########################
 if __name__=='__main__':
@@ -105,42 +139,93 @@ if __name__=='__main__':
     if not fp_names: raise ValueError('No fingerprints given in', fp_file)
     if outpath_set: scor.checkPath(outpath, 'output')
     scor.checkSimil(simil_metric)
+    num_keep = 0
+    if options.num_keep: num_keep = options.num_keep
+    # streaming mode: validation of the ranked lists of each repetition
+    method_dict = None
+    if options.val_file:
+        method_dict = vfunc.readMethods(path+options.val_file)
+    early = False
+    if options.early:
+        if not method_dict: raise RuntimeError('early-recognition mode requires the streaming mode (-v)')
+        vfunc.checkEarly(method_dict)
+        early = True
+
+    # pipelined mode: numbers of workers of the stages and of the
+    # fingerprint processes (started before any other thread)
+    workers = None
+    num_fp_jobs = 1
+    if options.workers: workers, num_fp_jobs = scor.checkWorkers(options.workers)
+    fp_calc = scor.FPCalculator(num_fp_jobs)
 
-    # loop over targets
-    for target in conf.set_data:
+    # compound lists of the selected targets, read ahead on background threads
+    targets = [('ChEMBL', t) for t in conf.set_data if scor.checkTarget(options.targets, 'ChEMBL', t)]
+    compounds = scor.CompoundPrefetcher(scor.getCompoundFiles(inpath_cmp, targets))
+
+    def readMols(reader):
+        '''Reads a compound list, the fingerprints of a compound
+        are calculated on the first access'''
+        # store: [internal ID, dict with fps]
+        return [[m[0], scor.LazyFPDict(m[1], fp_names)] for m in scor.readCompounds(reader)]
+
+    def loadTarget(item):
+        '''Checks the journal of a target, reads its training actives
+        and opens its compound lists'''
+        target = item['target']
         print target
+        # checkpoint journal of the target
+        item['checkpoint'] = scor.Checkpoint(outpath, str(target), options.resume, [fp_names, simil_metric, method_dict and sorted(method_dict.items()), num_keep, early], options.checkpoint)
+        if item['checkpoint'].done:
+            print "already done"
+            return None
+        # training actives per paper
+        item['actives'] = cPickle.load(open(inpath_cmp+'ChEMBL_II/Target_no_'+str(target)+'.pkl', 'r'))
+        # test actives
+        item['div_actives'] = compounds.open(inpath_cmp+'ChEMBL/cmp_list_ChEMBL_'+str(target)+'_actives.dat.gz')
+        # the decoys are read only once
+        filepath = inpath_cmp+'ChEMBL/cmp_list_ChEMBL_zinc_decoys.dat.gz'
+        item['decoys'] = pipeline.once(filepath, lambda: compounds.open(filepath))
+        return item
 
-        # read in training actives and calculate fps
-        actives = cPickle.load(open(inpath_cmp+'ChEMBL_II/Target_no_'+str(target)+'.pkl', 'r'))
+    def fingerprintTarget(item):
+        '''Reads the training actives, the test actives and the decoys
+        and calculates the fingerprints of the compounds the papers use'''
+        target = item['target']
+        actives = item['actives']
         for k in actives.keys():
             for i,m in enumerate(actives[k]):
-                fp_dict = scor.getFPDict(fp_names, m[1])
-                actives[k][i] = [str(target)+'_'+str(k)+'_A_'+str(i+1), fp_dict]
-
-        # read in test actives and calculate fps
-        div_actives = []
-        for line in gzip.open(inpath_cmp+'ChEMBL/cmp_list_ChEMBL_'+str(target)+'_actives.dat.gz', 'r'):
-            if line[0] != '#': 
-                # structure of line: [external ID, internal ID, SMILES]]
-                line = line.rstrip().split()
-                fp_dict = scor.getFPDict(fp_names, line[2])
-                # store: [internal ID, dict with fps]
-                div_actives.append([line[1], fp_dict])
-        num_test_actives = conf.num_div_act - 1
+                actives[k][i] = [str(target)+'_'+str(k)+'_A_'+str(i+1), scor.LazyFPDict(m[1], fp_names)]
+        div_actives = item['div_actives'] = readMols(item['div_actives'])
+        decoys = item['decoys'] = pipeline.once('ChEMBL decoys', lambda: readMols(item['decoys']))
+        # test actives of the papers; the decoys which are training
+        # decoys of all papers are not used
+        training_input = open(inpath_list+'/training_'+str(target)+'.pkl', 'r')
+        test_input = open(inpath_list+'/test_'+str(target)+'.pkl', 'r')
+        test_actives = set()
+        unused = set(range(len(decoys)))
+        for q in actives.keys():
+            unused.intersection_update(cPickle.load(training_input)[len(actives[q]):])
+            test_actives.update(cPickle.load(test_input)[:conf.num_div_act-1])
+        training_input.close()
+        test_input.close()
+        for k in actives.keys():
+            scor.calcFPDicts(actives[k], range(len(actives[k])), fp_names, fp_calc)
+        scor.calcFPDicts(div_actives, test_actives, fp_names, fp_calc)
+        scor.calcFPDicts(decoys, [i for i in range(len(decoys)) if i not in unused], fp_names, fp_calc)
+        print target, "fingerprints calculated"
+        return item
 
-        # read in decoys and calculate fps
-        if firstchembl:
-            decoys = []
-            for line in gzip.open(inpath_cmp+'ChEMBL/cmp_list_ChEMBL_zinc_decoys.dat.gz', 'r'):
-                if line[0] != '#': 
-                    # structure of line: [external ID, internal ID, SMILES]]
-                    line = line.rstrip().split()
-                    fp_dict = scor.getFPDict(fp_names, line[2])
-                    # store: [internal ID, dict with fps]
-                    decoys.append([line[1], fp_dict])
-            firstchembl = False
-            num_decoys = len(decoys)
-        print "molecules read in and fingerprints calculated"
+    def scoreTarget(item):
+        '''Scores the papers of a target'''
+        target, checkpoint = item['target'], item['checkpoint']
+        actives = item.pop('actives')
+        div_actives = item.pop('div_actives')
+        decoys = item.pop('decoys')
+        num_test_actives = conf.num_div_act - 1
+        num_decoys = len(decoys)
+        # streaming mode: validation of the ranked lists of each repetition
+        stream = None
+        if method_dict: stream = vfunc.StreamValidation(method_dict, num_keep)
 
         # open training and test lists
         training_input = open(inpath_list+'/training_'+str(target)+'.pkl', 'r')
@@ -154,27 +239,69 @@ if __name__=='__main__':
             training_list = cPickle.load(training_input)
             test_list = cPickle.load(test_input)
             test_list += [i for i in range(num_decoys) if i not in training_list[num_actives:]]
+            # repetition validated in an interrupted run (streaming mode)
+            if checkpoint.isFinished(q, scor.results_unit):
+                stream.addResults(checkpoint.get(q, scor.results_unit))
+                continue
             # loop over fps
             single_score = defaultdict(list)
             for fp in fp_names:
-                query_fps = [a[1][fp] for a in actives[k]]
+                # unit already finished in an interrupted run
+                if checkpoint.isFinished(q, fp):
+                    scores[fp].append(checkpoint.get(q, fp))
+                    continue
+                query_fps = [a[1][fp] for a in actives[q]]
                 # test_list: first actives then decoys
                 test_fps = [[div_actives[i][0], div_actives[i][1][fp], 1] for i in test_list[:num_test_actives]]
                 test_fps += [[decoys[i][0], decoys[i][1][fp], 0] for i in test_list[num_test_actives:]]
-                for tmp_mol in test_fps:
-                    tmp_score = scor.getBulkSimilarity(tmp_mol[1], query_fps, simil_metric)
-                    # use max fusion
-                    # store : [similarity, internal ID, active/inactive]
-                    single_score[fp].append([tmp_score[0], tmp_mol[0], tmp_mol[2]]) 
+                with tracing.stage('similarity', len(test_fps), fp):
+                    for tmp_mol in test_fps:
+                        tmp_score = scor.getBulkSimilarity(tmp_mol[1], query_fps, simil_metric)
+                        # use max fusion
+                        # store : [similarity, internal ID, active/inactive]
+                        single_score[fp].append([tmp_score[0], tmp_mol[0], tmp_mol[2]]) 
                 # rank list according to similarity
-                scores[fp].append(sorted(single_score[fp], reverse=True))
+                with tracing.stage('rank', len(test_list), fp):
+                    if early: # only the top of the ranked list
+                        scores[fp].append(scor.getTopRanked(single_score[fp], stream.numRanked(len(test_list))))
+                    else:
+                        scores[fp].append(sorted(single_score[fp], reverse=True))
+                if not stream or stream.keeps(): # streaming mode: only the kept sample
+                    checkpoint.add(q, fp, scores[fp][-1])
+            if stream:
+                kept = stream.keeps()
+                stream.addRepetition(scores, num_mol=len(test_list), num_act=num_test_actives)
+                # only the validation results of the repetition are recorded
+                if not kept: checkpoint.add(q, scor.results_unit, stream.lastResults())
+            checkpoint.sync()
+        item['scores'] = scores
+        item['stream'] = stream
+        return item
 
+    def writeTarget(item):
+        '''Writes the scored lists (streaming mode: the validation
+        results and the kept sample) of a target'''
+        target, scores, stream = item['target'], item['scores'], item['stream']
         # write scores to file
-        if do_append:
-            outfile = gzip.open(outpath+'/list_'+str(target)+'.pkl.gz', 'ab+') # binary format
-        else:
-            outfile = gzip.open(outpath+'/list_'+str(target)+'.pkl.gz', 'wb+') # binary format
-        for fp in fp_names:
-            cPickle.dump([fp, scores[fp]], outfile, 2)
-        outfile.close()
-        print "scoring done and scored lists written"
+        outname = outpath+'/list_'+str(target)+'.pkl.gz'
+        if stream: # validation results and the kept sample of scored lists
+            stream.writeTarget(outpath+'/ChEMBL', target)
+            outname = outpath+'/sample_list_'+str(target)+'.pkl.gz'
+        if not stream or num_keep > 0:
+            with tracing.stage('write'):
+                if do_append:
+                    outfile = gzip.open(outname, 'ab+') # binary format
+                else:
+                    outfile = gzip.open(outname+'.tmp', 'wb+') # binary format
+                for fp in fp_names:
+                    cPickle.dump([fp, scores[fp]], outfile, 2)
+                outfile.close()
+            if not do_append: os.rename(outname+'.tmp', outname)
+        item['checkpoint'].finish()
+        print target, "scoring done and scored lists written"
+
+    # run the stages for each target (pipelined mode: concurrently)
+    pipeline = scor.Pipeline(zip(scor.stage_names, [loadTarget, fingerprintTarget, scoreTarget, writeTarget]), workers,
+                             context=lambda item: dict(dataset=item['dataset'], target=item['target']))
+    pipeline.run([dict(dataset=d, target=t) for d,t in targets])
+    fp_calc.close()
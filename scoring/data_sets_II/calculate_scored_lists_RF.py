@@ -15,11 +15,35 @@
 #          default parameters: criterion=gini, max_depth=10,
 #          max_features=auto (=sqrt), num_estimators=100,
 #          min_samples_split=2, min_samples_leaf=1, n_jobs=1
+# -v [] : file containing the validation methods; streaming mode:
+#         the scored lists are validated directly and only the
+#         validation results are written (default: off)
+# -k [] : number of repetitions for which the scored lists are
+#         kept in streaming mode (default: 0)
+# -e : early-recognition mode (requires -v with EF, BEDROC and
+#      RIE only): only the top of the scored lists is ranked
+# -t [] : only this target, can be given multiple times
+#         (default: all targets)
+# --resume : resume an interrupted run, finished targets (with
+#      --checkpoint also repetitions) are skipped (default: off)
+# --checkpoint : record the scored lists of the finished
+#      repetitions, flushed to disk once per repetition, so
+#      that --resume skips them (default: off)
+# -p [] : pipelined mode: comma-separated numbers of load
+#         threads, fingerprint processes and write threads
+#         (e.g. 1,4,1); the stages of consecutive targets run
+#         concurrently, the score stage on one thread; the
+#         fingerprint stage calculates the fingerprints of the
+#         compounds the repetitions use (default: off)
 # --help : prints usage
 #
 # OUTPUT: for each target in each data set
 #         a file with a list (1 element) of RF prediction
 #         per RF prediction: [name, list of 50 scored lists]
+#         in streaming mode: the validation results per target
+#         (as for calculate_validation_methods.py) and the kept
+#         sample of scored lists (sample_list_[...].pkl.gz)
+#         (ranks of the validation results within this run)
 #
 #  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
 #  All rights reserved.
@@ -56,6 +80,7 @@ import cPickle, gzip, sys, os, os.path, numpy
 from collections import defaultdict
 from optparse import OptionParser 
 from sklearn.ensemble import RandomForestClassifier, forest
+from sklearn.base import clone
 from sklearn.tree import tree
 from rdkit.ML.Data import DataUtils
 from multiprocessing import Pool
@@ -64,10 +89,17 @@ from multiprocessing import Pool
 sys.path.insert(0, os.getcwd()+'/../../')
 import configuration_file_II as conf
 
+# instrumentation of the stages
+import tracing
+
 # import functions for scoring step
 sys.path.insert(0, os.getcwd()+'/../')
 import scoring_functions as scor
 
+# import validation functions for the streaming mode
+sys.path.insert(0, os.getcwd()+'/../../validation/')
+import validation_functions as vfunc
+
 # import ML functions
 import ml_functions_13 as ml_func
 
@@ -78,9 +110,6 @@ inpath_cmp = parentpath+'compounds/'
 inpath_list = parentpath+'query_lists/data_sets_II/ChEMBL/'
 path = cwd+'/'
 
-# flag to read in ChEMBL decoys only once
-firstchembl = True
-
 # dictionary for readMLFile()
 read_dict = {}
 read_dict['criterion'] = lambda x: x
@@ -101,6 +130,13 @@ parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relat
 parser.add_option("-s", "--similarity", dest="simil", type="string", metavar="NAME", help="NAME of similarity metric to use (default: Dice, other options are: Tanimoto, Cosine, Russel, Kulczynski, McConnaughey, Manhattan, RogotGoldberg")
 parser.add_option("-m", "--ml", dest="ml", metavar="FILE", help="file containing the random forest info (default parameters: criterion=gini, max_depth=10, max_features=auto (=sqrt), num_estimators=100, min_samples_split=2, min_samples_leaf=1, n_jobs=1)")
 parser.add_option("-a", "--append", dest="do_append", action="store_true", help="append to the output file (default: False)")
+parser.add_option("-v", "--validation", dest="val_file", metavar="FILE", help="FILE containing the validation methods, switches on the streaming mode (default: off)")
+parser.add_option("-k", "--keep", dest="num_keep", type="int", metavar="INT", help="number of repetitions for which the scored lists are kept in streaming mode (default: 0)")
+parser.add_option("-e", "--early", dest="early", action="store_true", help="early-recognition mode: only the top of the scored lists is ranked, requires -v with EF, BEDROC and RIE only (default: False)")
+parser.add_option("-t", "--target", action="append", dest="targets", metavar="NAME", help="only this target (target id), can be given multiple times (default: all targets)")
+parser.add_option("--resume", dest="resume", action="store_true", help="resume an interrupted run: finished targets (with --checkpoint also repetitions) are skipped (default: False)")
+parser.add_option("--checkpoint", dest="checkpoint", action="store_true", help="record the scored lists of the finished repetitions, so that --resume skips them (default: False)")
+parser.add_option("-p", "--pipeline", dest="workers", metavar="LIST", help="pipelined mode: comma-separated numbers of load threads, fingerprint processes and write threads, e.g. 1,4,1 (default: off)")
 
 ############# MAIN PART ########################
 if __name__=='__main__':
@@ -127,6 +163,17 @@ if __name__=='__main__':
     # check for sensible input
     if outpath_set: scor.checkPath(outpath, 'output')
     scor.checkSimil(simil_metric)
+    num_keep = 0
+    if options.num_keep: num_keep = options.num_keep
+    # streaming mode: validation of the ranked lists of each repetition
+    method_dict = None
+    if options.val_file:
+        method_dict = vfunc.readMethods(path+options.val_file)
+    early = False
+    if options.early:
+        if not method_dict: raise RuntimeError('early-recognition mode requires the streaming mode (-v)')
+        vfunc.checkEarly(method_dict)
+        early = True
 
     # default machine-learning method variables
     ml_dict = dict(criterion='gini', max_features='auto', n_jobs=1, max_depth=10, min_samples_split=2, min_samples_leaf=1, num_estimators=100)
@@ -136,45 +183,89 @@ if __name__=='__main__':
     # initialize machine-learning method
     ml = RandomForestClassifier(criterion=ml_dict['criterion'], max_features=ml_dict['max_features'], min_samples_split=ml_dict['min_samples_split'], max_depth=ml_dict['max_depth'], min_samples_leaf=ml_dict['min_samples_leaf'], n_estimators=ml_dict['num_estimators'], n_jobs=ml_dict['n_jobs'])
 
-    # loop over targets
-    for target in conf.set_data:
+    # pipelined mode: numbers of workers of the stages and of the
+    # fingerprint processes (started before any other thread)
+    workers = None
+    num_fp_jobs = 1
+    if options.workers: workers, num_fp_jobs = scor.checkWorkers(options.workers)
+    fp_calc = scor.FPCalculator(num_fp_jobs)
+
+    # compound lists of the selected targets, read ahead on background threads
+    targets = [('ChEMBL', t) for t in conf.set_data if scor.checkTarget(options.targets, 'ChEMBL', t)]
+    compounds = scor.CompoundPrefetcher(scor.getCompoundFiles(inpath_cmp, targets))
+
+    def readMols(reader):
+        '''Reads a compound list, the fingerprint of a compound and
+        its numpy array are calculated on the first access'''
+        # store: [internal ID, fp]
+        mols = scor.LazyFPList(scor.readCompounds(reader), fp_build)
+        # numpy arrays of the fps
+        return mols, scor.LazyList(mols, lambda m: ml_func.getNumpy([m])[0])
+
+    def loadTarget(item):
+        '''Checks the journal of a target, reads its training actives
+        and opens its compound lists'''
+        target = item['target']
         print target
+        # checkpoint journal of the target
+        item['checkpoint'] = scor.Checkpoint(outpath, str(target), options.resume, [fp_build, simil_metric, sorted(ml_dict.items()),
+                                                                                    method_dict and sorted(method_dict.items()), num_keep, early], options.checkpoint)
+        if item['checkpoint'].done:
+            print "already done"
+            return None
+        # training actives per paper
+        item['actives'] = cPickle.load(open(inpath_cmp+'ChEMBL_II/Target_no_'+str(target)+'.pkl', 'r'))
+        # test actives
+        item['div_actives'] = compounds.open(inpath_cmp+'ChEMBL/cmp_list_ChEMBL_'+str(target)+'_actives.dat.gz')
+        # the decoys are read only once
+        filepath = inpath_cmp+'ChEMBL/cmp_list_ChEMBL_zinc_decoys.dat.gz'
+        item['decoys'] = pipeline.once(filepath, lambda: compounds.open(filepath))
+        return item
 
-        # read in training actives and calculate fps
-        actives = cPickle.load(open(inpath_cmp+'ChEMBL_II/Target_no_'+str(target)+'.pkl', 'r'))
+    def fingerprintTarget(item):
+        '''Reads the training actives, the test actives and the decoys
+        and calculates the fingerprints (and their numpy arrays) of the
+        compounds the papers use'''
+        target = item['target']
+        actives = item['actives']
         for k in actives.keys():
-            for i,m in enumerate(actives[k]):
-                fp_dict = scor.getFP(fp_build, m[1])
-                actives[k][i] = [str(target)+'_'+str(k)+'_A_'+str(i+1), fp_dict]
-
-        # read in test actives and calculate fps
-        div_actives = []
-        for line in gzip.open(inpath_cmp+'ChEMBL/cmp_list_ChEMBL_'+str(target)+'_actives.dat.gz', 'r'):
-            if line[0] != '#': 
-                # structure of line: [external ID, internal ID, SMILES]]
-                line = line.rstrip().split()
-                fp_dict = scor.getFP(fp_build, line[2])
-                # store: [internal ID, dict with fps]
-                div_actives.append([line[1], fp_dict])
+            mols = [[str(target)+'_'+str(k)+'_A_'+str(i+1), m[1]] for i,m in enumerate(actives[k])]
+            actives[k] = scor.LazyFPList(mols, fp_build)
+            actives[k].calculate(range(len(mols)), fp_calc)
+        div_actives, np_fps_div_act = item['div_actives'] = readMols(item['div_actives'])
+        decoys, np_fps_dcy = item['decoys'] = pipeline.once('ChEMBL decoys', lambda: readMols(item['decoys']))
+        # test actives of the papers; the decoys which are training
+        # decoys of all papers are not used
+        training_input = open(inpath_list+'/training_'+str(target)+'.pkl', 'r')
+        test_input = open(inpath_list+'/test_'+str(target)+'.pkl', 'r')
+        test_actives = set()
+        unused = set(range(len(decoys)))
+        for q in actives.keys():
+            unused.intersection_update(cPickle.load(training_input)[len(actives[q]):])
+            test_actives.update(cPickle.load(test_input)[:conf.num_div_act-1])
+        training_input.close()
+        test_input.close()
+        div_actives.calculate(test_actives, fp_calc)
+        np_fps_div_act.fill(test_actives)
+        # the training and test decoys are all decoys
+        decoys.calculate(range(len(decoys)), fp_calc)
+        np_fps_dcy.fill(range(len(decoys)))
+        print target, "fingerprints calculated"
+        return item
+
+    def scoreTarget(item):
+        '''Scores the papers of a target'''
+        target, checkpoint = item['target'], item['checkpoint']
+        actives = item.pop('actives')
+        div_actives, np_fps_div_act = item.pop('div_actives')
+        decoys, np_fps_dcy = item.pop('decoys')
         num_test_actives = conf.num_div_act - 1
-        # convert fps to numpy arrays
-        np_fps_div_act = ml_func.getNumpy(div_actives)
-
-        # read in decoys and calculate fps
-        if firstchembl:
-            decoys = []
-            for line in gzip.open(inpath_cmp+'ChEMBL/cmp_list_ChEMBL_zinc_decoys.dat.gz', 'r'):
-                if line[0] != '#': 
-                    # structure of line: [external ID, internal ID, SMILES]]
-                    line = line.rstrip().split()
-                    fp_dict = scor.getFP(fp_build, line[2])
-                    # store: [internal ID, dict with fps]
-                    decoys.append([line[1], fp_dict])
-            # convert fps to numpy arrays
-            np_fps_dcy = ml_func.getNumpy(decoys)
-            firstchembl = False
-            num_decoys = len(decoys)
-        print "molecules read in and fingerprints calculated"
+        num_decoys = len(decoys)
+        # streaming mode: validation of the ranked lists of each repetition
+        stream = None
+        if method_dict: stream = vfunc.StreamValidation(method_dict, num_keep)
+        # machine-learning method of the target (unfitted copy)
+        model = clone(ml)
 
         # open training and test lists
         training_input = open(inpath_list+'/training_'+str(target)+'.pkl', 'r')
@@ -189,6 +280,15 @@ if __name__=='__main__':
             training_list = cPickle.load(training_input)
             test_list = cPickle.load(test_input)
             test_list += [i for i in range(num_decoys) if i not in training_list[num_actives:]]
+            # repetition validated in an interrupted run (streaming mode)
+            if checkpoint.isFinished(q, scor.results_unit):
+                stream.addResults(checkpoint.get(q, scor.results_unit))
+                continue
+            # repetition already finished in an interrupted run
+            if checkpoint.isFinished(q, 'rf_'+fp_build):
+                scores['rf_'+fp_build].append(checkpoint.get(q, 'rf_'+fp_build))
+                if stream: stream.addRepetition(scores, num_mol=len(test_list), num_act=num_test_actives)
+                continue
 
             # list with active/inactive info
             ys_fit = [1]*num_actives + [0]*(len(training_list)-num_actives)
@@ -196,7 +296,8 @@ if __name__=='__main__':
             train_fps = [actives[q][i][1] for i in range(num_actives)]
             np_train_fps = np_fps_act + [np_fps_dcy[i] for i in training_list[num_actives:]]
             # fit random forest
-            ml.fit(np_train_fps, ys_fit)
+            with tracing.stage('fit', len(ys_fit), fp_build):
+                model.fit(np_train_fps, ys_fit)
 
             # test fps and molecule info
             test_fps = [div_actives[i][1] for i in test_list[:num_test_actives]]
@@ -208,24 +309,59 @@ if __name__=='__main__':
 
             # calculate similarity with standard fp
             std_simil = []
-            for fp in test_fps:
-                tmp_simil = scor.getBulkSimilarity(fp, train_fps, simil_metric)
-                tmp_simil.sort(reverse=True)
-                std_simil.append(tmp_simil[0])
+            with tracing.stage('similarity', len(test_fps), fp_build):
+                for fp in test_fps:
+                    tmp_simil = scor.getBulkSimilarity(fp, train_fps, simil_metric)
+                    tmp_simil.sort(reverse=True)
+                    std_simil.append(tmp_simil[0])
 
             # rank based on probability (and second based on similarity)
-            single_score = ml.predict_proba(np_test_fps)
+            with tracing.stage('predict', len(np_test_fps), fp_build):
+                single_score = model.predict_proba(np_test_fps)
             # store: [probability, similarity, internal ID, active/inactive]
             single_score = [[m[1], s, t[0], t[1]] for m,s,t in zip(single_score,std_simil,test_mols)]
-            single_score.sort(reverse=True)
+            with tracing.stage('rank', len(test_mols), fp_build):
+                if early: # only the top of the ranked list
+                    single_score = scor.getTopRanked(single_score, stream.numRanked(len(test_mols)))
+                else:
+                    single_score.sort(reverse=True)
             scores['rf_'+fp_build].append(single_score)
+            if not stream or stream.keeps(): # streaming mode: only the kept sample
+                checkpoint.add(q, 'rf_'+fp_build, single_score)
+            if stream:
+                kept = stream.keeps()
+                stream.addRepetition(scores, num_mol=len(test_mols), num_act=num_test_actives)
+                # only the validation results of the repetition are recorded
+                if not kept: checkpoint.add(q, scor.results_unit, stream.lastResults())
+            checkpoint.sync()
+        item['scores'] = scores
+        item['stream'] = stream
+        return item
 
+    def writeTarget(item):
+        '''Writes the scored lists (streaming mode: the validation
+        results and the kept sample) of a target'''
+        target, scores, stream = item['target'], item['scores'], item['stream']
         # write scores to file
-        if do_append:
-            outfile = gzip.open(outpath+'/list_'+str(target)+'.pkl.gz', 'ab+') # binary format
-        else:
-            outfile = gzip.open(outpath+'/list_'+str(target)+'.pkl.gz', 'wb+') # binary format
-        for fp in ['rf_'+fp_build]:
-            cPickle.dump([fp, scores[fp]], outfile, 2)
-        outfile.close()
-        print "scoring done and scored lists written"
+        outname = outpath+'/list_'+str(target)+'.pkl.gz'
+        if stream: # validation results and the kept sample of scored lists
+            stream.writeTarget(outpath+'/ChEMBL', target)
+            outname = outpath+'/sample_list_'+str(target)+'.pkl.gz'
+        if not stream or num_keep > 0:
+            with tracing.stage('write'):
+                if do_append:
+                    outfile = gzip.open(outname, 'ab+') # binary format
+                else:
+                    outfile = gzip.open(outname+'.tmp', 'wb+') # binary format
+                for fp in ['rf_'+fp_build]:
+                    cPickle.dump([fp, scores[fp]], outfile, 2)
+                outfile.close()
+            if not do_append: os.rename(outname+'.tmp', outname)
+        item['checkpoint'].finish()
+        print target, "scoring done and scored lists written"
+
+    # run the stages for each target (pipelined mode: concurrently)
+    pipeline = scor.Pipeline(zip(scor.stage_names, [loadTarget, fingerprintTarget, scoreTarget, writeTarget]), workers,
+                             context=lambda item: dict(dataset=item['dataset'], target=item['target']))
+    pipeline.run([dict(dataset=d, target=t) for d,t in targets])
+    fp_calc.close()
@@ -3,13 +3,18 @@
 #
 # module to calculate a fingerprint from SMILES
 
-from rdkit import Chem
+from rdkit import Chem, DataStructs
 from rdkit.Chem import MACCSkeys, AllChem
 from rdkit.Avalon import pyAvalonTools as fpAvalon
 from rdkit.Chem.AtomPairs import Pairs, Torsions
 from rdkit.Chem.Fingerprints import FingerprintMols
 from rdkit.Chem.ChemicalFeatures import BuildFeatureFactory
 from rdkit.Chem import rdMolDescriptors
+import os, gzip, cPickle, mmap, struct, threading, atexit, inspect, hashlib, fcntl, zlib
+import rdkit
+
+# instrumentation (the root directory is in the path of the scripts)
+import tracing
 
 # implemented fingerprints:
 # ECFC0 (ecfc0), ECFP0 (ecfp0), MACCS (maccs), 
@@ -46,6 +51,20 @@ fpdict['lecfp4'] = lambda m: AllChem.GetMorganFingerprintAsBitVect(m, 2, nBits=l
 fpdict['lecfp6'] = lambda m: AllChem.GetMorganFingerprintAsBitVect(m, 3, nBits=longbits)
 fpdict['lfcfp4'] = lambda m: AllChem.GetMorganFingerprintAsBitVect(m, 2, useFeatures=True, nBits=longbits)
 fpdict['lfcfp6'] = lambda m: AllChem.GetMorganFingerprintAsBitVect(m, 3, useFeatures=True, nBits=longbits)
+# Morgan fingerprints: [feature invariants, radius, number of bits
+# (None: unfolded counts)]; the fingerprints of one invariant type are
+# derived from a single calculation at the largest radius (GetMorganFamily)
+morgan_params = {}
+for name, radius in [('0', 0), ('2', 1), ('4', 2), ('6', 3)]:
+    morgan_params['ecfp'+name] = (False, radius, nbits)
+    morgan_params['ecfc'+name] = (False, radius, None)
+    if radius > 0:
+        morgan_params['fcfp'+name] = (True, radius, nbits)
+        morgan_params['fcfc'+name] = (True, radius, None)
+    if radius > 1:
+        morgan_params['lecfp'+name] = (False, radius, longbits)
+        morgan_params['lfcfp'+name] = (True, radius, longbits)
+
 fpdict['maccs'] = lambda m: MACCSkeys.GenMACCSKeys(m)
 fpdict['ap'] = lambda m: Pairs.GetAtomPairFingerprint(m)
 fpdict['tt'] = lambda m: Torsions.GetTopologicalTorsionFingerprintAsIntVect(m)
@@ -58,9 +77,257 @@ fpdict['rdk6'] = lambda m: Chem.RDKFingerprint(m, maxPath=6, fpSize=nbits, nBits
 fpdict['rdk7'] = lambda m: Chem.RDKFingerprint(m, maxPath=7, fpSize=nbits, nBitsPerHash=2)
 
 
-def CalculateFP(fp_name, smiles):
-    m = Chem.MolFromSmiles(smiles)
+# compound registry (written by build_mol_store.py): each molecule of
+# the compound lists has a global ID (one per canonical SMILES) and its
+# RDKit binary is stored once (mol_store.bin); the registry maps the
+# SMILES of the compound lists to the IDs (registry.pkl.gz)
+registry_name = 'registry.pkl.gz'
+store_name = 'mol_store.bin'
+# directory of the fingerprint stores in the compound directory; the
+# name of a store contains the signature of the fingerprint definition
+fp_store_dir = 'fp_store'
+# the fingerprint stores are not used if this environment variable is
+# set (e.g. by the benchmarks, which time the calculation)
+no_fp_store_env = 'BENCHMARK_NO_FP_STORE'
+
+_registry = {'path':None, 'ids':{}, 'offsets':[], 'data':None}
+_registry_lock = threading.Lock()
+
+def OpenRegistry(inpath):
+    '''Opens the compound registry and the molecule store of a
+    compound directory, if there is one (only the first one found
+    is used)'''
+    with _registry_lock:
+        if _registry['path'] is not None: return
+        inpath = os.path.abspath(inpath)+'/'
+        if not os.path.exists(inpath+registry_name): return
+        registry = cPickle.load(gzip.open(inpath+registry_name, 'rb'))
+        if not registry['offsets']: return
+        datafile = open(inpath+store_name, 'rb')
+        _registry['data'] = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+        datafile.close()
+        _registry['ids'] = registry['ids']
+        _registry['offsets'] = registry['offsets']
+        _registry['path'] = inpath
+
+def GetRegistryPath():
+    '''Returns the compound directory of the open registry (None if
+    no registry is open)'''
+    return _registry['path']
+
+def GetMolID(smiles):
+    '''Returns the global ID of a SMILES (None if not registered)'''
+    return _registry['ids'].get(smiles)
+
+def GetMol(smiles):
+    '''Returns the molecule of a SMILES, from the molecule store
+    if the SMILES is registered'''
+    molid = _registry['ids'].get(smiles)
+    if molid is None:
+        return Chem.MolFromSmiles(smiles)
+    offset, length = _registry['offsets'][molid]
+    return Chem.Mol(_registry['data'][offset:offset+length])
+
+def _crc(data):
+    '''Checksum of the records of the fingerprint stores'''
+    return zlib.crc32(data) & 0xffffffff
+
+class FPStore:
+    '''Fingerprints of one type per global ID: records [ID, length,
+    checksum of the fingerprint, checksum of the header, pickled
+    fingerprint] appended to fp_store/[name]_[signature].bin; new
+    fingerprints are appended in batches under an exclusive lock of
+    the file (fcntl, also on NFS), so that several processes and
+    nodes can share the store'''
+    header = struct.Struct('<iIII')
+    def __init__(self, filepath, batch_size=1000):
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.index = {}
+        self.added = {}
+        self.pending = []
+        self.data = None
+        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            datafile = open(filepath, 'rb')
+            self.data = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+            datafile.close()
+            self._readIndex()
+    def _readIndex(self):
+        '''Reads the offsets of the records (an incomplete last record
+        of an interrupted run is ignored, a record with a wrong checksum
+        is an error)'''
+        size = len(self.data)
+        offset = 0
+        while offset + self.header.size <= size:
+            molid, length, checksum, header_checksum = self.header.unpack_from(self.data, offset)
+            start = offset + self.header.size
+            if _crc(self.data[offset:start-4]) != header_checksum: # header without its checksum
+                raise IOError('corrupt record in the fingerprint store (remove the file):', self.filepath, offset)
+            if start + length > size: break
+            if _crc(self.data[start:start+length]) != checksum:
+                raise IOError('corrupt record in the fingerprint store (remove the file):', self.filepath, offset)
+            self.index[molid] = (start, length)
+            offset = start + length
+    def get(self, molid):
+        fp = self.added.get(molid)
+        if fp is not None: return fp
+        entry = self.index.get(molid)
+        if entry is None: return None
+        offset, length = entry
+        return cPickle.loads(self.data[offset:offset+length])
+    def add(self, molid, fp):
+        with self.lock:
+            self.added[molid] = fp
+            self.pending.append(molid)
+            if len(self.pending) >= self.batch_size:
+                self._write()
+    def flush(self):
+        with self.lock:
+            self._write()
+    def _write(self):
+        if not self.pending: return
+        records = []
+        for molid in self.pending:
+            binary = cPickle.dumps(self.added[molid], 2)
+            header = struct.pack('<iII', molid, len(binary), _crc(binary))
+            records.append(header+struct.pack('<I', _crc(header)))
+            records.append(binary)
+        data = ''.join(records)
+        fd = os.open(self.filepath, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX) # released by close
+            written = 0
+            while written < len(data):
+                num = os.write(fd, data[written:])
+                if num <= 0:
+                    raise IOError('cannot write to the fingerprint store:', self.filepath)
+                written += num
+        finally:
+            os.close(fd)
+        self.pending = []
+
+_fp_stores = {}
+
+def GetFPSignature(fp_name):
+    '''Returns the signature of the definition of a fingerprint: its
+    entries of fpdict and morgan_params, the numbers of bits, the
+    RDKit version and the record format; stores of another definition
+    are not used'''
+    definition = [inspect.getsource(fpdict[fp_name]).strip(), morgan_params.get(fp_name),
+                  nbits, longbits, getattr(rdkit, '__version__', None), FPStore.header.format]
+    return hashlib.md5(repr(definition)).hexdigest()[:12]
+
+def GetFPStore(fp_name):
+    '''Returns the fingerprint store of a fingerprint (None without
+    a compound registry or if the stores are switched off)'''
+    if _registry['path'] is None or os.environ.get(no_fp_store_env): return None
+    with _registry_lock:
+        if fp_name not in _fp_stores:
+            storepath = _registry['path']+fp_store_dir+'/'
+            if not os.path.exists(storepath):
+                try:
+                    os.makedirs(storepath)
+                except OSError: # created by another process
+                    pass
+            _fp_stores[fp_name] = FPStore(storepath+fp_name+'_'+GetFPSignature(fp_name)+'.bin')
+        return _fp_stores[fp_name]
+
+def FlushFPStores():
+    '''Writes the new fingerprints of all stores'''
+    for store in _fp_stores.values():
+        store.flush()
+
+atexit.register(FlushFPStores)
+
+def GetMorganFamily(m, fp_names):
+    '''Calculates the Morgan fingerprints fp_names of a molecule with
+    one unfolded Morgan fingerprint per invariant type: the environments
+    of a smaller radius are a subset of those of the largest radius
+    (bitInfo), and a folded fingerprint sets the environment IDs
+    modulo the number of bits'''
+    fps = {}
+    for features in [False, True]:
+        names = [n for n in fp_names if morgan_params[n][0] == features]
+        if not names: continue
+        max_radius = max([morgan_params[n][1] for n in names])
+        info = {}
+        full = AllChem.GetMorganFingerprint(m, max_radius, useFeatures=features, bitInfo=info)
+        counts = {} # per radius: {environment ID: count}
+        for n in names:
+            radius, bits = morgan_params[n][1:]
+            if bits is None and radius == max_radius:
+                fps[n] = full
+                continue
+            if radius not in counts:
+                counts[radius] = {}
+                for envid, envs in info.iteritems():
+                    c = len([e for e in envs if e[1] <= radius])
+                    if c > 0: counts[radius][envid] = c
+            if bits is None:
+                fp = DataStructs.UIntSparseIntVect(full.GetLength())
+                for envid, c in counts[radius].iteritems():
+                    fp[envid] = c
+            else:
+                fp = DataStructs.ExplicitBitVect(bits)
+                fp.SetBitsFromList(sorted(set([envid % bits for envid in counts[radius]])))
+            fps[n] = fp
+    return fps
+
+def LookupFPs(fp_names, smiles):
+    '''Returns the fingerprints among fp_names of a SMILES which are
+    in the fingerprint stores {fingerprint name: fingerprint}'''
+    molid = GetMolID(smiles)
+    fps = {}
+    if molid is None: return fps
+    for fp_name in fp_names:
+        store = GetFPStore(fp_name)
+        fp = None
+        if store: fp = store.get(molid)
+        if fp is not None: fps[fp_name] = fp
+    return fps
+
+def ComputeFPs(fp_names, smiles):
+    '''Calculates the fingerprints fp_names of a SMILES without the
+    fingerprint stores; returns a dictionary {fingerprint name:
+    fingerprint}'''
+    with tracing.stage('parse', 1, fp_names[0]):
+        m = GetMol(smiles)
     if m is None:
         raise ValueError('SMILES cannot be converted to a RDKit molecules:', smiles)
 
-    return fpdict[fp_name](m)
+    fps = {}
+    # several Morgan fingerprints are derived from one calculation
+    morgan = [n for n in fp_names if n in morgan_params]
+    if len(morgan) > 1:
+        with tracing.stage('fingerprint', 1, 'morgan'):
+            fps.update(GetMorganFamily(m, morgan))
+    for fp_name in fp_names:
+        if fp_name not in fps:
+            with tracing.stage('fingerprint', 1, fp_name):
+                fps[fp_name] = fpdict[fp_name](m)
+    return fps
+
+def StoreFPs(smiles, fps):
+    '''Adds the calculated fingerprints of a registered SMILES to
+    the fingerprint stores'''
+    molid = GetMolID(smiles)
+    if molid is None: return
+    for fp_name, fp in fps.items():
+        store = GetFPStore(fp_name)
+        if store: store.add(molid, fp)
+
+def CalculateFPs(fp_names, smiles):
+    '''Calculates the fingerprints fp_names of a SMILES; returns a
+    dictionary {fingerprint name: fingerprint}'''
+    # fingerprints of registered molecules are calculated only once
+    fps = LookupFPs(fp_names, smiles)
+    missing = [n for n in fp_names if n not in fps]
+    if missing:
+        calculated = ComputeFPs(missing, smiles)
+        StoreFPs(smiles, calculated)
+        fps.update(calculated)
+    return fps
+
+def CalculateFP(fp_name, smiles):
+    return CalculateFPs([fp_name], smiles)[fp_name]
@@ -34,12 +34,16 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import os, sys, operator
+import os, sys, operator, cPickle, gzip, threading, Queue, hashlib, multiprocessing
+import numpy
 from rdkit import DataStructs
 
 # import the fingerprint library
 import fingerprint_lib
 
+# instrumentation (the root directory is in the path of the scripts)
+import tracing
+
 def checkFPFile(filepath):
     '''Checks if file containing fingerprint names exists
     and reads the fingerprints'''
@@ -70,18 +74,367 @@ def checkQueryMols(num, list_num_query_mols):
     if num not in list_num_query_mols:
         raise ValueError('provided number of query molecules not supported:', num)
 
+def checkTarget(selection, dataset, target):
+    '''Checks if a target is selected ([data set]:[target] or
+    [target]); all targets are selected if no selection is given'''
+    if not selection: return True
+    return dataset+':'+str(target) in selection or str(target) in selection
+
+def getListFile(inpath, name):
+    '''Returns the file with the scored lists of a target:
+    list_[name].pkl.gz or the former name list_[name]_.pkl.gz'''
+    filepath = inpath+'/list_'+name+'.pkl.gz'
+    if not os.path.exists(filepath) and os.path.exists(inpath+'/list_'+name+'_.pkl.gz'):
+        filepath = inpath+'/list_'+name+'_.pkl.gz'
+    return filepath
+
 def getFPDict(fp_names, smiles):
     '''Gets the fingerprints from the fingerprint library
     and stores them in a dictioanry'''
-    fp_dict = {}
-    for fp in fp_names:
-        fp_dict[fp] = fingerprint_lib.CalculateFP(fp, smiles)
-    return fp_dict
+    return fingerprint_lib.CalculateFPs(fp_names, smiles)
 
 def getFP(fp_name, smiles):
     '''Gets fingerprint from fingerprint library'''
     return fingerprint_lib.CalculateFP(fp_name, smiles)
 
+# lazy fingerprints: the fingerprints of a compound are calculated on
+# the first access and kept, so that a run calculates only the
+# fingerprints of the compounds (and of the repetitions) it scores;
+# the fingerprint stage of the scoring scripts calculates those of
+# the compounds the repetitions use in advance (calcFPDicts,
+# LazyFPList.calculate), in a pool of processes since the calculation
+# holds the GIL; registered compounds are taken from the fingerprint
+# store, which only the main process reads and writes
+
+# number of compounds per task of the fingerprint processes
+fp_chunk_size = 200
+
+def _calcFPChunk(task):
+    '''Calculates the fingerprints of a chunk of compounds [SMILES,
+    fingerprint names] in a fingerprint process'''
+    registry_path, context, chunk = task
+    if registry_path: fingerprint_lib.OpenRegistry(registry_path)
+    tracing.setContext(**context)
+    fps = [fingerprint_lib.ComputeFPs(fp_names, smiles) for smiles, fp_names in chunk]
+    tracing.flush()
+    return fps
+
+class FPCalculator:
+    '''Calculates the fingerprints of lists of SMILES, in a pool of
+    num_jobs processes if num_jobs > 1; the pool has to be started
+    before the threads of the script'''
+    def __init__(self, num_jobs=1):
+        self.pool = None
+        if num_jobs > 1: self.pool = multiprocessing.Pool(num_jobs)
+    def calculate(self, fp_names, smiles_list):
+        '''Returns a dictionary {fingerprint name: fingerprint} per
+        SMILES'''
+        if not self.pool:
+            return [fingerprint_lib.CalculateFPs(fp_names, smiles) for smiles in smiles_list]
+        results = [fingerprint_lib.LookupFPs(fp_names, smiles) for smiles in smiles_list]
+        todo = [(i, [n for n in fp_names if n not in fps]) for i,fps in enumerate(results)]
+        todo = [t for t in todo if t[1]]
+        chunks = [todo[k:k+fp_chunk_size] for k in range(0, len(todo), fp_chunk_size)]
+        tasks = [(fingerprint_lib.GetRegistryPath(), tracing.getContext(), [[smiles_list[i], names] for i,names in c]) for c in chunks]
+        with tracing.stage('fingerprint_pool', len(todo)):
+            for c, fps_list in zip(chunks, self.pool.map(_calcFPChunk, tasks)):
+                for (i, names), fps in zip(c, fps_list):
+                    fingerprint_lib.StoreFPs(smiles_list[i], fps)
+                    results[i].update(fps)
+        return results
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+class LazyFPDict(dict):
+    '''Fingerprints of a compound {fingerprint name: fingerprint},
+    calculated on the first access; the Morgan fingerprints among
+    fp_names are calculated together'''
+    __slots__ = ['smiles', 'fp_names']
+    def __init__(self, smiles, fp_names=[]):
+        dict.__init__(self)
+        self.smiles = smiles
+        self.fp_names = fp_names
+    def __missing__(self, fp_name):
+        names = [fp_name]
+        if fp_name in fingerprint_lib.morgan_params:
+            names += [n for n in self.fp_names if n in fingerprint_lib.morgan_params and n != fp_name and n not in self]
+        self.update(fingerprint_lib.CalculateFPs(names, self.smiles))
+        return self[fp_name]
+
+class LazyList:
+    '''List of values of a list of compounds (e.g. [internal ID,
+    fingerprint] or numpy arrays): the value of an index is
+    calculated with func on the first access and kept'''
+    def __init__(self, items, func):
+        self.items = items
+        self.func = func
+        self.values = [None]*len(items)
+    def __len__(self):
+        return len(self.values)
+    def __getitem__(self, i):
+        value = self.values[i]
+        if value is None:
+            value = self.values[i] = self.func(self.items[i])
+        return value
+    def __iter__(self):
+        for i in xrange(len(self.values)):
+            yield self[i]
+    def fill(self, indices):
+        '''Calculates the values of the indices in advance'''
+        for i in indices:
+            self[i]
+
+class LazyFPList(LazyList):
+    '''[internal ID, fingerprint] of a list of compounds [internal ID,
+    SMILES]: the fingerprint of an index is calculated on the first
+    access or in advance with calculate()'''
+    def __init__(self, items, fp_name):
+        LazyList.__init__(self, items, lambda m: [m[0], getFP(fp_name, m[1])])
+        self.fp_name = fp_name
+    def calculate(self, indices, calculator):
+        '''Calculates the fingerprints of the indices in advance'''
+        todo = [i for i in sorted(set(indices)) if self.values[i] is None]
+        for i, fps in zip(todo, calculator.calculate([self.fp_name], [self.items[i][1] for i in todo])):
+            self.values[i] = [self.items[i][0], fps[self.fp_name]]
+
+def calcFPDicts(mols, indices, fp_names, calculator):
+    '''Calculates the fingerprints fp_names of the compounds indices
+    of a list [internal ID, LazyFPDict] in advance'''
+    todo = [i for i in sorted(set(indices)) if [n for n in fp_names if n not in mols[i][1]]]
+    for i, fps in zip(todo, calculator.calculate(fp_names, [mols[i][1].smiles for i in todo])):
+        mols[i][1].update(fps)
+
+def readCompounds(reader):
+    '''Reads a compound list: [internal ID, SMILES] per compound;
+    each chunk is converted as it arrives from the reader'''
+    mols = []
+    for chunk in reader:
+        for line in chunk:
+            # structure of line: [external ID, internal ID, SMILES]
+            mols.append([line[1], line[2]])
+    return mols
+
+# reading of the compound lists: the files are decompressed and the
+# lines split on a background thread, the compounds are handed over
+# in chunks through a bounded buffer; the lists of the next targets
+# are read ahead while the current target is scored (only the reading
+# overlaps with the other stages: the scoring scripts keep the
+# compounds of a list in memory, since the training lists index them
+# randomly, and calculate the fingerprints in the fingerprint stage)
+
+# number of compounds per chunk
+chunk_size = 1000
+# maximal number of chunks buffered per compound list
+max_chunks = 4
+
+class CompoundReader:
+    '''Reads a compound list on a background thread; iterating
+    yields chunks of compounds [external ID, internal ID, SMILES]'''
+    def __init__(self, filepath, chunksize=chunk_size, maxchunks=max_chunks):
+        # compound registry of the compound directory (if built)
+        fingerprint_lib.OpenRegistry(os.path.dirname(os.path.dirname(os.path.abspath(filepath))))
+        self.filepath = filepath
+        self.chunksize = chunksize
+        self.buffer = Queue.Queue(maxchunks)
+        self.stopped = False
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+    def _put(self, item):
+        '''Waits for space in the buffer, returns False if the
+        reader was stopped'''
+        while not self.stopped:
+            try:
+                self.buffer.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def _read(self):
+        try:
+            infile = gzip.open(self.filepath, 'r')
+            chunk = []
+            for line in infile:
+                if line[0] != '#':
+                    chunk.append(line.rstrip().split())
+                    if len(chunk) == self.chunksize:
+                        if not self._put(chunk): break
+                        chunk = []
+            else:
+                if chunk: self._put(chunk)
+                self._put(None)
+            infile.close()
+        except Exception:
+            # handed over to the reading thread
+            self._put(sys.exc_info())
+    def __iter__(self):
+        while 1:
+            item = self.buffer.get()
+            if item is None: break
+            if isinstance(item, tuple):
+                raise item[0], item[1], item[2]
+            yield item
+    def stop(self):
+        '''Stops the reading (the file is not needed)'''
+        self.stopped = True
+
+class CompoundPrefetcher:
+    '''Opens the compound lists of a run in the given order and
+    starts the readers of the next depth lists in advance'''
+    def __init__(self, filepaths, depth=2):
+        self.filepaths = list(filepaths)
+        self.depth = depth
+        self.pos = 0
+        self.readers = {}
+        self.lock = threading.Lock()
+    def open(self, filepath):
+        '''Returns the reader of a compound list; lists skipped
+        in the order (e.g. finished targets) are not read'''
+        with self.lock:
+            return self._open(filepath)
+    def _open(self, filepath):
+        if filepath in self.filepaths[self.pos:]:
+            i = self.filepaths.index(filepath, self.pos)
+            for f in self.filepaths[self.pos:i]:
+                if f in self.readers: self.readers.pop(f).stop()
+            self.pos = i+1
+            reader = self.readers.pop(filepath, None)
+        else:
+            reader = None
+        if reader is None:
+            reader = CompoundReader(filepath)
+        for f in self.filepaths[self.pos:self.pos+self.depth]:
+            if f not in self.readers:
+                self.readers[f] = CompoundReader(f)
+        return reader
+
+def getCompoundFiles(inpath, targets):
+    '''Returns the compound lists of the targets ([data set, target])
+    in the order they are read: actives and decoys per target, the
+    ZINC decoys of ChEMBL only once'''
+    filepaths = []
+    for dataset, target in targets:
+        filepaths.append(inpath+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_actives.dat.gz')
+        if dataset == 'ChEMBL':
+            decoys = inpath+'ChEMBL/cmp_list_ChEMBL_zinc_decoys.dat.gz'
+        else:
+            decoys = inpath+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_decoys.dat.gz'
+        if decoys not in filepaths: filepaths.append(decoys)
+    return filepaths
+
+# pipelined execution of the targets: the stages (reading of the
+# compound lists, fingerprints, scoring of the repetitions, writing)
+# run on their own threads and are connected by bounded queues, so
+# that the stages of consecutive targets overlap and the slowest
+# stage sets the throughput; the threads share the GIL, so that the
+# CPU-bound stages run on one thread each: the fingerprint stage
+# distributes the fingerprints over processes (FPCalculator), the
+# score stage runs alone
+
+# names of the stages of the scoring scripts
+stage_names = ['load', 'fingerprint', 'score', 'write']
+
+def checkWorkers(value):
+    '''Reads the comma-separated numbers of load threads, fingerprint
+    processes and write threads; returns the numbers of workers of
+    the stages and the number of fingerprint processes'''
+    try:
+        num_load, num_fp, num_write = [int(w) for w in value.split(',')]
+    except ValueError:
+        raise ValueError('three integers required (load, fingerprint, write):', value)
+    if min(num_load, num_fp, num_write) < 1:
+        raise ValueError('one or more workers required for each stage:', value)
+    return [num_load, 1, 1, num_write], num_fp
+
+# marks the end of the items in a queue
+_end_of_items = None
+
+class Pipeline:
+    '''Runs items through a sequence of stages [name, function];
+    a function returns the item for the next stage or None if the
+    item is finished. With workers (per stage), the stages run
+    concurrently and at most maxitems items wait between two stages;
+    without workers, the stages run one after the other per item.
+    context(item) returns the tracing context of an item'''
+    def __init__(self, stages, workers=None, context=None, maxitems=1):
+        if workers and len(workers) != len(stages):
+            raise ValueError('number of workers required for each stage:', [s[0] for s in stages])
+        self.stages = stages
+        self.workers = workers
+        self.context = context
+        self.maxitems = maxitems
+        self.lock = threading.Lock()
+        self.shared = {}
+    def once(self, key, function):
+        '''Returns function() computed only once for the key (e.g. the
+        ChEMBL decoys, which are shared by all targets)'''
+        with self.lock:
+            if key not in self.shared:
+                self.shared[key] = [threading.Lock(), None, False]
+            entry = self.shared[key]
+        with entry[0]:
+            if not entry[2]:
+                entry[1] = function()
+                entry[2] = True
+        return entry[1]
+    def _runStage(self, i, item):
+        if self.context: tracing.setContext(**self.context(item))
+        return self.stages[i][1](item)
+    def run(self, items):
+        '''Runs all items through the stages'''
+        if not self.workers:
+            for item in items:
+                for i in range(len(self.stages)):
+                    item = self._runStage(i, item)
+                    if item is None: break
+            return
+        self.error = None
+        self.queues = [Queue.Queue(self.maxitems) for s in self.stages]
+        self.remaining = list(self.workers)
+        threads = []
+        for i,n in enumerate(self.workers):
+            for j in range(n):
+                t = threading.Thread(target=self._work, args=(i,))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+        for item in items:
+            if self.error: break
+            self.queues[0].put(item)
+        for j in range(self.workers[0]):
+            self.queues[0].put(_end_of_items)
+        for t in threads:
+            # join with a timeout, so that the main thread can be interrupted
+            while t.isAlive(): t.join(1.0)
+        tracing.flush()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+    def _work(self, i):
+        '''Worker of stage i: after an error, the remaining items are
+        dropped, so that no stage blocks'''
+        while 1:
+            item = self.queues[i].get()
+            if item is _end_of_items: break
+            if self.error is None:
+                try:
+                    item = self._runStage(i, item)
+                except Exception:
+                    with self.lock:
+                        if self.error is None: self.error = sys.exc_info()
+                    item = None
+            else:
+                item = None
+            if item is not None and i+1 < len(self.stages):
+                self.queues[i+1].put(item)
+        with self.lock:
+            self.remaining[i] -= 1
+            last = self.remaining[i] == 0
+        if last and i+1 < len(self.stages):
+            for j in range(self.workers[i+1]):
+                self.queues[i+1].put(_end_of_items)
+
 # dictionary for similarity measures
 simil_dict = {}
 simil_dict['Dice'] = lambda x,y: sorted(DataStructs.BulkDiceSimilarity(x,y), reverse=True)
@@ -97,6 +450,21 @@ def getBulkSimilarity(fp, fp_list, simil):
     '''Calculate the bulk similarity for a given list of fingerprints'''
     return simil_dict[simil](fp,fp_list)
 
+def getTopRanked(single_score, num_top):
+    '''Returns the first num_top entries of the list sorted in
+    descending order (as sorted(single_score, reverse=True)) with
+    a partial sort on the first element of the entries'''
+    num_mol = len(single_score)
+    if num_top >= num_mol:
+        return sorted(single_score, reverse=True)
+    values = numpy.array([s[0] for s in single_score], dtype=float)
+    # value of the entry at position num_top
+    threshold = numpy.partition(values, num_mol-num_top)[num_mol-num_top]
+    # all entries with this value are kept, ties are resolved by the full sort
+    top = [single_score[i] for i in numpy.flatnonzero(values >= threshold)]
+    top.sort(reverse=True)
+    return top[:num_top]
+
 # helper functions for the fusion
 def printFPs(fps, fpname):
     '''Prints a list of fingerprints'''
@@ -143,3 +511,179 @@ def getRanks(probas):
     # sort based on internal ID
     ranks.sort(key=operator.itemgetter(-2))
     return ranks
+
+def getRankMatrix(scored_lists):
+    '''Aligns a set of ranked lists on the internal ID and returns
+    the IDs, the labels, and the rank and score matrices
+    (one row per ranked list, the highest rank is the best)'''
+    with tracing.stage('rank_matrix', len(scored_lists)):
+        return _getRankMatrix(scored_lists)
+
+def _getRankMatrix(scored_lists):
+    '''Builds the rank and score matrices (see getRankMatrix())'''
+    num_lists = len(scored_lists)
+    num_mol = len(scored_lists[0])
+    ranks = numpy.empty((num_lists, num_mol), dtype=int)
+    scores = numpy.empty((num_lists, num_mol))
+    ids = None
+    for j,sl in enumerate(scored_lists):
+        if len(sl) != num_mol:
+            raise ValueError('ranked lists have different lengths:', len(sl), num_mol)
+        tmp_ids = numpy.array([s[-2] for s in sl])
+        # sort based on internal ID (stable, as in getRanks())
+        order = numpy.argsort(tmp_ids, kind='mergesort')
+        ranks[j] = numpy.arange(num_mol, 0, -1)[order]
+        scores[j] = numpy.array([s[0] for s in sl], dtype=float)[order]
+        if ids is None:
+            ids = tmp_ids[order]
+            labels = numpy.array([s[-1] for s in sl])[order]
+        elif not numpy.array_equal(ids, tmp_ids[order]):
+            raise ValueError('ranked lists contain different molecules')
+    return ids, labels, ranks, scores
+
+# normalization of the score matrix (per ranked list)
+def _zscore(scores):
+    '''Z-score normalization of each row of a score matrix'''
+    std = scores.std(axis=1)
+    std[std == 0] = 1.0
+    return (scores - scores.mean(axis=1)[:,None]) / std[:,None]
+
+def _minmax(scores):
+    '''Min-max normalization of each row of a score matrix'''
+    lo = scores.min(axis=1)
+    span = scores.max(axis=1) - lo
+    span[span == 0] = 1.0
+    return (scores - lo[:,None]) / span[:,None]
+
+# constant of the reciprocal-rank fusion
+rrf_k = 60
+
+# dictionary for fusion rules
+# input: rank matrix, score matrix, weights per ranked list
+# output: [primary fused value, secondary fused value] per molecule
+fusion_dict = {}
+fusion_dict['max'] = lambda r,s,w: (r.max(axis=0), s.max(axis=0))
+fusion_dict['ave'] = lambda r,s,w: (r.mean(axis=0), s.mean(axis=0))
+fusion_dict['sum'] = lambda r,s,w: (r.sum(axis=0), s.sum(axis=0))
+fusion_dict['rrf'] = lambda r,s,w: ((1.0/(rrf_k + r.shape[1] - r + 1)).sum(axis=0), s.mean(axis=0))
+fusion_dict['zscore'] = lambda r,s,w: (_zscore(s).mean(axis=0), r.mean(axis=0))
+fusion_dict['minmax'] = lambda r,s,w: (_minmax(s).mean(axis=0), r.mean(axis=0))
+fusion_dict['weighted'] = lambda r,s,w: (numpy.average(r, axis=0, weights=w), numpy.average(_minmax(s), axis=0, weights=w))
+
+def checkFusion(method):
+    '''Checks if the chosen fusion rule is supported'''
+    if method not in fusion_dict:
+        raise ValueError('fusion rule is unknown. supported rules are:', sorted(fusion_dict.keys()))
+
+def fuseRanks(ids, labels, ranks, scores, method, weights=None):
+    '''Applies a fusion rule to aligned rank and score matrices
+    and returns the new ranked list'''
+    with tracing.stage('fusion', len(ids), method):
+        fused_rank, fused_score = fusion_dict[method](ranks, scores, weights)
+        # sort descending on [fused rank, fused score, internal ID, active/inactive]
+        order = numpy.lexsort((labels, ids, fused_score, fused_rank))[::-1]
+        # store: [fused rank, fused score, internal ID, active/inactive]
+        return [list(l) for l in zip(fused_rank[order].tolist(), fused_score[order].tolist(), ids[order].tolist(), labels[order].tolist())]
+
+# checkpoint journal of the scoring of a target: when the target is
+# finished, the journal contains the line 'done'; with units, the
+# scored list of each finished (repetition, fingerprint) unit is
+# appended to a file with the partial results, which is flushed to
+# disk once per repetition before the units of the repetition are
+# recorded in the journal; in the streaming mode only the ranked
+# lists of the kept sample are recorded, the other repetitions are
+# recorded with their validation results (unit results_unit)
+#
+# the journal belongs to a target and to the settings of the run
+# (fingerprints, number of query mols, similarity metric, ...), so
+# that runs with other settings into the same output path are resumed
+# separately; the settings enter the file name as a short hash
+
+# name of the unit with the validation results of a repetition
+results_unit = '#validation'
+
+class Checkpoint:
+    '''Journal of the finished target (with units: and of its
+    finished units), read in if an interrupted run is resumed'''
+    def __init__(self, outpath, name, resume, settings=None, units=False):
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        name = '_'.join([script, name, hashlib.md5(repr(settings or [])).hexdigest()[:12]])
+        self.journalname = outpath+'/checkpoint_'+name+'.journal'
+        self.partname = outpath+'/checkpoint_'+name+'.part'
+        self.units = units
+        self.done = False
+        self.scores = {}
+        self.pending = []
+        finished = set()
+        if resume and os.path.exists(self.journalname):
+            for line in open(self.journalname, 'r'):
+                line = line.rstrip().split('\t')
+                if line[0] == 'done':
+                    self.done = True
+                elif len(line) == 2:
+                    finished.add((line[0], line[1]))
+            if self.done: return
+            if units: self._readPart(finished)
+        self.finished = set(self.scores.keys())
+        if units: self._rewrite()
+    def _readPart(self, finished):
+        '''Reads the scored lists of the finished units'''
+        if not os.path.exists(self.partname): return
+        myfile = open(self.partname, 'rb')
+        while 1:
+            try:
+                q, fp, scored_list = cPickle.load(myfile)
+            except Exception: # end of file or incomplete last unit
+                break
+            if (q, fp) in finished:
+                self.scores[(q, fp)] = scored_list
+        myfile.close()
+    def _rewrite(self):
+        '''Writes the partial results and the journal of the finished
+        units and opens them for appending'''
+        outfile = open(self.partname+'.tmp', 'wb')
+        for (q, fp), scored_list in sorted(self.scores.items()):
+            cPickle.dump([q, fp, scored_list], outfile, 2)
+        outfile.close()
+        os.rename(self.partname+'.tmp', self.partname)
+        outfile = open(self.journalname+'.tmp', 'w')
+        outfile.writelines("%s\t%s\n" % k for k in sorted(self.scores.keys()))
+        outfile.close()
+        os.rename(self.journalname+'.tmp', self.journalname)
+        self.partfile = open(self.partname, 'ab')
+        self.journal = open(self.journalname, 'a')
+    def isFinished(self, q, fp):
+        return (str(q), fp) in self.finished
+    def get(self, q, fp):
+        '''Returns the scored list (or the validation results) of
+        a finished unit'''
+        return self.scores.pop((str(q), fp))
+    def add(self, q, fp, scored_list):
+        '''Records a finished unit (q: repetition or paper); the
+        unit results_unit records validation results; the unit is
+        in the journal after the next sync()'''
+        if not self.units: return
+        with tracing.stage('checkpoint', len(scored_list), fp):
+            cPickle.dump([str(q), fp, scored_list], self.partfile, 2)
+            self.pending.append((q, fp))
+    def sync(self):
+        '''Flushes the partial results to disk and records the added
+        units in the journal (once per repetition)'''
+        if not self.pending: return
+        with tracing.stage('checkpoint', len(self.pending)):
+            self.partfile.flush()
+            os.fsync(self.partfile.fileno())
+            self.journal.writelines("%s\t%s\n" % k for k in self.pending)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        self.pending = []
+    def finish(self):
+        '''Marks the target as done and removes the partial results'''
+        if self.units:
+            self.partfile.close()
+            self.journal.close()
+        outfile = open(self.journalname+'.tmp', 'w')
+        outfile.write("done\n")
+        outfile.close()
+        os.rename(self.journalname+'.tmp', self.journalname)
+        if os.path.exists(self.partname): os.remove(self.partname)
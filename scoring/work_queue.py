@@ -0,0 +1,433 @@
+#
+# $Id$
+#
+# work queue for the scoring step on a shared filesystem:
+# the coordinator writes one task per (data set, target,
+# model, fingerprint, number of query mols) into a queue
+# directory, workers on any node claim the tasks by renaming
+# them and run the scoring scripts; claims of workers which
+# stopped (no heartbeat within the timeout) are reclaimed
+#
+# the tasks are claimed largest first: the cost of a task is
+# estimated from the number of compounds and repetitions, the
+# fingerprint and the model, and calibrated with the runtimes
+# of the finished tasks in the queue (and in other queues);
+# runs which resumed an interrupted run are not used
+#
+# INPUT
+# required:
+# command : submit, work or status
+# -q [] : relative path of the queue directory
+# submit:
+# -f [] : file containing the fingerprint names
+# -n [] : number of query mols (subset I only), can be given
+#         multiple times
+# -d [] : subset of data sets: I or II (default: I)
+# -c [] : scoring model: sim, LR, NB or RF, can be given
+#         multiple times (default: sim)
+# -s [] : similarity metric (default: Dice)
+# -l [] : file containing the parameters of the ML models
+# -t [] : only this target ([data set]:[target] for subset I),
+#         can be given multiple times (default: all targets)
+# -o [] : relative output path (default: [queue]/output)
+# -k [] : relative path of another queue directory whose
+#         finished tasks are used to calibrate the cost
+#         model, can be given multiple times
+# work:
+# -w [] : number of local worker processes (default: 1)
+# -x [] : timeout in seconds after which a claim without
+#         heartbeat is reclaimed (default: 600)
+# --help : prints usage
+#
+# OUTPUT: the scored lists in [output]/[model]_[fp](_[num]);
+#         the queue directory contains the tasks in pending,
+#         claimed, done and failed, and the logs of the tasks
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, os.path, sys, time, json, socket, subprocess, threading, gzip, cPickle
+import multiprocessing
+from optparse import OptionParser
+
+# paths
+cwd = os.getcwd()
+path = cwd+'/'
+scoringpath = os.path.dirname(os.path.abspath(__file__))+'/'
+rootpath = scoringpath+'../'
+
+# scripts of the scoring models
+model_scripts = {'sim':'calculate_scored_lists.py', 'LR':'calculate_scored_lists_LR.py',
+                 'NB':'calculate_scored_lists_NB.py', 'RF':'calculate_scored_lists_RF.py'}
+
+# subdirectories of the queue
+queue_dirs = ['pending', 'claimed', 'done', 'failed', 'logs', 'params']
+
+# prepare command-line option parser
+usage = "usage: %prog [options] submit|work|status"
+parser = OptionParser(usage)
+parser.add_option("-q", "--queue", dest="queue", metavar="PATH", help="relative PATH of the queue directory")
+parser.add_option("-f", "--fingerprints", dest="fp_file", metavar="FILE", help="FILE containing the fingerprint names")
+parser.add_option("-n", "--num", action="append", dest="num", type="int", metavar="INT", help="number of query mols (subset I only), can be given multiple times")
+parser.add_option("-d", "--subset", dest="subset", metavar="NAME", help="subset of data sets: I or II (default: I)")
+parser.add_option("-c", "--model", action="append", dest="models", metavar="NAME", help="scoring model: sim, LR, NB or RF, can be given multiple times (default: sim)")
+parser.add_option("-s", "--similarity", dest="simil", metavar="NAME", help="NAME of similarity metric to use (default: Dice)")
+parser.add_option("-l", "--ml", dest="ml_file", metavar="FILE", help="FILE containing the parameters of the ML models")
+parser.add_option("-t", "--target", action="append", dest="targets", metavar="NAME", help="only this target ([data set]:[target] for subset I), can be given multiple times (default: all targets)")
+parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relative output PATH (default: [queue]/output)")
+parser.add_option("-k", "--calibrate", action="append", dest="calibrate", metavar="PATH", help="relative PATH of another queue directory used to calibrate the cost model")
+parser.add_option("-w", "--workers", dest="num_workers", type="int", metavar="INT", help="number of local worker processes (default: 1)")
+parser.add_option("-x", "--timeout", dest="timeout", type="int", metavar="INT", help="timeout in seconds after which a claim without heartbeat is reclaimed (default: 600)")
+
+# relative cost of the scoring models and of the fingerprints
+# (per compound and repetition) before calibration
+model_costs = {'sim':1.0, 'NB':2.0, 'LR':4.0, 'RF':10.0}
+long_fps = ['lecfp4', 'lecfp6', 'lfcfp4', 'lfcfp6', 'laval']
+count_fps = ['ecfc0', 'ecfc2', 'ecfc4', 'ecfc6', 'fcfc2', 'fcfc4', 'fcfc6', 'ap', 'tt']
+
+##################### COST MODEL #########################
+
+_num_compounds = {}
+def countCompounds(filepath):
+    '''Returns the number of compounds in a compound file'''
+    if filepath not in _num_compounds:
+        num = 0
+        if os.path.exists(filepath):
+            for line in gzip.open(filepath, 'r'):
+                if line[0] != '#': num += 1
+        _num_compounds[filepath] = num
+    return _num_compounds[filepath]
+
+def taskSize(subset, conf, dataset, target):
+    '''Returns the number of compounds and repetitions of a target'''
+    inpath_cmp = rootpath+'compounds/'
+    if subset == 'I':
+        num_cmps = countCompounds(inpath_cmp+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_actives.dat.gz')
+        if dataset == 'ChEMBL':
+            num_cmps += countCompounds(inpath_cmp+dataset+'/cmp_list_'+dataset+'_zinc_decoys.dat.gz')
+        else:
+            num_cmps += countCompounds(inpath_cmp+dataset+'/cmp_list_'+dataset+'_'+str(target)+'_decoys.dat.gz')
+        num_reps = conf.num_reps
+    else:
+        num_cmps = countCompounds(inpath_cmp+'ChEMBL/cmp_list_ChEMBL_'+str(target)+'_actives.dat.gz')
+        num_cmps += countCompounds(inpath_cmp+'ChEMBL/cmp_list_ChEMBL_zinc_decoys.dat.gz')
+        actfile = inpath_cmp+'ChEMBL_II/Target_no_'+str(target)+'.pkl'
+        num_reps = 1
+        if os.path.exists(actfile): num_reps = len(cPickle.load(open(actfile, 'r')))
+    return max(num_cmps, 1), num_reps
+
+def taskCost(model, fp, num, num_cmps, num_reps):
+    '''Returns the cost of a task before calibration'''
+    fp_cost = 1.0
+    if fp in long_fps: fp_cost = 4.0
+    elif fp in count_fps: fp_cost = 2.0
+    # the similarity search scales with the number of query mols
+    num_query = 1
+    if model == 'sim' and num: num_query = num
+    return num_cmps * num_reps * num_query * fp_cost * model_costs[model]
+
+def calibrateCosts(queuedirs):
+    '''Returns the factors from cost to runtime per (model, fp),
+    per model and overall, fitted on the finished tasks'''
+    sums = {}
+    for queuedir in queuedirs:
+        if not os.path.exists(queuedir+'done'): continue
+        for f in os.listdir(queuedir+'done'):
+            if not f.endswith('.json'): continue
+            task = json.load(open(queuedir+'done/'+f, 'r'))
+            if not task.get('cost') or not task.get('runtime'): continue
+            if task.get('resumed'): continue # runtime of the remaining units only
+            for key in [(task['model'], task['fp']), task['model'], None]:
+                s = sums.setdefault(key, [0.0, 0.0])
+                s[0] += task['runtime']
+                s[1] += task['cost']
+    return dict([(key, s[0]/s[1]) for key, s in sums.items()])
+
+def estimateRuntime(task, factors):
+    '''Returns the estimated runtime of a task in seconds (or the
+    cost if no finished tasks are available for calibration)'''
+    for key in [(task['model'], task['fp']), task['model'], None]:
+        if key in factors: return task['cost'] * factors[key]
+    return task['cost']
+
+##################### TASKS #########################
+
+def getTargets(subset, conf, selection=None):
+    '''Returns the targets of a subset as [data set, target,
+    selection name, name of the list file]'''
+    targets = []
+    if subset == 'I':
+        for dataset in conf.set_data.keys():
+            for target in conf.set_data[dataset]['ids']:
+                targets.append([dataset, target, dataset+':'+str(target), dataset+'_'+str(target)])
+    else:
+        for target in conf.set_data:
+            targets.append(['ChEMBL', target, str(target), str(target)])
+    if selection:
+        targets = [t for t in targets if t[2] in selection or str(t[1]) in selection]
+    return targets
+
+def makeTasks(subset, conf, fp_names, models, nums, options, queuedir, outpath):
+    '''Returns the scoring tasks; a task is a dictionary with the
+    name, the script (relative to the scoring directory) and the
+    arguments (paths relative to the directory of the script)'''
+    scriptdir = scoringpath+'data_sets_'+subset+'/'
+    rel = lambda p: os.path.relpath(p, scriptdir)
+    simil = options.simil or 'Dice'
+    tasks = []
+    for dataset, target, selection, listname in getTargets(subset, conf, options.targets):
+        num_cmps, num_reps = taskSize(subset, conf, dataset, target)
+        for num in nums:
+            for model in models:
+                for fp in fp_names:
+                    name = model+'_'+fp
+                    if num: name += '_'+str(num)
+                    outdir = outpath+name
+                    args = ['-o', rel(outdir), '-s', simil, '-t', selection, '--resume', '--checkpoint']
+                    if num: args += ['-n', str(num)]
+                    if model == 'sim':
+                        args += ['-f', rel(queuedir+'params/fp_'+fp+'.txt')]
+                    else:
+                        args += ['-f', fp]
+                        if options.ml_file: args += ['-m', rel(path+options.ml_file)]
+                    tasks.append(dict(name=name+'_'+listname, script='data_sets_'+subset+'/'+model_scripts[model],
+                                      args=args, outdir=outdir, output=outdir+'/list_'+listname+'.pkl.gz',
+                                      dataset=dataset, target=str(target), model=model, fp=fp, num=num,
+                                      cost=taskCost(model, fp, num, num_cmps, num_reps)))
+    return tasks
+
+def writeJSON(filepath, data):
+    '''Writes a json file under a temporary name and renames it'''
+    outfile = open(filepath+'.tmp', 'w')
+    json.dump(data, outfile)
+    outfile.close()
+    os.rename(filepath+'.tmp', filepath)
+
+def taskFilename(task):
+    '''Returns the file name of a task; the prefix decreases with
+    the estimated runtime so that the largest tasks come first'''
+    return '%015i-%s.json' % (max(10**15-1-int(round(task['estimate']*1000)), 0), task['name'])
+
+def submitTasks(queuedir, tasks, factors={}):
+    '''Writes the tasks into the pending directory of the queue;
+    tasks which are already in the queue are skipped, failed tasks
+    are submitted again'''
+    known = set()
+    failed = {}
+    for d in ['pending', 'claimed', 'done', 'failed']:
+        for f in os.listdir(queuedir+d):
+            name = f.split('.json')[0].split('-', 1)[-1]
+            if d == 'failed': failed[name] = f
+            else: known.add(name)
+    num = 0
+    for t in tasks:
+        if t['name'] in known: continue
+        if t['name'] in failed: # resubmitted
+            os.remove(queuedir+'failed/'+failed[t['name']])
+        if not os.path.exists(t['outdir']): os.makedirs(t['outdir'])
+        t['estimate'] = estimateRuntime(t, factors)
+        writeJSON(queuedir+'pending/'+taskFilename(t), t)
+        num += 1
+    return num
+
+##################### WORKERS #########################
+
+def _claimTime(filename):
+    '''Time of a claim, stored in the name of the claimed file'''
+    return float(filename.rsplit('.', 2)[-1].replace('_', '.'))
+
+def claimTask(queuedir, worker_id):
+    '''Claims the largest pending task by renaming it into the claimed
+    directory (atomic on POSIX filesystems); returns the name of the
+    claimed file or None if no task is pending'''
+    for f in sorted(os.listdir(queuedir+'pending')):
+        if not f.endswith('.json'): continue
+        claimed = f+'.'+worker_id+'.'+('%.3f' % time.time()).replace('.', '_')
+        try:
+            os.rename(queuedir+'pending/'+f, queuedir+'claimed/'+claimed)
+        except OSError: # claimed by another worker
+            continue
+        return claimed
+    return None
+
+def reclaimStale(queuedir, timeout):
+    '''Moves claimed tasks without heartbeat within the timeout
+    back to the pending directory; returns the number of reclaimed tasks'''
+    num = 0
+    now = time.time()
+    for f in os.listdir(queuedir+'claimed'):
+        try:
+            last = max(_claimTime(f), os.path.getmtime(queuedir+'claimed/'+f))
+            if now - last > timeout:
+                os.rename(queuedir+'claimed/'+f, queuedir+'pending/'+f.split('.json')[0]+'.json')
+                print "reclaimed:", f
+                num += 1
+        except (OSError, ValueError): # finished or reclaimed by another worker
+            continue
+    return num
+
+def _heartbeat(filepath, interval, stop):
+    '''Touches the claimed file until stop is set'''
+    while not stop.wait(interval):
+        try:
+            os.utime(filepath, None)
+        except OSError:
+            return
+
+def isResumed(task):
+    '''Returns True if a checkpoint journal of the task exists, i.e.
+    the scoring script resumes an interrupted run'''
+    if not os.path.exists(task['outdir']): return False
+    script = os.path.splitext(os.path.basename(task['script']))[0]
+    listname = os.path.basename(task['output'])[len('list_'):-len('.pkl.gz')]
+    prefix = 'checkpoint_'+script+'_'+listname+'_'
+    for f in os.listdir(task['outdir']):
+        if f.startswith(prefix) and f.endswith('.journal'): return True
+    return False
+
+def runTask(queuedir, claimed, timeout):
+    '''Runs the scoring script of a claimed task and moves the task
+    to the done or failed directory; returns True if successful'''
+    task = json.load(open(queuedir+'claimed/'+claimed, 'r'))
+    resumed = isResumed(task)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(queuedir+'claimed/'+claimed, max(timeout/4.0, 1.0), stop))
+    heartbeat.daemon = True
+    heartbeat.start()
+    log = open(queuedir+'logs/'+task['name']+'.log', 'a')
+    start = time.time()
+    scriptdir = scoringpath+os.path.dirname(task['script'])
+    returncode = subprocess.call([sys.executable, os.path.basename(task['script'])] + task['args'],
+                                 cwd=scriptdir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    stop.set()
+    heartbeat.join()
+    success = returncode == 0 and os.path.exists(task['output'])
+    task.update(returncode=returncode, host=socket.gethostname(), runtime=time.time()-start, resumed=resumed)
+    result = 'done' if success else 'failed'
+    writeJSON(queuedir+result+'/'+claimed.split('.json')[0]+'.json', task)
+    try:
+        os.remove(queuedir+'claimed/'+claimed)
+    except OSError: # reclaimed in the meantime
+        pass
+    return success
+
+def workLoop(queuedir, timeout):
+    '''Claims and runs tasks until no task is pending or claimed'''
+    worker_id = socket.gethostname()+'_'+str(os.getpid())
+    while True:
+        reclaimStale(queuedir, timeout)
+        claimed = claimTask(queuedir, worker_id)
+        if claimed:
+            name = claimed.split('.json')[0]
+            print worker_id, "started:", name
+            if runTask(queuedir, claimed, timeout):
+                print worker_id, "finished:", name
+            else:
+                print worker_id, "failed:", name
+        elif os.listdir(queuedir+'claimed'):
+            # wait for the other workers or their claims to become stale
+            time.sleep(min(timeout/4.0, 10.0))
+        else:
+            break
+
+def queueStatus(queuedir):
+    '''Returns the number of tasks in each state'''
+    status = {}
+    for d in ['pending', 'claimed', 'done', 'failed']:
+        status[d] = len([f for f in os.listdir(queuedir+d) if '.json' in f and not f.endswith('.tmp')])
+    return status
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in ['submit', 'work', 'status']:
+        raise RuntimeError('command submit, work or status required!')
+    command = args[0]
+    if not options.queue:
+        raise RuntimeError('one or more of the required options was not given!')
+    queuedir = path+options.queue+'/'
+    for d in queue_dirs:
+        if not os.path.exists(queuedir+d): os.makedirs(queuedir+d)
+
+    if command == 'submit':
+        if not options.fp_file:
+            raise RuntimeError('one or more of the required options was not given!')
+        subset = options.subset or 'I'
+        if subset not in ['I', 'II']:
+            raise ValueError('subset not supported:', subset)
+        sys.path.insert(0, rootpath)
+        conf = __import__('configuration_file_'+subset)
+        nums = [None]
+        if subset == 'I':
+            if not options.num: raise RuntimeError('number of query mols (-n) required for subset I')
+            for num in options.num:
+                if num not in conf.list_num_query_mols:
+                    raise ValueError('number of query mols not supported:', num)
+            nums = options.num
+        models = options.models or ['sim']
+        for model in models:
+            if model not in model_scripts:
+                raise ValueError('scoring model not supported:', model)
+        outpath = queuedir+'output/'
+        if options.outpath: outpath = path+options.outpath+'/'
+        fp_names = []
+        for line in open(path+options.fp_file, 'r'):
+            line = line.rstrip().split()
+            if line: fp_names.append(line[0])
+        for fp in fp_names:
+            outfile = open(queuedir+'params/fp_'+fp+'.txt', 'w')
+            outfile.write(fp+"\n")
+            outfile.close()
+        tasks = makeTasks(subset, conf, fp_names, models, nums, options, queuedir, outpath)
+        queuedirs = [queuedir]
+        if options.calibrate: queuedirs += [path+q+'/' for q in options.calibrate]
+        factors = calibrateCosts(queuedirs)
+        if None in factors:
+            print "cost model calibrated with the finished tasks"
+        print submitTasks(queuedir, tasks, factors), "tasks submitted"
+
+    elif command == 'work':
+        timeout = 600
+        if options.timeout: timeout = options.timeout
+        num_workers = 1
+        if options.num_workers: num_workers = options.num_workers
+        if num_workers == 1:
+            workLoop(queuedir, timeout)
+        else:
+            workers = [multiprocessing.Process(target=workLoop, args=(queuedir, timeout)) for i in range(num_workers)]
+            for w in workers: w.start()
+            for w in workers: w.join()
+
+    status = queueStatus(queuedir)
+    print " ".join(["%s: %i" % (d, status[d]) for d in ['pending', 'claimed', 'done', 'failed']])
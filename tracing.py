@@ -0,0 +1,294 @@
+#
+# $Id$
+#
+# instrumentation of the benchmarking scripts: the time spent
+# in each stage (parsing of the SMILES, fingerprints, similarity,
+# model fitting, validation, reading and writing of the lists, ...)
+# is summed per (stage, data set, target, fingerprint) and written
+# as JSON lines to the trace file given by the environment variable
+# BENCHMARK_TRACE (no tracing if not set)
+#
+# a record contains the name of the script, the process id, the
+# stage, the data set, the target, the fingerprint, the number
+# of calls and of items, the wall and CPU time in seconds and
+# the peak RSS of the process in kB; the CPU time is that of the
+# thread running the stage (stages run on several threads in the
+# pipelined mode and next to the compound readers), it is null if
+# the platform has no CPU time per thread (RUSAGE_THREAD, Linux) and
+# several threads are running; the fingerprint processes of the
+# pipelined mode write their own records, the main process records
+# the waiting for them (fingerprint_pool)
+#
+# used as script: summarizes one or more trace files and prints
+# the hot spots
+#
+# INPUT
+# required:
+# [] : trace files
+# optional:
+# -g [] : comma-separated fields to group by: script, stage,
+#         dataset, target, fp (default: stage,fp)
+# -n [] : number of hot spots printed (default: 10)
+# -s [] : sort by wall or cpu time (default: wall)
+# --help : prints usage
+#
+# OUTPUT: for each group the wall and CPU time, the share of
+#         the total wall time, the number of calls and items,
+#         the throughput (items per second) and the peak RSS
+#
+#  Copyright (c) 2013, Novartis Institutes for BioMedical Research Inc.
+#  All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met: 
+#
+#     * Redistributions of source code must retain the above copyright 
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following 
+#       disclaimer in the documentation and/or other materials provided 
+#       with the distribution.
+#     * Neither the name of Novartis Institutes for BioMedical Research Inc. 
+#       nor the names of its contributors may be used to endorse or promote 
+#       products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os, sys, time, json, atexit, threading
+import resource
+from optparse import OptionParser
+
+# environment variable with the path of the trace file
+trace_env = 'BENCHMARK_TRACE'
+
+# fields of the key of a record
+key_fields = ['stage', 'dataset', 'target', 'fp']
+
+# CPU time per thread (Linux); missing in the resource module of Python 2
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', None)
+if RUSAGE_THREAD is None and sys.platform.startswith('linux'):
+    RUSAGE_THREAD = 1
+
+def threadCPU():
+    '''CPU time (user + system) of the calling thread; the time of
+    the process if it has only one thread, None otherwise'''
+    if RUSAGE_THREAD is not None:
+        r = resource.getrusage(RUSAGE_THREAD)
+        return r.ru_utime + r.ru_stime
+    if threading.active_count() == 1:
+        return sum(os.times()[:2])
+    return None
+
+class Stage:
+    '''Context manager timing one call of a stage'''
+    def __init__(self, tracer, key, items):
+        self.tracer = tracer
+        self.key = key
+        self.items = items
+    def add(self, items):
+        '''Adds to the number of items processed in the call'''
+        self.items += items
+    def __enter__(self):
+        self.cpu = threadCPU()
+        self.wall = time.time()
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = time.time()-self.wall
+        cpu = threadCPU()
+        if cpu is not None and self.cpu is not None:
+            cpu -= self.cpu
+        else:
+            cpu = None
+        self.tracer.record(self.key, self.items, wall, cpu)
+        return False
+
+class NullStage:
+    '''Stage used if the tracing is switched off'''
+    def add(self, items):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_null_stage = NullStage()
+
+class Tracer:
+    '''Sums up the calls of the stages and appends them to the
+    trace file when the context changes or the process ends; the
+    context is kept per thread (stages running on several threads)'''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.script = os.path.basename(sys.argv[0])
+        self.local = threading.local()
+        self.reset()
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.stats = {}
+    def getContext(self):
+        if not hasattr(self.local, 'context'):
+            self.local.context = {}
+        return self.local.context
+    def stage(self, name, items=0, fp=None):
+        if os.getpid() != self.pid: # forked process, the records belong to the parent
+            self.reset()
+        context = self.getContext()
+        key = (name, context.get('dataset'), context.get('target'), fp or context.get('fp'))
+        return Stage(self, key, items)
+    def record(self, key, items, wall, cpu):
+        with self.lock:
+            s = self.stats.get(key)
+            if s is None:
+                s = self.stats[key] = [0, 0, 0.0, 0.0]
+            s[0] += 1
+            s[1] += items
+            s[2] += wall
+            s[3] = _addCPU(s[3], cpu)
+    def setContext(self, **context):
+        self.flush()
+        for k,v in context.items():
+            if v is not None: v = str(v)
+            self.getContext()[k] = v
+    def flush(self):
+        '''Appends the records to the trace file; each record is
+        written with a single call, so that several processes
+        can write to the same file'''
+        if os.getpid() != self.pid:
+            self.reset()
+        with self.lock:
+            stats = self.stats
+            self.stats = {}
+        if not stats: return
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        lines = []
+        for key in sorted(stats.keys()):
+            calls, items, wall, cpu = stats[key]
+            rec = dict(zip(key_fields, key))
+            rec.update(script=self.script, pid=self.pid, calls=calls, items=items,
+                       wall=round(wall, 6), cpu=cpu if cpu is None else round(cpu, 6), peak_rss_kb=rss)
+            lines.append(json.dumps(rec, sort_keys=True)+'\n')
+        fd = os.open(self.filepath, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+        for line in lines:
+            os.write(fd, line)
+        os.close(fd)
+
+def _addCPU(total, cpu):
+    '''Sums CPU times, None if one of them is unknown'''
+    if total is None or cpu is None: return None
+    return total + cpu
+
+_tracer = None
+
+def startTrace(filepath):
+    '''Switches on the tracing into a file'''
+    global _tracer
+    if _tracer: _tracer.flush()
+    _tracer = Tracer(filepath)
+    return _tracer
+
+def stage(name, items=0, fp=None):
+    '''Returns a context manager timing one call of a stage;
+    fp overrides the fingerprint of the context'''
+    if _tracer is None: return _null_stage
+    return _tracer.stage(name, items, fp)
+
+def setContext(**context):
+    '''Sets the data set, target or fingerprint of the
+    following records (None removes it)'''
+    if _tracer: _tracer.setContext(**context)
+
+def getContext():
+    '''Returns the context of the calling thread'''
+    if _tracer is None: return {}
+    return dict(_tracer.getContext())
+
+def flush():
+    '''Writes the records summed up so far'''
+    if _tracer: _tracer.flush()
+
+if os.environ.get(trace_env):
+    startTrace(os.path.abspath(os.environ[trace_env]))
+atexit.register(flush)
+
+##################### SUMMARY #########################
+
+def readTrace(filepaths):
+    '''Reads the records of one or more trace files'''
+    records = []
+    for f in filepaths:
+        for line in open(f, 'r'):
+            line = line.strip()
+            if line: records.append(json.loads(line))
+    return records
+
+def summarizeTrace(records, groupby=['stage', 'fp']):
+    '''Returns for each group [group values..., calls, items, wall,
+    cpu, peak RSS]; the peak RSS is the maximum over the processes'''
+    groups = {}
+    for r in records:
+        g = tuple([r.get(f) for f in groupby])
+        s = groups.setdefault(g, [0, 0, 0.0, 0.0, 0])
+        s[0] += r['calls']
+        s[1] += r['items']
+        s[2] += r['wall']
+        s[3] = _addCPU(s[3], r['cpu'])
+        s[4] = max(s[4], r['peak_rss_kb'])
+    return [list(g)+s for g,s in groups.items()]
+
+
+######################## MAIN PART ###########################
+if __name__=='__main__':
+
+    # prepare command-line option parser
+    usage = "usage: %prog [options] trace files"
+    parser = OptionParser(usage)
+    parser.add_option("-g", "--groupby", dest="groupby", metavar="LIST", help="comma-separated fields to group by (default: stage,fp)")
+    parser.add_option("-n", "--num", dest="num", type="int", metavar="INT", help="number of hot spots printed (default: 10)")
+    parser.add_option("-s", "--sort", dest="sort", metavar="NAME", help="sort by wall or cpu time (default: wall)")
+
+    # read in command line options
+    (options, args) = parser.parse_args()
+    if not args:
+        raise RuntimeError('one or more of the required options was not given!')
+    groupby = ['stage', 'fp']
+    if options.groupby: groupby = options.groupby.split(',')
+    for g in groupby:
+        if g not in key_fields+['script']:
+            raise ValueError('cannot group by', g)
+    num = 10
+    if options.num: num = options.num
+    sort = 'wall'
+    if options.sort: sort = options.sort
+    if sort not in ['wall', 'cpu']:
+        raise ValueError('cannot sort by', sort)
+
+    rows = summarizeTrace(readTrace(args), groupby)
+    n = len(groupby)
+    col = n+2
+    if sort == 'cpu': col = n+3
+    rows.sort(key=lambda r: r[col], reverse=True)
+    total = sum([r[n+2] for r in rows])
+    print "# total wall time: %.2f s" % total
+    print "# "+" ".join(groupby)+" wall[s] cpu[s] share[%] calls items items/s peak_rss[MB]"
+    for r in rows[:num]:
+        wall = r[n+2]
+        rate = 0.0
+        if wall > 0: rate = r[n+1]/wall
+        share = 0.0
+        if total > 0: share = 100.0*wall/total
+        cpu = 'n/a'
+        if r[n+3] is not None: cpu = "%.2f" % r[n+3]
+        print " ".join([str(x) for x in r[:n]]), "%.2f %s %.1f %i %i %.1f %.1f" % (wall, cpu, share, r[n], r[n+1], rate, r[n+4]/1024.0)
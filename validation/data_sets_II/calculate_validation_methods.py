@@ -14,6 +14,9 @@
 # -i [] : relative input path (default: pwd/../scoring)
 # -o [] : relative output path (default: pwd)
 # -r [] : file containing fingerprints to leave out
+# -j [] : number of targets validated in parallel (default: 1)
+# -t [] : only this target, can be given multiple times
+#         (default: all targets)
 # --help : prints usage
 #
 # OUTPUT: for each target in each dataset
@@ -54,12 +57,14 @@
 import gzip, cPickle, math, sys, os, os.path
 from collections import defaultdict
 from optparse import OptionParser
-from rdkit.ML.Scoring import Scoring
 
 # import configuration file with global variables
 sys.path.insert(0, os.getcwd()+'/../../')
 import configuration_file_II as conf
 
+# instrumentation of the stages
+import tracing
+
 # import validation functions
 sys.path.insert(0, os.getcwd()+'/../')
 import validation_functions as vfunc
@@ -76,6 +81,32 @@ parser.add_option("-m", "--methods", dest="filename", metavar="FILE", help="FILE
 parser.add_option("-i", "--inpath", action="append", dest="inpath", metavar="PATH", help="relative input PATH (default: pwd/../scoring)")
 parser.add_option("-o", "--outpath", dest="outpath", metavar="PATH", help="relative output PATH (default: pwd)")
 parser.add_option("-r", "--remove", dest="rm_file", metavar="FILE", help="FILE containing the fingerprints to be left out (default: all fingerprints are read)")
+parser.add_option("-j", "--jobs", dest="num_jobs", type="int", metavar="INT", help="number of targets validated in parallel (default: 1)")
+parser.add_option("-t", "--target", action="append", dest="targets", metavar="NAME", help="only this target (target id), can be given multiple times (default: all targets)")
+
+def validateTarget(args):
+    '''Runs the evaluation methods for the scored lists
+    of one target and writes the results'''
+    target, method_dict, inpath, outdir, remove_fps = args
+    tracing.setContext(dataset='ChEMBL', target=target)
+
+    # load scored lists
+    scores = vfunc.readScoredLists([inp+'/list_'+str(target)+'.pkl.gz' for inp in inpath], remove_fps)
+
+    # prepare to store results
+    results = {}
+    for m in method_dict.keys():
+        method_dict[m].addNames(results)
+
+    # loop of papers
+    for q in range(len(scores[scores.keys()[0]])):
+        # run all evaluation methods
+        vfunc.runMethods(method_dict, results, scores, q, -1)
+
+    # write results
+    vfunc.writeResults(outdir+'/validation_'+str(target)+'.pkl.gz', results)
+    tracing.flush()
+    return target, scores.keys()
 
 
 ######################## MAIN PART ###########################
@@ -93,7 +124,7 @@ if __name__=='__main__':
     if not method_dict: raise ValueError('No methods given in', methods_file)
 
     # optional arguments
-    inpath = parentpath+'scoring/'
+    inpath = [parentpath+'scoring/']
     if options.inpath: 
         inpath = [path+i for i in options.inpath]
         vfunc.checkPaths(inpath)
@@ -104,6 +135,8 @@ if __name__=='__main__':
     remove_fps = []
     if options.rm_file:
         remove_fps = vfunc.readFPs(path+options.rm_file)
+    num_jobs = 1
+    if options.num_jobs: num_jobs = options.num_jobs
 
     # print input parameters
     vfunc.printInputParam(method_dict, inpath)
@@ -116,45 +149,10 @@ if __name__=='__main__':
     if not os.path.exists(outdir): os.makedirs(outdir)
 
     # loop over targets
-    for target in conf.set_data:
-        print target
-
-        # load scored lists
-        scores = {}
-        for inp in inpath: # loop over input paths
-            myfile = gzip.open(inp+'/list_'+str(target)+'.pkl.gz', 'r')
-            while 1:
-                try:
-                    tmp = cPickle.load(myfile)
-                except (EOFError):
-                    break
-                else:
-                    # check that fp is not in remove_fps list
-                    if tmp[0] not in remove_fps:
-                        tmp[0] = vfunc.getName(tmp[0], scores.keys())
-                        # input line: [fp_name, list of scored lists]
-                        scores[tmp[0]] = tmp[1]
-        print "scored lists read in"
+    # each target is validated independently and written to its own file
+    tasks = [(target, method_dict, inpath, outdir, remove_fps) for target in conf.set_data if vfunc.checkTarget(options.targets, 'ChEMBL', target)]
+    for target, fps in vfunc.runPool(validateTarget, tasks, num_jobs):
         if printfp:
-            vfunc.printFPs(scores.keys())
+            vfunc.printFPs(fps)
             printfp = False
-
-        # prepare to store results
-        results = {}
-        for m in method_dict.keys():
-            method_dict[m].addNames(results)
-
-        # loop of papers
-        for q in range(len(scores[scores.keys()[0]])):
-            # loop over evaluation methods
-            for m in method_dict.keys(): 
-                method_dict[m].runMethod(results, scores, q, -1)
-
-        print "validation methods calculated"
-
-        # write results
-        outf = gzip.open(outdir+'/validation_'+str(target)+'.pkl.gz', 'wb+')
-        cPickle.dump(results, outf, 2)
-        outf.close()
-
-        print "results written out"
+        print target, "validation methods calculated and results written out"
@@ -34,9 +34,12 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import os
+import os, math, gzip, cPickle
+import numpy
 from collections import defaultdict
-from rdkit.ML.Scoring import Scoring
+
+# instrumentation (the root directory is in the path of the scripts)
+import tracing
 
 
 def checkPaths(filepaths):
@@ -128,19 +131,202 @@ def getName(fp, fp_names):
     else:
         return fp
 
+def checkTarget(selection, dataset, target):
+    '''Checks if a target is selected ([data set]:[target] or
+    [target]); all targets are selected if no selection is given'''
+    if not selection: return True
+    return dataset+':'+str(target) in selection or str(target) in selection
+
+def getListFile(inpath, name):
+    '''Returns the file with the scored lists of a target:
+    list_[name].pkl.gz or the former name list_[name]_.pkl.gz'''
+    filepath = inpath+'/list_'+name+'.pkl.gz'
+    if not os.path.exists(filepath) and os.path.exists(inpath+'/list_'+name+'_.pkl.gz'):
+        filepath = inpath+'/list_'+name+'_.pkl.gz'
+    return filepath
+
+def readScoredLists(filepaths, remove_fps):
+    '''Reads the scored lists of all fingerprints from a set of files
+    and stores them in a dictionary'''
+    scores = {}
+    for f in filepaths: # loop over input files
+        with tracing.stage('read_lists') as st:
+            myfile = gzip.open(f, 'r')
+            while 1:
+                try:
+                    tmp = cPickle.load(myfile)
+                except (EOFError):
+                    break
+                else:
+                    # check that fp is not in remove_fps list
+                    if tmp[0] not in remove_fps:
+                        tmp[0] = getName(tmp[0], scores.keys())
+                        # input line: [fp_name, list of scored lists]
+                        scores[tmp[0]] = tmp[1]
+                        st.add(len(tmp[1]))
+            myfile.close()
+    return scores
+
+def writeResults(filepath, results):
+    '''Writes the validation results of a target; the file is
+    written under a temporary name and renamed when complete'''
+    with tracing.stage('write_results'):
+        outf = gzip.open(filepath+'.tmp', 'wb+')
+        cPickle.dump(results, outf, 2)
+        outf.close()
+        os.rename(filepath+'.tmp', filepath)
+
+def runPool(function, tasks, num_jobs):
+    '''Runs a function for each task, in a process pool if
+    num_jobs > 1; the results are returned as they are done'''
+    if num_jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(num_jobs)
+        for r in pool.imap_unordered(function, tasks):
+            yield r
+        pool.close()
+        pool.join()
+    else:
+        for t in tasks:
+            yield function(t)
+
+# validation kernel
+# a ranked list is described by the (1-based) positions of its actives,
+# the number of molecules and the number of actives. in the
+# early-recognition mode only the top of the ranked list is known.
+
+# early-recognition mode: maximal weight exp(-alpha*k/N) of an active
+# ranked after the top k molecules
+early_tol = 1e-6
+
+def getActivePositions(score, index):
+    '''Extracts the (1-based) positions of the actives
+    in a ranked list'''
+    labels = numpy.array([s[index] for s in score], dtype=bool)
+    return numpy.flatnonzero(labels) + 1
+
+def calcAUC(positions, num_mol, num_act):
+    '''Area under the ROC curve from the positions of the actives
+    (same definition as rdkit.ML.Scoring.CalcAUC)'''
+    num_inact = num_mol - num_act
+    if num_act == 0 or num_inact == 0:
+        return 0.0
+    if len(positions) != num_act:
+        raise ValueError('AUC requires the full ranked list')
+    # number of inactives ranked after each active
+    inact_after = num_inact - (positions - numpy.arange(1, num_act+1))
+    return float(inact_after.sum()) / (num_act*num_inact)
+
+def _getEFCutoffs(num_mol, fractions):
+    '''Helper function for calcEnrichment(): positions at which
+    the enrichment factors are evaluated'''
+    cutoffs = []
+    cutoff = 0
+    for f in fractions:
+        # each fraction is evaluated at least one molecule after the previous one
+        cutoff = max(int(math.ceil(num_mol*f)), cutoff+1)
+        cutoffs.append(min(cutoff, num_mol))
+    return cutoffs
+
+def calcEnrichment(positions, num_mol, num_act, fractions):
+    '''Enrichment factors from the positions of the actives
+    (same definition as rdkit.ML.Scoring.CalcEnrichment)'''
+    for f in fractions:
+        if f > 1 or f < 0:
+            raise ValueError('Fractions must be between [0,1]')
+    if num_act == 0:
+        return [0.0]*len(fractions)
+    enrich = []
+    for i in _getEFCutoffs(num_mol, fractions):
+        # number of actives ranked before position i
+        num_found = numpy.searchsorted(positions, i, side='right')
+        enrich.append(1.0*num_found*num_mol/i/num_act)
+    return enrich
+
+def _calcRIE(positions, num_mol, num_act, alphas, num_ranked):
+    '''Helper function for calcRIE() and calcBEDROC()'''
+    if num_mol == 0:
+        raise ValueError('score list is empty')
+    alphas = numpy.array(alphas, dtype=float)
+    if (alphas <= 0.0).any():
+        raise ValueError('alpha must be greater than zero')
+    if num_act == 0:
+        return numpy.zeros(len(alphas)), alphas
+    denom = 1.0/num_mol * ((1-numpy.exp(-alphas)) / (numpy.exp(alphas/num_mol)-1))
+    # all alphas at once: one row per alpha
+    sum_exp = numpy.exp(-numpy.outer(alphas, positions)/num_mol).sum(axis=1)
+    num_rest = num_act - len(positions)
+    if num_rest > 0:
+        # actives after the top num_ranked molecules: average weight
+        # of the positions num_ranked+1 ... num_mol
+        r = numpy.exp(-alphas/num_mol)
+        tail = r**(num_ranked+1) * (1 - r**(num_mol-num_ranked)) / (1 - r)
+        sum_exp += num_rest * tail / (num_mol-num_ranked)
+    return sum_exp / (num_act*denom), alphas
+
+def calcRIE(positions, num_mol, num_act, alphas, num_ranked=None):
+    '''RIE for a set of alphas from the positions of the actives
+    (same definition as rdkit.ML.Scoring.CalcRIE)'''
+    rie, alphas = _calcRIE(positions, num_mol, num_act, alphas, num_ranked)
+    return rie.tolist()
+
+def calcBEDROC(positions, num_mol, num_act, alphas, num_ranked=None):
+    '''BEDROC for a set of alphas from the positions of the actives
+    (same definition as rdkit.ML.Scoring.CalcBEDROC)'''
+    rie, alphas = _calcRIE(positions, num_mol, num_act, alphas, num_ranked)
+    if num_act == 0:
+        return [0.0]*len(alphas)
+    ratio = 1.0*num_act / num_mol
+    rie_max = (1-numpy.exp(-alphas*ratio)) / (ratio*(1-numpy.exp(-alphas)))
+    rie_min = (1-numpy.exp(alphas*ratio)) / (ratio*(1-numpy.exp(alphas)))
+    bedroc = numpy.ones(len(alphas)) # numActives = numMol
+    diff = rie_max != rie_min
+    bedroc[diff] = (rie[diff] - rie_min[diff]) / (rie_max[diff] - rie_min[diff])
+    return bedroc.tolist()
+
+def runMethods(method_dict, results, scores, query, index, num_mol=None, num_act=None):
+    '''Extracts the positions of the actives of each ranked list
+    once and runs all evaluation methods on them; num_mol and
+    num_act are required if only the top of the lists is given'''
+    with tracing.stage('validation', len(scores)):
+        lists = {}
+        for k in scores.keys(): # fingerprints
+            positions = getActivePositions(scores[k][query], index)
+            if num_mol is None:
+                lists[k] = (positions, len(scores[k][query]), len(positions), len(scores[k][query]))
+            else:
+                lists[k] = (positions, num_mol, num_act, len(scores[k][query]))
+        for m in method_dict.keys():
+            method_dict[m].runMethod(results, lists)
+
+def checkEarly(method_dict):
+    '''Checks if all methods can be calculated from the top of
+    the ranked lists (early-recognition mode)'''
+    for m in method_dict.keys():
+        if not method_dict[m].early:
+            raise ValueError('method not supported in the early-recognition mode:', m)
+
+def getNumRanked(method_dict, num_mol):
+    '''Number of top molecules of a ranked list needed by
+    the evaluation methods'''
+    return max([method_dict[m].numRanked(num_mol) for m in method_dict.keys()])
+
 # class for handling of evaluation methods
 class EvalMethod:
+    early = False
     def __init__(self, name):
         self.method_name = name
         self.names = name
     def addNames(self, results):
         results[self.method_name] = defaultdict(list)
-    def calculate(self, score, index):
-        return Scoring.CalcAUC(score,index)
-    def runMethod(self, results, scores, query, index):
+    def numRanked(self, num_mol):
+        return num_mol
+    def calculate(self, positions, num_mol, num_act, num_ranked):
+        return calcAUC(positions, num_mol, num_act)
+    def runMethod(self, results, lists):
         tmp_list = []
-        for k in scores.keys(): # fingerprints
-            tmp = self.calculate(scores[k][query], index)
+        for k in lists.keys(): # fingerprints
+            tmp = self.calculate(*lists[k])
             tmp_list.append([tmp, k])
         # sort list according to the descending score
         tmp_list.sort(reverse=True)
@@ -150,6 +336,7 @@ class EvalMethod:
             results[self.method_name][l[1]].append([l[0], i+1])
 
 class ParamEvalMethod(EvalMethod):
+    early = True
     def __init__(self, name, params, factor):
         EvalMethod.__init__(self, name)
         self.params = params
@@ -159,11 +346,11 @@ class ParamEvalMethod(EvalMethod):
     def addNames(self, results):
         for n in self.names: 
             results[n] = defaultdict(list)
-    def runMethod(self, results, scores, query, index):
+    def runMethod(self, results, lists):
         tmp_list = [[] for i in range(len(self.names))]
         # loop over fingerprints
-        for k in scores.keys(): 
-            tmp = self.calculate(scores[k][query], index)
+        for k in lists.keys(): 
+            tmp = self.calculate(*lists[k])
             # loop over parameters
             for i in range(len(self.names)):
                 tmp_list[i].append([tmp[i], k])
@@ -177,20 +364,69 @@ class ParamEvalMethod(EvalMethod):
                 results[n][l[1]].append([l[0], j+1])
 
 class EFMethod(ParamEvalMethod):
-    def calculate(self, score, index):
-        return Scoring.CalcEnrichment(score,index,self.params)
+    def numRanked(self, num_mol):
+        return _getEFCutoffs(num_mol, self.params)[-1]
+    def calculate(self, positions, num_mol, num_act, num_ranked):
+        return calcEnrichment(positions, num_mol, num_act, self.params)
 
 class BEDROCMethod(ParamEvalMethod):
-    def calculate(self, score, index):
-        tmp = []
-        for p in self.params:
-            tmp.append(Scoring.CalcBEDROC(score,index,p))
-        return tmp
+    def numRanked(self, num_mol):
+        return min(int(math.ceil(num_mol*math.log(1.0/early_tol)/min(self.params))), num_mol)
+    def calculate(self, positions, num_mol, num_act, num_ranked):
+        return calcBEDROC(positions, num_mol, num_act, self.params, num_ranked)
 
-class RIEMethod(ParamEvalMethod):
-    def calculate(self, score, index):
-        tmp = []
-        for p in self.params:
-            tmp.append(Scoring.CalcRIE(score,index,p))
-        return tmp
+class RIEMethod(BEDROCMethod):
+    def calculate(self, positions, num_mol, num_act, num_ranked):
+        return calcRIE(positions, num_mol, num_act, self.params, num_ranked)
 
+# class for the streaming mode of the scoring step
+class StreamValidation:
+    '''Runs the evaluation methods on the ranked lists of each
+    repetition as soon as they are produced by a scoring script,
+    so that only the results (and a sample of lists) are kept'''
+    def __init__(self, method_dict, num_keep):
+        self.method_dict = method_dict
+        self.num_keep = num_keep
+        self.newTarget()
+    def newTarget(self):
+        self.results = {}
+        for m in self.method_dict.keys():
+            self.method_dict[m].addNames(self.results)
+        self.num_reps = 0
+    def numRanked(self, num_mol):
+        '''Number of top molecules to rank in the early-recognition
+        mode (all for the kept sample)'''
+        if self.num_reps < self.num_keep:
+            return num_mol
+        return getNumRanked(self.method_dict, num_mol)
+    def addRepetition(self, scores, index=-1, num_mol=None, num_act=None):
+        '''Validates the last ranked list of each fingerprint and
+        removes it again unless it belongs to the kept sample'''
+        runMethods(self.method_dict, self.results, scores, -1, index, num_mol, num_act)
+        self.num_reps += 1
+        if self.num_reps > self.num_keep:
+            for k in scores.keys():
+                scores[k].pop()
+    def keeps(self):
+        '''True if the ranked lists of the next repetition belong
+        to the kept sample'''
+        return self.num_reps < self.num_keep
+    def lastResults(self):
+        '''Returns the results of the last repetition
+        {method: {fingerprint: [value, rank]}}'''
+        last = {}
+        for n in self.results.keys():
+            last[n] = dict([(k, v[-1]) for k,v in self.results[n].items()])
+        return last
+    def addResults(self, results):
+        '''Adds the results of a repetition validated before (the
+        checkpoint of a resumed run)'''
+        for n in results.keys():
+            for k,v in results[n].items():
+                self.results[n][k].append(v)
+        self.num_reps += 1
+    def writeTarget(self, outdir, target):
+        '''Writes the results of a target and resets them'''
+        if not os.path.exists(outdir): os.makedirs(outdir)
+        writeResults(outdir+'/validation_'+str(target)+'.pkl.gz', self.results)
+        self.newTarget()